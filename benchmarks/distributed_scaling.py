@@ -0,0 +1,70 @@
+import argparse
+import tensorflow as tf
+import spatial_flow as sf
+from spatial_flow.spatial_tensor import Layout
+from spatial_flow.distribute import Training_Harness
+
+"""
+
+Benchmarks data parallel scaling of a reference Selector + Dense model, from one
+worker up to the requested number, with each worker pinned to a single core.
+
+The per worker batch is fixed, so perfect scaling means aggregate examples per
+second grows linearly with the number of workers.
+
+    python benchmarks/distributed_scaling.py --workers 4 --steps 50
+
+"""
+
+SPATIAL = [32, 32]
+KERNEL = [3, 3]
+CHANNELS = 4
+BATCH = 16
+
+
+def build_model():
+    layout = Layout(SPATIAL, [CHANNELS])
+    reference = sf.reference.Reference(SPATIAL, KERNEL)
+    sf.reference.spatial_kernel(reference)
+    selector = sf.selectors.Selector(reference, layout=layout)
+
+    inputs = tf.keras.Input(layout.signature().shape[1:])
+    comparison = selector(inputs)
+    flat = tf.keras.layers.Reshape([*SPATIAL, CHANNELS * KERNEL[0] * KERNEL[1]])(comparison)
+    outputs = tf.keras.layers.Dense(CHANNELS)(flat)
+    return tf.keras.Model(inputs, outputs)
+
+
+def build_optimizer():
+    return tf.keras.optimizers.SGD(0.01)
+
+
+def per_example_loss(targets, predictions):
+    return tf.reduce_mean(tf.square(targets - predictions), axis=[1, 2, 3])
+
+
+def build_dataset(context):
+    shape = [BATCH, *SPATIAL, CHANNELS]
+    data = tf.data.Dataset.from_tensors((tf.random.normal(shape), tf.random.normal(shape)))
+    return data.repeat()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--steps", type=int, default=50)
+    args = parser.parse_args()
+
+    baseline = None
+    print("workers  examples/s  speedup")
+    for workers in range(1, args.workers + 1):
+        harness = Training_Harness(build_model, build_optimizer, per_example_loss, build_dataset,
+                                   num_workers=workers, threads_per_worker=1)
+        results = harness.run(args.steps)
+        throughput = min(result["examples_per_second"] for result in results)
+        baseline = baseline or throughput
+        print("%7d  %10.1f  %7.2f" % (workers, throughput, throughput / baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+import spatial_flow as sf
+from spatial_flow.spatial_tensor import Layout
+from spatial_flow.ordering import ORDERINGS
+
+"""
+
+Benchmarks the effect of the spatial ordering on gather throughput. The same square
+kernel reference is built under each ordering, and the compiled dense and packed
+selectors are timed on a large grid. The speedup of each ordering over row major is
+reported, followed by a verdict. Speedups within the noise tolerance count as parity.
+
+The curves only help where the gather is bound by reads of the state. On a single CPU
+core the state of a 512 by 512 grid fits in the last level cache, the gather is bound by
+writing its output, and every ordering runs at parity with row major (0.93x to 1.02x
+measured). Larger grids, or more channels, are where any gain should be looked for.
+
+    python benchmarks/gather_locality.py --size 512 --kernel 5 --channels 8 --steps 20
+
+"""
+
+
+def build_reference(size, kernel, ordering):
+    # A centered square kernel. The relative reference is set directly, as
+    # running an update over every location of a large grid is slow.
+    reference = sf.reference.Reference([size, size], [kernel, kernel], ordering=ordering)
+    offsets = np.arange(kernel) - kernel // 2
+    offsets = np.stack(np.meshgrid(offsets, offsets, indexing="ij"), -1)
+    relative = np.broadcast_to(offsets, reference.reference_shape.as_list())
+    reference.relative_reference = tf.constant(relative, dtype=tf.dtypes.int32)
+    return reference
+
+
+def time_selector(selector, state, steps):
+    # Warm up, so that tracing is excluded from timing
+    selector.compiled(state)
+    start = time.perf_counter()
+    for _ in range(steps):
+        output = selector.compiled(state)
+    output.numpy()
+    return (time.perf_counter() - start) / steps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--kernel", type=int, default=5)
+    parser.add_argument("--channels", type=int, default=8)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--tolerance", type=float, default=0.05,
+                        help="Relative difference from row major below which timings count as parity")
+    args = parser.parse_args()
+
+    state = tf.random.normal([args.batch, args.size, args.size, args.channels])
+    results = {}
+    for ordering in ORDERINGS:
+        reference = build_reference(args.size, args.kernel, ordering)
+        layout = Layout([args.size, args.size], [args.channels], ordering=ordering)
+        stored = layout.to_storage(state)
+        dense = sf.selectors.Selector(reference, layout=layout)
+        packed = sf.selectors.Selector(reference, packed=True, layout=layout)
+        results[ordering] = {"dense": time_selector(dense, stored, args.steps),
+                             "packed": time_selector(packed, stored, args.steps)}
+
+    baseline = results["row_major"]
+    for ordering, timings in results.items():
+        print("%-10s dense %8.2fms (%.2fx)   packed %8.2fms (%.2fx)" % (
+            ordering,
+            timings["dense"] * 1000, baseline["dense"] / timings["dense"],
+            timings["packed"] * 1000, baseline["packed"] / timings["packed"]))
+
+    faster = ["%s %s" % (ordering, mode)
+              for ordering, timings in results.items() if ordering != "row_major"
+              for mode in ("dense", "packed")
+              if baseline[mode] / timings[mode] > 1 + args.tolerance]
+    if faster:
+        print("faster than row major by more than %d%%: %s" % (args.tolerance * 100, ", ".join(faster)))
+    else:
+        print("no ordering is faster than row major by more than %d%%; treat as parity" % (args.tolerance * 100))
+
+
+if __name__ == "__main__":
+    main()
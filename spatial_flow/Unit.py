@@ -1,11 +1,246 @@
 import tensorflow as tf
-import spatial_flow as sf
+import tensorflow.keras as keras
 from spatial_flow.utils.error_utils import Unit_Error
-from spatial_flow.selectors import Selector
+from spatial_flow.selectors import Selector, Selection_Cache
+from spatial_flow.reducers import Reducer
+from spatial_flow.spatial_tensor import Spatial_State
+from spatial_flow.combiners import Combiner, sum_combiner
 """
 
-A Unit is a complete and comprehensive spatial flow calculation 
-environment. 
+A Unit is a complete and comprehensive spatial flow calculation
+environment.
+
+It owns a spatial state, along with a collection of reducers and the
+selectors they are tied to, and treats them as a recurrent system. Each
+update step selects from the current state, reduces, and combines the
+reducer outputs into the next state.
+
+The entire run is performed inside a single tf.while_loop, and so once
+compiled nothing returns to python between steps.
 
 """
 
+spatial_register = keras.utils.register_keras_serializable("spatial_flow/unit")
+
+
+@spatial_register
+class Unit(keras.layers.Layer):
+    """
+
+    The Unit class.
+
+    A unit is initialized with a spatial state and a list of reducers. When
+    called with an initial state, it runs "steps" update steps and returns the final state.
+
+    The loop carries only the current state. Each step reads it and produces the
+    next state, which replaces it as the loop variable. Nothing else is carried.
+
+    If checkpoint is true, each step is wrapped in tf.recompute_grad. Only the state
+    entering each step is then kept for the backwards pass, and everything else
+    is recomputed, bounding memory over long horizons.
+
+    If a tolerance is provided, convergence is tracked per sample along the first
+    batch dimension. A sample has converged once the norm of its state delta falls
+    to or below the tolerance, after which its state is frozen. Converged samples are
+    either compacted out of the batch before each step, or simply masked, and the loop
+    exits early once every sample has converged.
+
+    :method run:
+        A compiled entry point, equivalent to calling the unit. If any reducer is not
+        hot swappable, it is rebuilt whenever any reference changes version.
+    """
+    @property
+    def spatial_state(self):
+        return self._spatial_state
+    @property
+    def reducers(self):
+        return self._reducers
+    @property
+    def combiner(self):
+        return self._combiner
+    @property
+    def selectors(self):
+        return [reducer.selector for reducer in self._reducers]
+    @property
+    def steps(self):
+        return self._steps
+    @property
+    def checkpoint(self):
+        return self._checkpoint
+    @property
+    def tolerance(self):
+        return self._tolerance
+    @property
+    def convergence(self):
+        return self._convergence
+    @property
+    def run(self):
+        versions = tuple(selector.reference.version for selector in self.selectors)
+        stale = not all(reducer.hot_swappable for reducer in self._reducers) and self._run_versions != versions
+        if self._run is None or stale:
+            self._run = tf.function(self.__call__)
+            self._run_versions = versions
+        return self._run
+    def __init__(self, spatial_state, reducers, steps=1, checkpoint=False,
+                 tolerance=None, convergence="compact", combiner=None, name="unit"):
+        """
+
+        The initializer
+
+        :param spatial_state: A Spatial_State describing the state being iterated
+        :param reducers: A list of reducers. Each is tied to its own selector.
+        :param steps: The number of update steps to perform by default.
+        :param checkpoint: Whether to recompute each step during the backwards pass.
+        :param tolerance: None to always run every step, else the state delta norm at or below which
+            a sample is considered converged.
+        :param convergence: Either "compact" or "mask". Compact gathers the unconverged samples into a
+            smaller batch before each step, while mask runs the full batch and discards converged results.
+        :param combiner: None to sum the reducer outputs without fusing, else a Combiner merging them into the next state.
+        :param name: The name of the layer.
+        """
+        super().__init__(name=name)
+
+        #Sanity check
+        if not isinstance(spatial_state, Spatial_State):
+            raise Unit_Error("init - spatial_state was not of type 'Spatial_State'")
+        if not isinstance(reducers, (list, tuple)) or len(reducers) == 0:
+            raise Unit_Error("init - reducers was not a nonempty list or tuple")
+        for reducer in reducers:
+            if not isinstance(reducer, Reducer):
+                raise Unit_Error("init - reducers contained an item which was not a reducer")
+            if not isinstance(reducer.selector, Selector):
+                raise Unit_Error("init - reducer was not tied to a selector")
+            if reducer.layout != spatial_state.layout:
+                raise Unit_Error("init - reducer layout %s does not match state layout %s"
+                                 % (reducer.layout, spatial_state.layout))
+        if type(steps) != int or steps < 0:
+            raise Unit_Error("init - steps was not a non-negative integer")
+        if type(checkpoint) != bool:
+            raise Unit_Error("init - checkpoint was not bool")
+        if tolerance is not None and (not isinstance(tolerance, (int, float)) or tolerance < 0):
+            raise Unit_Error("init - tolerance was not None or a non-negative number")
+        if convergence not in ("compact", "mask"):
+            raise Unit_Error("init - convergence was not 'compact' or 'mask'")
+        if combiner is None:
+            #Unfused, as compact convergence shrinks the batch and XLA would compile for every size
+            combiner = sum_combiner(spatial_state.layout, fused=False)
+        if not isinstance(combiner, Combiner):
+            raise Unit_Error("init - combiner was not of type 'Combiner'")
+        if combiner.layout != spatial_state.layout:
+            raise Unit_Error("init - combiner layout %s does not match state layout %s"
+                             % (combiner.layout, spatial_state.layout))
+
+        #Store
+
+        self._spatial_state = spatial_state
+        self._reducers = list(reducers)
+        self._steps = steps
+        self._checkpoint = checkpoint
+        self._tolerance = tolerance
+        self._convergence = convergence
+        self._combiner = combiner
+
+        if checkpoint:
+            self._update = tf.recompute_grad(self.step)
+        else:
+            self._update = self.step
+        self._run = None
+        self._run_versions = None
+
+    def step(self, state):
+        """
+
+        Performs a single update step. Each reducer selects from and reduces
+        the state, after which the combiner merges the results into the next state.
+        Reducers whose selectors would make identical selections share a single one.
+
+        :param state: A tensor in spatialgrid format
+        :return: The next state, in spatialgrid format
+        """
+        cache = Selection_Cache([reducer.selector for reducer in self._reducers if reducer.consumes_selection])
+        outputs = [reducer.reduce_state(state, cache) for reducer in self._reducers]
+        return self._combiner(outputs)
+
+    def build(self, input_shape):
+
+        #Reducer and combiner weights must exist before the loop is entered, as variables
+        #cannot be created inside a while loop. Trace one step on a dummy state to build them.
+
+        input_shape = tf.TensorShape(input_shape)
+        dummy_shape = [1 if item is None else item for item in input_shape.as_list()]
+        self.step(tf.zeros(dummy_shape))
+        super().build(input_shape)
+
+    def converged_step(self, front, converged):
+        """
+
+        Performs a single update step, skipping samples which have already converged.
+
+        :param front: The current state, in spatialgrid format
+        :param converged: A bool tensor with one entry per sample
+        :return: The next state, in spatialgrid format. Converged samples are unchanged.
+        """
+        if self._convergence == "compact":
+            active = tf.where(tf.logical_not(converged))
+            updated = self._update(tf.gather_nd(front, active))
+            return tf.tensor_scatter_nd_update(front, active, updated)
+
+        updated = self._update(front)
+        mask = tf.reshape(converged, [-1] + [1] * (front.shape.rank - 1))
+        return tf.where(mask, front, updated)
+
+    def call(self, initial_state, steps=None, return_steps=False):
+        """
+
+        Runs the recurrent system.
+
+        :param initial_state: A tensor in spatialgrid format.
+        :param steps: None to use the default number of steps, else an integer or scalar int tensor.
+            Passing a tensor avoids retracing when the number of steps changes.
+        :param return_steps: If true, additionally return the number of steps each sample
+            ran for before converging.
+        :return: The state after the final step
+        """
+        if steps is None:
+            steps = self._steps
+        if self._tolerance is not None:
+            final, taken = self.__converging_loop(initial_state, steps)
+            if return_steps:
+                return final, taken
+            return final
+
+        def condition(index, state):
+            return tf.less(index, steps)
+
+        def body(index, state):
+            updated = tf.ensure_shape(self._update(state), state.shape)
+            return index + 1, updated
+
+        _, final = tf.while_loop(condition, body, (tf.constant(0), initial_state))
+        if return_steps:
+            return final, tf.fill(tf.shape(initial_state)[:1], tf.convert_to_tensor(steps, tf.dtypes.int32))
+        return final
+
+    def __converging_loop(self, initial_state, steps):
+        # As the standard loop, but additionally carrying per sample
+        # convergence flags and step counts, and exiting once all samples
+        # have converged.
+
+        def condition(index, state, converged, taken):
+            return tf.logical_and(tf.less(index, steps),
+                                  tf.logical_not(tf.reduce_all(converged)))
+
+        def body(index, state, converged, taken):
+            updated = tf.ensure_shape(self.converged_step(state, converged), state.shape)
+            taken = taken + tf.cast(tf.logical_not(converged), taken.dtype)
+            delta = tf.norm(tf.reshape(updated - state, [tf.shape(state)[0], -1]), axis=-1)
+            converged = tf.logical_or(converged, tf.less_equal(delta, self._tolerance))
+            return index + 1, updated, converged, taken
+
+        batch = tf.shape(initial_state)[:1]
+        loop_vars = (tf.constant(0),
+                     initial_state,
+                     tf.fill(batch, False),
+                     tf.zeros(batch, tf.dtypes.int32))
+        _, final, _, taken = tf.while_loop(condition, body, loop_vars)
+        return final, taken
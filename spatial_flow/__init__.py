@@ -1,8 +1,36 @@
-#Import files
-
-from spatial_flow import core
-from spatial_flow import reducers
-from spatial_flow import selectors
-from spatial_flow import combiners
-from spatial_flow import reference
-from spatial_flow import layers
\ No newline at end of file
+#Import files lazily
+
+"""
+
+Submodules are imported on first access, as in "spatial_flow.reference", so that
+importing spatial_flow alone does not initialize tensorflow. Tools which only build
+and inspect topologies can use spatial_flow.numpy_reference, which needs only numpy.
+
+Keras serializables are registered when their submodule is imported. Access, or
+import, the submodules a saved model uses before loading it.
+
+"""
+
+import importlib
+
+_SUBMODULES = ("core",
+               "reducers",
+               "selectors",
+               "combiners",
+               "reference",
+               "layers",
+               "numpy_reference")
+
+__all__ = list(_SUBMODULES)
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        module = importlib.import_module("spatial_flow." + name)
+        globals()[name] = module
+        return module
+    raise AttributeError("module 'spatial_flow' has no attribute '%s'" % name)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULES))
@@ -0,0 +1,241 @@
+import tensorflow as tf
+import tensorflow.keras as keras
+from spatial_flow.spatial_tensor import Layout
+from spatial_flow.utils.error_utils import Combiner_Error
+from spatial_flow.utils.instrumentation import instrument
+
+"""
+
+A combiner merges the outputs of several reducers back into the
+next spatial state.
+
+Every reducer output shares the layout of the state, and the combiner
+returns a single tensor in that layout. Each output makes a single
+contribution to the next state, such as the output itself, or its
+projection, or its gated share, and the contributions are summed with one
+tf.add_n rather than a chain of full grid intermediates. When fused, the
+combine is compiled by XLA, so the weighting, summation, and projection of
+every output are emitted as a single kernel.
+
+XLA compiles once per distinct input shape. Where the batch changes size
+from step to step, as under compact convergence, every new size compiles
+again, and an unfused combiner is the better choice.
+
+"""
+
+spatial_register = keras.utils.register_keras_serializable("spatial_flow/combiners")
+
+
+@spatial_register
+class Combiner(keras.layers.Layer):
+    """
+
+    The base class for combiners.
+
+    A combiner is called with a list of reducer outputs, each in the
+    spatialgrid format of its layout, and returns the next state.
+
+    :method contribution:
+        The contribution of a single output to the next state. Should be overridden.
+    """
+    @property
+    def layout(self):
+        return self._layout
+    @property
+    def fused(self):
+        return self._fused
+    def __init__(self, layout, fused=True, name="combiner", **kwargs):
+        """
+
+        :param layout: The Layout of the state being combined into
+        :param fused: Whether to compile the combine into a single XLA kernel
+        :param name: The name of the layer
+        """
+        if not isinstance(layout, Layout):
+            raise Combiner_Error("init - layout was not of type 'Layout'")
+        if type(fused) != bool:
+            raise Combiner_Error("init - fused was not bool")
+        super().__init__(name=name, **kwargs)
+
+        self._layout = layout
+        self._fused = fused
+        self._compiled_combine = None
+
+    def contribution(self, index, output):
+        """
+
+        Should be overridden.
+
+        :param index: The position of the output within the list of outputs
+        :param output: The output, in spatialgrid format
+        :return: The output's contribution to the next state, in spatialgrid format
+        """
+
+    def combine(self, outputs):
+        """
+
+        Sums the contributions of every output.
+
+        :param outputs: A list of tensors in spatialgrid format
+        :return: The combined tensor in spatialgrid format
+        """
+        contributions = [self.contribution(index, output) for index, output in enumerate(outputs)]
+        if len(contributions) == 1:
+            return contributions[0]
+        return tf.add_n(contributions)
+
+    @instrument("Combiner.call")
+    def call(self, outputs):
+        """
+
+        :param outputs: A nonempty list of reducer outputs, in spatialgrid format
+        :return: The next state, in spatialgrid format
+        """
+        if not isinstance(outputs, (list, tuple)) or len(outputs) == 0:
+            raise Combiner_Error("call - outputs was not a nonempty list or tuple")
+        for output in outputs[1:]:
+            if not output.shape.is_compatible_with(outputs[0].shape):
+                raise Combiner_Error("call - outputs had incompatible shapes %s and %s"
+                                     % (outputs[0].shape, output.shape))
+
+        if self._fused:
+            if self._compiled_combine is None:
+                self._compiled_combine = tf.function(self.combine, jit_compile=True)
+            return self._compiled_combine(list(outputs))
+        return self.combine(list(outputs))
+
+    def _channel_size(self, input_shape):
+        # The number of entries across the channel dimensions of the outputs
+
+        channel_rank = self._layout.channel_rank
+        shape = tf.TensorShape(input_shape[0])
+        channels = shape[shape.rank - channel_rank:].num_elements()
+        if channels is None:
+            raise Combiner_Error("build - channel shape %s was not fully known"
+                                 % shape[shape.rank - channel_rank:])
+        return channels
+
+
+@spatial_register
+class sum_combiner(Combiner):
+    """
+
+    Sums every output. The default combiner of a Unit.
+
+    """
+    def __init__(self, layout, fused=True, name="sum_combiner", **kwargs):
+        super().__init__(layout, fused=fused, name=name, **kwargs)
+
+    def contribution(self, index, output):
+        return output
+
+
+@spatial_register
+class concat_combiner(Combiner):
+    """
+
+    Concatenates the outputs along the channels, then projects the result
+    back down to the channels of the state with a learned dense layer.
+
+    The concatenation is never materialized. Projecting a concatenation is the
+    same as projecting each output by its own slice of the kernel and summing,
+    which is what is done. The bias is carried by the first output's contribution.
+
+    """
+    def __init__(self,
+                 layout,
+                 use_bias=True,
+                 kernel_initializer="glorot_uniform",
+                 bias_initializer="zeros",
+                 fused=True,
+                 name="concat_combiner",
+                 **kwargs):
+        """
+
+        :param layout: The Layout of the state being combined into
+        :param use_bias: Like keras Dense
+        :param kernel_initializer: Like keras Dense
+        :param bias_initializer: Like keras Dense
+        :param fused: Whether to compile the combine into a single XLA kernel
+        :param name: The name of the layer
+        """
+        super().__init__(layout, fused=fused, name=name, **kwargs)
+        self._use_bias = use_bias
+        self._kernel_initializer = keras.initializers.get(kernel_initializer)
+        self._bias_initializer = keras.initializers.get(bias_initializer)
+
+    def build(self, input_shape):
+        channels = self._channel_size(input_shape)
+        self._channels = channels
+        self._kernel = self.add_weight(name="kernel",
+                                       shape=[len(input_shape), channels, channels],
+                                       initializer=self._kernel_initializer)
+        if self._use_bias:
+            self._bias = self.add_weight(name="bias",
+                                         shape=[channels],
+                                         initializer=self._bias_initializer)
+
+    def contribution(self, index, output):
+        shape = tf.shape(output)
+        leading = shape[:output.shape.rank - self._layout.channel_rank]
+        flat = tf.reshape(output, tf.concat([leading, [self._channels]], axis=0))
+        projected = tf.matmul(flat, tf.cast(self._kernel[index], flat.dtype))
+        if self._use_bias and index == 0:
+            projected = projected + tf.cast(self._bias, projected.dtype)
+        return tf.reshape(projected, shape)
+
+
+@spatial_register
+class gated_combiner(Combiner):
+    """
+
+    Mixes the outputs by a learned softmax gate, so the next state is a
+    convex combination of the reducer outputs.
+
+    The gate is either a single set of logits shared by the whole grid, or, if
+    per_location is true, a separate set for every spatial location.
+
+    """
+    def __init__(self,
+                 layout,
+                 per_location=False,
+                 gate_initializer="zeros",
+                 fused=True,
+                 name="gated_combiner",
+                 **kwargs):
+        """
+
+        :param layout: The Layout of the state being combined into
+        :param per_location: Whether every location has its own gate
+        :param gate_initializer: The initializer of the gate logits. Zeros mixes evenly.
+        :param fused: Whether to compile the combine into a single XLA kernel
+        :param name: The name of the layer
+        """
+        super().__init__(layout, fused=fused, name=name, **kwargs)
+        if type(per_location) != bool:
+            raise Combiner_Error("init - per_location was not bool")
+        self._per_location = per_location
+        self._gate_initializer = keras.initializers.get(gate_initializer)
+
+    @property
+    def per_location(self):
+        return self._per_location
+
+    def build(self, input_shape):
+        shape = [len(input_shape)]
+        if self._per_location:
+            shape += self._layout.stored_spatial_shape.as_list()
+        self._gate = self.add_weight(name="gate",
+                                     shape=shape,
+                                     initializer=self._gate_initializer)
+
+    def gates(self):
+        """ The mixing weight of each output. Sums to one across outputs. """
+        return tf.nn.softmax(self._gate, axis=0)
+
+    def contribution(self, index, output):
+        gates = tf.cast(self.gates()[index], output.dtype)
+        trailing = [1] * self._layout.channel_rank
+        if not self._per_location:
+            trailing += [1] * self._layout.stored_spatial_rank
+        return output * tf.reshape(gates, [*gates.shape, *trailing])
@@ -21,10 +21,10 @@ def indexed_broadcast(input, shape, indices):
     """
     #do some sanity testing
 
-    tf.debugging.assert_integer(shape)
-    tf.debugging.assert_integer(indices)
-    tf.debugging.assert_rank(shape, 1)
-    tf.debugging.assert_rank(indices, 1)
+    error.assert_integer(shape)
+    error.assert_integer(indices)
+    error.assert_rank(shape, 1)
+    error.assert_rank(indices, 1)
 
     #Rearrange for dimensions insertion.
     
@@ -53,6 +53,80 @@ def indexed_broadcast(input, shape, indices):
     return output
 
 
+def flatten_spatial(input, batch_rank, spatial_rank):
+    """ Flattens the spatial dimensions of a tensor in
+    [batch..., spatial..., channel...] format down into a single
+    dimension, producing [batch..., spatial, channel...]. Flattening
+    is row major, matching the linearized reference.
+
+    """
+    shape = tf.shape(input)
+    flat_shape = tf.concat([shape[:batch_rank],
+                            [tf.reduce_prod(shape[batch_rank:batch_rank + spatial_rank])],
+                            shape[batch_rank + spatial_rank:]], axis=0)
+    return tf.reshape(input, flat_shape)
+
+
+def restore_spatial(input, batch_rank, spatial_shape):
+    """ The inverse of flatten_spatial. Accepts a tensor in
+    [batch..., spatial, channel...] format and restores the
+    spatial dimensions to spatial_shape.
+
+    """
+    shape = tf.shape(input)
+    restored_shape = tf.concat([shape[:batch_rank],
+                                tf.constant(tf.TensorShape(spatial_shape).as_list(), dtype=shape.dtype),
+                                shape[batch_rank + 1:]], axis=0)
+    return tf.reshape(input, restored_shape)
+
+
+def move_axis(input, source, destination):
+    """ Moves a single axis of input from source to
+    destination, preserving the order of the others. Needed
+    for segment operations, which only operate on the first axis.
+
+    """
+    rank = input.shape.rank
+    source = source % rank
+    destination = destination % rank
+    permute = [index for index in range(rank) if index != source]
+    permute.insert(destination, source)
+    return tf.transpose(input, permute)
+
+
+
+def inverse_gather(params, indices, inverse, axis):
+    """
+
+    A gather along axis whose gradient uses a precomputed inverse index.
+
+    The gradient of an ordinary gather scatters every incoming gradient back onto its
+    source, and sources read many times contend with one another. Here the incoming
+    gradients are instead reordered so that all reads of each source are adjacent, and
+    summed by a single sorted segment sum.
+
+    :param params: The tensor to gather from
+    :param indices: A 1D int tensor of the entries along axis to gather
+    :param inverse: A tuple of (readers, row_splits, segment_ids) inverting indices, as
+        produced by Reference.inverse_index
+    :param axis: The axis to gather along
+    :return: As tf.gather(params, indices, axis=axis)
+    """
+    readers, row_splits, segment_ids = inverse
+
+    @tf.custom_gradient
+    def gather(params):
+        def grad(upstream):
+            upstream = move_axis(tf.convert_to_tensor(upstream), axis, 0)
+            summed = tf.math.segment_sum(tf.gather(upstream, readers), segment_ids)
+
+            # Trailing locations nobody reads are absent from the sum
+            missing = tf.shape(row_splits)[0] - 1 - tf.shape(summed)[0]
+            summed = tf.pad(summed, [[0, missing]] + [[0, 0]] * (summed.shape.rank - 1))
+            return move_axis(summed, 0, axis)
+        return tf.gather(params, indices, axis=axis), grad
+    return gather(params)
+
 
 def unpack_standard(config, standard, callback, level="spatial", shape=None):
     """
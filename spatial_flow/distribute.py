@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import socket
+import multiprocessing
+
+"""
+
+This section pertains to data parallel training of spatial flow models on a single,
+CPU only, host.
+
+Each worker is a separate local process running a tf.distribute MultiWorkerMirroredStrategy.
+Workers find each other over the loopback interface only, so no network is required. Every
+worker is pinned to a fixed number of threads, which means scaling comes from processes
+rather than from a single map_fn loop fighting over one thread pool.
+
+References hold their pointers in non-trainable variables, but they are not layers, and
+so their variables are neither model variables nor kept consistent by the strategy. Whenever
+references are mutated during training, "sync_references" must be called on every worker. It
+broadcasts the chief's copy of each reference to every other worker, keeping the topology
+identical across replicas. The chief's copy is restored into each reference in place, so
+compiled steps on hot swappable paths pick it up without being rebuilt.
+
+Tensorflow is deliberately not imported at module level. Thread counts and the cluster
+configuration must be set before tensorflow initializes in each worker.
+
+"""
+
+
+def free_ports(count):
+    """ Find count unused loopback ports """
+    sockets = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("localhost", 0))
+        sockets.append(sock)
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def local_cluster(num_workers, ports=None):
+    """
+
+    Builds a cluster specification for num_workers processes on localhost.
+
+    :param num_workers: The number of workers
+    :param ports: None to pick free ports, else a list of num_workers ports
+    :return: A dict suitable for the "cluster" entry of TF_CONFIG
+    """
+    if type(num_workers) != int or num_workers < 1:
+        raise ValueError("local_cluster - num_workers was not a positive integer")
+    if ports is None:
+        ports = free_ports(num_workers)
+    if len(ports) != num_workers:
+        raise ValueError("local_cluster - expected %s ports, got %s" % (num_workers, len(ports)))
+    return {"worker": ["localhost:%s" % port for port in ports]}
+
+
+def find_references(model):
+    """
+
+    Find every distinct reference used by a selector within model. References are not
+    tracked by keras themselves, so they are found through the selectors holding them.
+
+    :param model: A keras model, or any tf.Module
+    :return: A list of references, each appearing once, in the order first found
+    """
+    from spatial_flow.selectors import Selector
+
+    references = []
+    for layer in [model, *model.submodules]:
+        if isinstance(layer, Selector) and all(layer.reference is not item for item in references):
+            references.append(layer.reference)
+    return references
+
+
+def hot_swappable(model):
+    """ Whether every selector and reducer within model picks up reference changes without retracing """
+    return all(layer.hot_swappable for layer in [model, *model.submodules] if hasattr(layer, "hot_swappable"))
+
+
+def is_chief(strategy):
+    """ Whether this worker is the chief, whose references the others are synced to """
+    resolver = strategy.cluster_resolver
+    return resolver is None or not resolver.task_id
+
+
+def sync_references(strategy, references):
+    """
+
+    Broadcast the chief's copy of each reference to every worker. This is a collective
+    operation, and must be called by every worker with references in the same order.
+
+    Each reference is restored from the broadcast a single time, so its pointers are
+    rebuilt, and its version increased, at most once per sync.
+
+    :param strategy: The active MultiWorkerMirroredStrategy
+    :param references: A list of references
+    """
+    import tensorflow as tf
+
+    chief = is_chief(strategy)
+
+    def broadcast(packed):
+        context = tf.distribute.get_replica_context()
+        return context.all_reduce(tf.distribute.ReduceOp.SUM, packed)
+
+    for reference in references:
+
+        # Pack the relative reference, mutability, and validity into one tensor,
+        # so that only a single collective is needed per reference.
+
+        packed = tf.concat([tf.reshape(reference.relative_reference, [-1]),
+                            tf.reshape(tf.cast(reference.mutable, tf.dtypes.int32), [-1]),
+                            tf.reshape(tf.cast(reference.valid, tf.dtypes.int32), [-1])], axis=0)
+        if not chief:
+            packed = tf.zeros_like(packed)
+        packed = strategy.experimental_local_results(strategy.run(broadcast, args=(packed,)))[0]
+
+        relative_size = reference.reference_shape.num_elements()
+        mutable_size = reference.spatial_size
+        relative, mutable, valid = tf.split(packed, [relative_size, mutable_size, -1])
+        reference.restore({"relative_reference": tf.reshape(relative, reference.reference_shape),
+                           "mutable": tf.reshape(tf.cast(mutable, tf.dtypes.bool), reference.spatial_shape),
+                           "valid": tf.reshape(tf.cast(valid, tf.dtypes.bool), reference.valid_shape)})
+
+
+def _worker_main(task_id, cluster, threads, harness, steps, results):
+    # The body of a single worker process. Configure the environment
+    # first, as tensorflow reads it on initialization.
+
+    os.environ["TF_CONFIG"] = json.dumps({"cluster": cluster, "task": {"type": "worker", "index": task_id}})
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+    try:
+        results.put(harness.train(steps, task_id))
+    except Exception as err:
+        results.put({"task_id": task_id, "error": "%s: %s" % (type(err).__name__, err)})
+
+
+class Training_Harness():
+    """
+
+    The training harness.
+
+    The harness is initialized with functions which build the model, optimizer, loss,
+    and dataset. These are called inside each worker, within the strategy scope, and so
+    must be picklable; top level functions are suitable. When "run" is called, one process
+    per worker is launched, each trains for the requested number of steps, and the per worker
+    results are returned.
+
+    If a mutation function is provided, it is called with the model every "mutate_every" steps,
+    on the chief only, after which the references are synchronized from the chief. The compiled
+    step is kept if every selector and reducer in the model is hot swappable, and is otherwise
+    rebuilt after each mutation, as it captured structures derived from the old references.
+    """
+    @property
+    def num_workers(self):
+        return self._num_workers
+    @property
+    def threads_per_worker(self):
+        return self._threads_per_worker
+    def __init__(self,
+                 model_fn,
+                 optimizer_fn,
+                 loss_fn,
+                 dataset_fn,
+                 num_workers=1,
+                 threads_per_worker=1,
+                 mutate_fn=None,
+                 mutate_every=0,
+                 timeout=600):
+        """
+
+        :param model_fn: Function with no arguments returning a keras model.
+        :param optimizer_fn: Function with no arguments returning a keras optimizer.
+        :param loss_fn: Function accepting (targets, predictions) and returning per example losses.
+        :param dataset_fn: Function accepting a tf.distribute.InputContext and returning a dataset of
+            (inputs, targets) batches, already sized for a single replica. It should repeat forever.
+        :param num_workers: The number of worker processes.
+        :param threads_per_worker: The number of intra and inter op threads each worker may use.
+        :param mutate_fn: None, or a function accepting the model, which mutates its references. Only called on the chief.
+        :param mutate_every: How many steps between mutations.
+        :param timeout: Seconds to wait for all workers to finish.
+        """
+        for name, item in (("model_fn", model_fn), ("optimizer_fn", optimizer_fn),
+                           ("loss_fn", loss_fn), ("dataset_fn", dataset_fn)):
+            if not callable(item):
+                raise TypeError("Training_Harness - %s was not callable" % name)
+        if mutate_fn is not None and not callable(mutate_fn):
+            raise TypeError("Training_Harness - mutate_fn was not callable")
+        if type(num_workers) != int or num_workers < 1:
+            raise ValueError("Training_Harness - num_workers was not a positive integer")
+        if type(threads_per_worker) != int or threads_per_worker < 1:
+            raise ValueError("Training_Harness - threads_per_worker was not a positive integer")
+
+        self._model_fn = model_fn
+        self._optimizer_fn = optimizer_fn
+        self._loss_fn = loss_fn
+        self._dataset_fn = dataset_fn
+        self._num_workers = num_workers
+        self._threads_per_worker = threads_per_worker
+        self._mutate_fn = mutate_fn
+        self._mutate_every = mutate_every
+        self._timeout = timeout
+
+    def train(self, steps, task_id=0):
+        """
+
+        Train within the current process, which must already be configured as a worker.
+        This is what each launched process runs, and is exposed for custom launchers.
+
+        :param steps: How many steps to train for
+        :param task_id: The index of this worker
+        :return: A dict of results for this worker
+        """
+        import tensorflow as tf
+
+        strategy = tf.distribute.MultiWorkerMirroredStrategy()
+        with strategy.scope():
+            model = self._model_fn()
+            optimizer = self._optimizer_fn()
+        references = find_references(model)
+        swappable = hot_swappable(model)
+        chief = is_chief(strategy)
+        sync_references(strategy, references)
+
+        dataset = strategy.distribute_datasets_from_function(self._dataset_fn)
+        iterator = iter(dataset)
+        global_batch = None
+
+        def replica_step(inputs, targets):
+            with tf.GradientTape() as tape:
+                predictions = model(inputs, training=True)
+                losses = self._loss_fn(targets, predictions)
+                loss = tf.nn.compute_average_loss(losses)
+            gradients = tape.gradient(loss, model.trainable_variables)
+            optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+            return loss, tf.shape(inputs)[0]
+
+        def build_step():
+            @tf.function
+            def step(inputs, targets):
+                loss, size = strategy.run(replica_step, args=(inputs, targets))
+                return (strategy.reduce(tf.distribute.ReduceOp.SUM, loss, axis=None),
+                        strategy.reduce(tf.distribute.ReduceOp.SUM, size, axis=None))
+            return step
+
+        step = build_step()
+
+        # Warm up, so that tracing is excluded from timing
+        inputs, targets = next(iterator)
+        loss, global_batch = step(inputs, targets)
+
+        mutations = 0
+        start = time.perf_counter()
+        for index in range(steps):
+            inputs, targets = next(iterator)
+            loss, _ = step(inputs, targets)
+            if self._mutate_fn is not None and self._mutate_every and (index + 1) % self._mutate_every == 0:
+                # Only the chief mutates. The sync broadcasts its result to everyone else.
+                if chief:
+                    self._mutate_fn(model)
+                sync_references(strategy, references)
+                if not swappable:
+                    step = build_step()
+                mutations += 1
+        seconds = time.perf_counter() - start
+
+        # A cheap fingerprint of every reference, so consistency across workers can be checked
+        checksum = sum(int(tf.reduce_sum(tf.cast(tf.reshape(reference.linear_reference, [-1]), tf.dtypes.int64) *
+                                         tf.range(1, reference.valid_shape.num_elements() + 1, dtype=tf.dtypes.int64)))
+                       for reference in references)
+
+        return {"task_id": task_id,
+                "steps": steps,
+                "seconds": seconds,
+                "global_batch": int(global_batch),
+                "examples_per_second": steps * int(global_batch) / seconds,
+                "final_loss": float(loss),
+                "mutations": mutations,
+                "reference_checksum": checksum}
+
+    def run(self, steps):
+        """
+
+        Launch one process per worker, train, and collect the results.
+
+        :param steps: How many steps each worker should train for
+        :return: A list of per worker result dicts, ordered by task id
+        """
+        if type(steps) != int or steps < 1:
+            raise ValueError("Training_Harness - steps was not a positive integer")
+
+        cluster = local_cluster(self._num_workers)
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        processes = [context.Process(target=_worker_main,
+                                     args=(task_id, cluster, self._threads_per_worker, self, steps, results))
+                     for task_id in range(self._num_workers)]
+        for process in processes:
+            process.start()
+        try:
+            outputs = [results.get(timeout=self._timeout) for _ in processes]
+        finally:
+            for process in processes:
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.terminate()
+
+        errors = [output for output in outputs if "error" in output]
+        if errors:
+            raise RuntimeError("Training_Harness - worker %s failed: %s" % (errors[0]["task_id"], errors[0]["error"]))
+        return sorted(outputs, key=lambda output: output["task_id"])
@@ -0,0 +1,594 @@
+import os
+import time
+import pickle
+import hashlib
+import collections
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import tensorflow as tf
+from spatial_flow.reference import Reference
+from spatial_flow.numpy_reference import Numpy_Reference
+
+"""
+
+This section pertains to evolutionary search over references.
+
+In a genetic search, many candidate references turn out identical to one already
+seen: two mutations cancel, a mutation is rejected, or an elite is carried over
+unchanged. Evaluating the fitness of a topology is by far the most expensive part
+of a generation, so evaluations are memoized.
+
+A Fitness_Cache maps a reference's content hash, together with a fingerprint of
+the dataset it was evaluated on, to the resulting fitness. Content hashes depend only
+on the current pointers, validity and mutability, not on how they were reached, so a
+reference which reverts to an earlier state is found in the cache. The cache is
+bounded, evicting the least recently used entry, and may be saved to and loaded
+from disk so that memoized evaluations survive a restart.
+
+"""
+
+#Distinguishes a cache miss from a memoized fitness of None
+_MISSING = object()
+
+
+def fingerprint(data):
+    """
+
+    A short fingerprint of a dataset, for use as part of a cache key.
+
+    :param data: A string, bytes, array, tensor, or a list, tuple, or dict of these. Strings
+        are taken to already identify the dataset, such as a path or name with a version.
+    :return: A hex string
+    """
+    digest = hashlib.blake2b(digest_size=16)
+
+    def visit(item):
+        if isinstance(item, str):
+            digest.update(b"s" + item.encode("utf-8"))
+        elif isinstance(item, (bytes, bytearray, memoryview)):
+            digest.update(b"b" + bytes(item))
+        elif isinstance(item, dict):
+            digest.update(b"d%d" % len(item))
+            for key in sorted(item, key=str):
+                visit(str(key))
+                visit(item[key])
+        elif isinstance(item, (list, tuple)):
+            digest.update(b"l%d" % len(item))
+            for entry in item:
+                visit(entry)
+        else:
+            array = np.ascontiguousarray(item.numpy() if hasattr(item, "numpy") else np.asarray(item))
+            digest.update(("a%s%s" % (array.dtype.str, array.shape)).encode("utf-8"))
+            digest.update(array.tobytes())
+
+    visit(data)
+    return digest.hexdigest()
+
+
+class Fitness_Cache():
+    """
+
+    A least recently used memo of fitness evaluations, keyed by reference content
+    hash and dataset fingerprint.
+
+    :property hits: How many lookups were found
+    :property misses: How many lookups were not found
+    :property evictions: How many entries were evicted to stay within capacity
+    """
+    @property
+    def capacity(self):
+        return self._capacity
+    @property
+    def path(self):
+        return self._path
+    @property
+    def hits(self):
+        return self._hits
+    @property
+    def misses(self):
+        return self._misses
+    @property
+    def evictions(self):
+        return self._evictions
+    def __init__(self, capacity=4096, path=None):
+        """
+
+        :param capacity: The largest number of entries kept
+        :param path: None, or a file to persist the cache to. If it exists, it is loaded.
+        """
+        if type(capacity) != int or capacity < 1:
+            raise ValueError("Fitness_Cache - capacity was not a positive integer")
+        self._capacity = capacity
+        self._path = path
+        self._entries = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @staticmethod
+    def key(reference, dataset):
+        """
+
+        :param reference: A Reference, or its content hash
+        :param dataset: A dataset fingerprint
+        :return: The cache key
+        """
+        if isinstance(reference, Reference):
+            reference = reference.content_hash
+        return (int(reference), dataset)
+
+    def get(self, reference, dataset, default=None):
+        """ The memoized fitness of a reference on a dataset, or default if there is none """
+        key = self.key(reference, dataset)
+        if key not in self._entries:
+            self._misses += 1
+            return default
+        self._hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, reference, dataset, fitness):
+        """ Memoize the fitness of a reference on a dataset """
+        key = self.key(reference, dataset)
+        self._entries[key] = fitness
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def evaluate(self, reference, dataset, evaluate):
+        """
+
+        The fitness of a reference on a dataset, evaluated only if not already memoized.
+
+        :param reference: A Reference
+        :param dataset: A dataset fingerprint
+        :param evaluate: A callable accepting the reference and returning its fitness
+        :return: The fitness
+        """
+        key = self.key(reference, dataset)
+        fitness = self.get(*key, default=_MISSING)
+        if fitness is _MISSING:
+            fitness = evaluate(reference)
+            self.put(*key, fitness)
+        return fitness
+
+    def clear(self):
+        self._entries.clear()
+
+    def save(self, path=None):
+        """
+
+        Write the cache to disk. The file is replaced atomically, so a crash while
+        saving leaves the previous file intact.
+
+        :param path: The file to write. Defaults to the path given at construction.
+        """
+        path = self._path if path is None else path
+        if path is None:
+            raise ValueError("Fitness_Cache - no path to save to")
+        temporary = "%s.tmp" % path
+        with open(temporary, "wb") as file:
+            pickle.dump({"capacity": self._capacity, "entries": list(self._entries.items())}, file)
+        os.replace(temporary, path)
+
+    def load(self, path):
+        """
+
+        Merge entries saved by save into the cache. Loaded entries are treated as less
+        recently used than those already present. Only load files from trusted sources,
+        as they are unpickled.
+
+        :param path: The file to read
+        """
+        with open(path, "rb") as file:
+            saved = pickle.load(file)
+        present = list(self._entries.items())
+        self._entries.clear()
+        for key, fitness in saved["entries"] + present:
+            self.put(*key, fitness)
+
+
+"""
+
+The evolution engine.
+
+An Evolution keeps a population of references as stacked arrays of their relative
+references, mutability, and validity, and each generation:
+
+    select - Parents are chosen by tournament. The fittest individuals, the elites, are
+        carried over unchanged.
+    mutate - Children are copied from their parents and mutated. A Point_Mutation mutates
+        every child at once in a single vectorized operation. Any other callable accepting
+        a reference, such as a Reference_Op, is applied to each child in turn.
+    evaluate - Each distinct child is evaluated once. Children already seen, by content hash,
+        are taken from the fitness cache, if there is one. The rest are spread over a pool of
+        worker processes.
+
+The fitness function receives a Reference and returns a number, higher being fitter unless
+maximize is false. When workers are used it runs in another process, so must be picklable,
+such as a top level function or a functools.partial of one. Each worker builds its own
+references, and so imports tensorflow once when it starts.
+
+The whole state of a search, including the random generator, may be checkpointed and later
+resumed from, and timings are recorded for every generation.
+
+"""
+
+
+class Point_Mutation():
+    """
+
+    Mutates a whole batch of references at once. Each pointer at a mutable location is
+    independently redirected, with probability rate, to a random offset within radius of its
+    location. Pointers may also be pruned or restored.
+    """
+    def __init__(self, rate=0.01, radius=1, prune_rate=0.0, restore_rate=0.0):
+        """
+
+        :param rate: The probability each mutable pointer is redirected
+        :param radius: The largest offset, along any dimension, of a redirected pointer
+        :param prune_rate: The probability each valid mutable pointer is pruned
+        :param restore_rate: The probability each pruned mutable pointer is made valid again
+        """
+        for value, name in ((rate, "rate"), (prune_rate, "prune_rate"), (restore_rate, "restore_rate")):
+            if not 0.0 <= value <= 1.0:
+                raise ValueError("Point_Mutation - %s was not a probability" % name)
+        if type(radius) != int or radius < 0:
+            raise ValueError("Point_Mutation - radius was not a non-negative integer")
+        self._rate = rate
+        self._radius = radius
+        self._prune_rate = prune_rate
+        self._restore_rate = restore_rate
+
+    def __call__(self, relative, mutable, valid, rng):
+        """
+
+        :param relative: The relative references, [batch, spatial..., comparison..., rank]
+        :param mutable: The mutability, [batch, spatial...]
+        :param valid: The validity, [batch, spatial..., comparison...]
+        :param rng: A numpy Generator
+        :return: The mutated relative references and validity
+        """
+        comparison_rank = (valid.ndim - 1) // 2
+        mutable = np.expand_dims(mutable, tuple(range(-comparison_rank, 0)))
+
+        redirect = (rng.random(valid.shape) < self._rate) & mutable
+        offsets = rng.integers(-self._radius, self._radius + 1, size=relative.shape, dtype=relative.dtype)
+        relative = np.where(redirect[..., None], offsets, relative)
+
+        if self._prune_rate > 0 or self._restore_rate > 0:
+            flip = np.where(valid, rng.random(valid.shape) < self._prune_rate,
+                            rng.random(valid.shape) < self._restore_rate)
+            valid = valid ^ (flip & mutable)
+        return relative, valid
+
+
+def _snapshot(relative, mutable, valid):
+    # A snapshot of a reference, from arrays
+    return {"relative_reference": tf.constant(relative),
+            "mutable": tf.constant(mutable),
+            "valid": tf.constant(valid)}
+
+
+_worker_references = {}
+
+
+def _evaluate(fitness, config, relative, mutable, valid):
+    # The body of an evaluation in a worker process. References are reused
+    # between evaluations of the same shape.
+
+    if config not in _worker_references:
+        spatial_shape, comparison_shape, ordering = config
+        _worker_references[config] = Reference(list(spatial_shape), list(comparison_shape), ordering=ordering)
+    reference = _worker_references[config]
+    reference.restore(_snapshot(relative, mutable, valid))
+    return fitness(reference)
+
+
+class Evolution():
+    """
+
+    A genetic search over references.
+
+    :property generation: How many generations have run. The initial population is generation 0.
+    :property fitness: The fitness of each member of the current population
+    :property history: A list with a record of every generation, holding its best and mean fitness,
+        the number of evaluations made and saved, and the seconds spent selecting, mutating,
+        evaluating, and in total
+    """
+    @property
+    def generation(self):
+        return self._generation
+    @property
+    def fitness(self):
+        self.__initialize()
+        return self._fitness
+    @property
+    def history(self):
+        self.__initialize()
+        return self._history
+    @property
+    def size(self):
+        return self._size
+    @property
+    def cache(self):
+        return self._cache
+    def __init__(self,
+                 reference,
+                 mutation,
+                 fitness,
+                 size=32,
+                 elites=2,
+                 tournament=3,
+                 maximize=True,
+                 workers=0,
+                 cache=None,
+                 dataset=None,
+                 seed=None):
+        """
+
+        :param reference: The Reference the search starts from. It is not modified.
+        :param mutation: A Point_Mutation, or a callable accepting a reference and mutating it in place
+        :param fitness: A callable accepting a reference and returning its fitness
+        :param size: The number of individuals in the population
+        :param elites: How many of the fittest individuals survive each generation unchanged
+        :param tournament: The number of individuals competing to be each parent
+        :param maximize: Whether higher fitness is better
+        :param workers: The number of worker processes evaluating fitness. Zero evaluates in this process.
+        :param cache: None, or a Fitness_Cache
+        :param dataset: The fingerprint of the dataset fitness is evaluated on, for the cache
+        :param seed: The seed of the random generator
+        """
+        if not isinstance(reference, Reference):
+            raise TypeError("Evolution - reference was not of type 'Reference'")
+        if not callable(mutation) or not callable(fitness):
+            raise TypeError("Evolution - mutation and fitness must be callable")
+        if type(size) != int or size < 1:
+            raise ValueError("Evolution - size was not a positive integer")
+        if type(elites) != int or not 0 <= elites < size:
+            raise ValueError("Evolution - elites must be an integer in [0, size)")
+        if type(tournament) != int or tournament < 1:
+            raise ValueError("Evolution - tournament was not a positive integer")
+        if type(workers) != int or workers < 0:
+            raise ValueError("Evolution - workers was not a non-negative integer")
+        if cache is not None and not isinstance(cache, Fitness_Cache):
+            raise TypeError("Evolution - cache was not of type 'Fitness_Cache'")
+
+        self._mutation = mutation
+        self._fitness_fn = fitness
+        self._size = size
+        self._elites = elites
+        self._tournament = tournament
+        self._maximize = maximize
+        self._workers = workers
+        self._cache = cache
+        self._dataset = dataset
+        self._rng = np.random.default_rng(seed)
+        self._pool = None
+        self._config = (tuple(reference.spatial_shape.as_list()), tuple(reference.comparison_shape.as_list()),
+                        reference.ordering)
+        self._scratch = reference.copy()
+
+        # The initial population is the starting reference and mutations of it
+        snapshot = {key: value.numpy() for key, value in reference.snapshot().items()}
+        relative = np.repeat(snapshot["relative_reference"][None], size, axis=0)
+        mutable = np.repeat(snapshot["mutable"][None], size, axis=0)
+        valid = np.repeat(snapshot["valid"][None], size, axis=0)
+        relative[1:], mutable[1:], valid[1:] = self.__mutate(relative[1:], mutable[1:], valid[1:])
+        self._relative, self._mutable, self._valid = relative, mutable, valid
+
+        # The initial population is evaluated when first needed, so that
+        # resuming from a checkpoint never evaluates it
+        self._generation = 0
+        self._history = []
+        self._fitness = None
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """ Shut down the worker processes, if any """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def individual(self, index):
+        """ The reference of a member of the current population """
+        reference = self._scratch.copy()
+        reference.restore(_snapshot(self._relative[index], self._mutable[index], self._valid[index]))
+        return reference
+
+    @property
+    def best(self):
+        """ The reference of the fittest member of the current population """
+        self.__initialize()
+        return self.individual(int(self.__ranking()[0]))
+
+    def __initialize(self):
+        # Evaluate the initial population, if it has not been already
+        if self._fitness is None:
+            start = time.perf_counter()
+            self._fitness, evaluations = self.__evaluate(self._relative, self._mutable, self._valid)
+            self.__record(0.0, 0.0, time.perf_counter() - start, evaluations, start)
+
+    def __ranking(self):
+        # Indices of the population, fittest first
+        order = np.argsort(self._fitness, kind="stable")
+        return order[::-1] if self._maximize else order
+
+    def __select(self, count):
+        # Choose parents by tournament
+        if count == 0:
+            return np.zeros([0], dtype=np.int64)
+        candidates = self._rng.integers(0, self._size, size=[count, self._tournament])
+        scores = self._fitness[candidates]
+        winners = np.argmax(scores, axis=1) if self._maximize else np.argmin(scores, axis=1)
+        return candidates[np.arange(count), winners]
+
+    def __mutate(self, relative, mutable, valid):
+        # Mutate a batch of children. A Point_Mutation handles the batch in one go.
+        if isinstance(self._mutation, Point_Mutation):
+            relative, valid = self._mutation(relative, mutable, valid, self._rng)
+            return relative, mutable, valid
+        relative, mutable, valid = relative.copy(), mutable.copy(), valid.copy()
+        for index in range(len(relative)):
+            self._scratch.restore(_snapshot(relative[index], mutable[index], valid[index]))
+            self._mutation(self._scratch)
+            relative[index] = self._scratch.relative_reference.numpy()
+            mutable[index] = self._scratch.mutable.numpy()
+            valid[index] = self._scratch.valid.numpy()
+        return relative, mutable, valid
+
+    def __evaluate(self, relative, mutable, valid):
+        # Evaluate each distinct individual once, skipping any already cached.
+        # Repeats within the generation are not looked up again, so every miss
+        # is an evaluation, as with Fitness_Cache.evaluate
+
+        fitness = np.zeros([len(relative)], dtype=np.float64)
+        pending = collections.OrderedDict()
+        for index in range(len(relative)):
+            key = Numpy_Reference.content_hash_of(relative[index], mutable[index], valid[index])
+            if key in pending:
+                pending[key].append(index)
+                continue
+            cached = _MISSING if self._cache is None else self._cache.get(key, self._dataset, default=_MISSING)
+            if cached is _MISSING:
+                pending[key] = [index]
+            else:
+                fitness[index] = cached
+
+        arguments = [(self._fitness_fn, self._config, relative[indices[0]], mutable[indices[0]], valid[indices[0]])
+                     for indices in pending.values()]
+        if self._workers == 0:
+            results = [_evaluate(*item) for item in arguments]
+        else:
+            if self._pool is None:
+                context = multiprocessing.get_context("spawn")
+                self._pool = concurrent.futures.ProcessPoolExecutor(self._workers, mp_context=context)
+            results = [future.result() for future in [self._pool.submit(_evaluate, *item) for item in arguments]]
+
+        for (key, indices), result in zip(pending.items(), results):
+            fitness[indices] = result
+            if self._cache is not None:
+                self._cache.put(key, self._dataset, result)
+        return fitness, len(arguments)
+
+    def __record(self, select_time, mutate_time, evaluate_time, evaluations, start):
+        self._history.append({"generation": self._generation,
+                              "best": float(self._fitness[self.__ranking()[0]]),
+                              "mean": float(np.mean(self._fitness)),
+                              "evaluations": evaluations,
+                              "saved": self._size - evaluations if self._generation == 0 else
+                              self._size - self._elites - evaluations,
+                              "select_time": select_time,
+                              "mutate_time": mutate_time,
+                              "evaluate_time": evaluate_time,
+                              "time": time.perf_counter() - start})
+        return self._history[-1]
+
+    def step(self):
+        """
+
+        Run a single generation.
+
+        :return: The record of the generation, as added to history
+        """
+        self.__initialize()
+        start = time.perf_counter()
+        elites = self.__ranking()[:self._elites]
+        parents = self.__select(self._size - self._elites)
+        select_time = time.perf_counter() - start
+
+        mark = time.perf_counter()
+        relative, mutable, valid = self.__mutate(self._relative[parents], self._mutable[parents], self._valid[parents])
+        mutate_time = time.perf_counter() - mark
+
+        mark = time.perf_counter()
+        fitness, evaluations = self.__evaluate(relative, mutable, valid)
+        evaluate_time = time.perf_counter() - mark
+
+        self._relative = np.concatenate([self._relative[elites], relative])
+        self._mutable = np.concatenate([self._mutable[elites], mutable])
+        self._valid = np.concatenate([self._valid[elites], valid])
+        self._fitness = np.concatenate([self._fitness[elites], fitness])
+        self._generation += 1
+        return self.__record(select_time, mutate_time, evaluate_time, evaluations, start)
+
+    def run(self, generations, checkpoint=None, checkpoint_every=1, callback=None):
+        """
+
+        Run until the given generation is reached. As the count is absolute, calling run
+        again after loading a checkpoint continues where the search left off.
+
+        :param generations: The generation to stop at
+        :param checkpoint: None, or a file to checkpoint to
+        :param checkpoint_every: How many generations pass between checkpoints
+        :param callback: None, or a callable accepting the record of each generation. Returning
+            True stops the search early.
+        :return: The fittest reference
+        """
+        while self._generation < generations:
+            record = self.step()
+            if checkpoint is not None and (self._generation % checkpoint_every == 0 or self._generation == generations):
+                self.save(checkpoint)
+            if callback is not None and callback(record):
+                break
+        return self.best
+
+    def save(self, path):
+        """
+
+        Checkpoint the search. The file is replaced atomically. If the cache has a path
+        of its own, it is saved as well.
+
+        :param path: The file to write
+        """
+        self.__initialize()
+        state = {"config": self._config,
+                 "generation": self._generation,
+                 "relative": self._relative,
+                 "mutable": self._mutable,
+                 "valid": self._valid,
+                 "fitness": self._fitness,
+                 "history": self._history,
+                 "rng": self._rng.bit_generator.state}
+        temporary = "%s.tmp" % path
+        with open(temporary, "wb") as file:
+            pickle.dump(state, file)
+        os.replace(temporary, path)
+        if self._cache is not None and self._cache.path is not None:
+            self._cache.save()
+
+    def load(self, path):
+        """
+
+        Resume from a checkpoint made by save. The search must have been constructed
+        with a reference of the same shapes and ordering, and a population of the same size.
+        Only load files from trusted sources, as they are unpickled.
+
+        :param path: The file to read
+        """
+        with open(path, "rb") as file:
+            state = pickle.load(file)
+        if state["config"] != self._config or len(state["fitness"]) != self._size:
+            raise ValueError("Evolution - checkpoint was made by a search of a different shape or size")
+        self._generation = state["generation"]
+        self._relative = state["relative"]
+        self._mutable = state["mutable"]
+        self._valid = state["valid"]
+        self._fitness = state["fitness"]
+        self._history = state["history"]
+        self._rng.bit_generator.state = state["rng"]
+        return self
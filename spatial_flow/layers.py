@@ -1,6 +1,7 @@
 import tensorflow as tf
 import tensorflow.keras as keras
 import spatial_flow.core as core
+from spatial_flow.utils.instrumentation import instrument
 
 class ND_Layer(keras.layers.Layer):
     """"
@@ -134,6 +135,7 @@ class Dense(ND_Layer):
         #take tensordot
 
         return tf.tensordot(input, self._kernel, axes=[input_indices, kernel_indices])
+    @instrument("Dense.call")
     def call(self, input):
 
         multiply = self.tensordot(input)
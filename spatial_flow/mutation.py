@@ -0,0 +1,141 @@
+import threading
+from spatial_flow.reference import Reference
+
+"""
+
+This section pertains to mutating references without stalling training.
+
+Running a mutation through Reference.update takes time, and when done between
+training steps the whole of it is added to the step. An Async_Mutator instead
+double buffers the reference. A private copy, the back buffer, is mutated by a
+background thread while training keeps reading the live reference. At the next step
+boundary, "swap" moves the finished result into the live reference in a single
+restore, and the next mutation is started.
+
+Swapping assigns the new pointers into the variables of the live reference, so
+hot swappable compiled selectors, reducers, and units pick them up without retracing.
+Anything caching structures derived from the pointers rebuilds as usual, as the version
+of the live reference changes.
+
+If the live reference is changed by something else while a mutation is in flight, the
+mutation was computed from stale pointers. It is then discarded rather than swapped in,
+and restarted from the current state.
+
+"""
+
+
+class Async_Mutator():
+    """
+
+    Applies a mutation to a reference in a background thread.
+
+    The mutation is any callable accepting a reference and mutating it in place,
+    such as a Reference_Op. Call "swap" at step boundaries.
+
+    :property swaps: How many mutations have been swapped in
+    :property discarded: How many mutations were discarded as stale
+    """
+    @property
+    def reference(self):
+        return self._reference
+    @property
+    def swaps(self):
+        return self._swaps
+    @property
+    def discarded(self):
+        return self._discarded
+    @property
+    def ready(self):
+        """ Whether a finished mutation is waiting to be swapped in """
+        return self._done.is_set()
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+    def __init__(self, reference, mutation, continuous=True):
+        """
+
+        :param reference: The live reference
+        :param mutation: A callable accepting a reference, which mutates it
+        :param continuous: If true, a new mutation begins as soon as the last is swapped in
+        """
+        if not isinstance(reference, Reference):
+            raise TypeError("Async_Mutator - reference was not of type 'Reference'")
+        if not callable(mutation):
+            raise TypeError("Async_Mutator - mutation was not callable")
+        if type(continuous) != bool:
+            raise TypeError("Async_Mutator - continuous was not bool")
+
+        self._reference = reference
+        self._mutation = mutation
+        self._continuous = continuous
+        self._back = reference.copy()
+        self._thread = None
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        self._base_version = None
+        self._swaps = 0
+        self._discarded = 0
+
+    def __work(self):
+        # The body of the background thread. Only the back buffer is touched.
+        try:
+            self._mutation(self._back)
+            self._result = self._back.snapshot()
+        except Exception as err:
+            self._error = err
+        finally:
+            self._done.set()
+
+    def start(self):
+        """ Begin computing the next mutation from the current live reference """
+        if self.running:
+            raise RuntimeError("Async_Mutator - a mutation is already running")
+        self._back.restore(self._reference.snapshot())
+        self._base_version = self._reference.version
+        self._result = None
+        self._error = None
+        self._done.clear()
+        self._thread = threading.Thread(target=self.__work, daemon=True)
+        self._thread.start()
+        return self
+
+    def swap(self, wait=False):
+        """
+
+        Swap a finished mutation into the live reference. Call at a step boundary.
+
+        :param wait: If true, block until the running mutation finishes. Else, return
+            immediately if it has not.
+        :return: True if a mutation was swapped in
+        """
+        if self._thread is None:
+            return False
+        if not wait and not self._done.is_set():
+            return False
+        self._thread.join()
+        self._thread = None
+
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Async_Mutator - mutation failed: %s" % error) from error
+
+        swapped = False
+        if self._reference.version == self._base_version:
+            self._reference.restore(self._result)
+            self._swaps += 1
+            swapped = True
+        else:
+            self._discarded += 1
+
+        if self._continuous:
+            self.start()
+        return swapped
+
+    def stop(self):
+        """ Wait for any running mutation to finish, and discard it """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._done.clear()
+        self._result = None
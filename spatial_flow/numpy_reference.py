@@ -0,0 +1,379 @@
+import numpy as np
+
+"""
+
+This section pertains to building and inspecting references with numpy alone.
+
+A Numpy_Reference holds the same state as a Reference: the relative reference, the
+per location mutability, and the per pointer validity. It derives the same absolute
+and packed pointers, but never imports tensorflow. Tools which only generate or
+analyse topologies can therefore avoid initializing tensorflow entirely.
+
+Flattened indices here are always row major. The ordering is only recorded, and is
+applied when the reference is converted, with "to_reference", into a Reference
+which selectors can consume. Only then is tensorflow imported. A Selector given a
+Numpy_Reference converts it itself.
+
+Construction and mutation are vectorized over the whole grid. Where Reference.update
+calls its callback once per mutable location, each call running many small tensorflow
+ops, Numpy_Reference.update calls its callback once, with every mutable location
+stacked. For small and medium grids, where per op dispatch dominates, topologies are
+generated far faster this way, then converted once.
+
+Conversion hands each array to tensorflow whole, which copies it into a tensor, and
+the Reference is then built once directly from those tensors, with no per location ops.
+
+The arrays returned by "relative_reference", "mutable", and "valid" are read only views,
+so that changes go through the setters, or "update", and the derived pointers stay current.
+
+"""
+
+
+def _mix(columns, seed):
+    # Fold each column into a running splitmix64 hash. Arithmetic wraps
+    # around at 64 bits.
+
+    state = np.full(columns.shape[1:], seed, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for column in columns:
+            state = state ^ column
+            state = (state ^ (state >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+            state = (state ^ (state >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+            state = state ^ (state >> np.uint64(31))
+    return state
+
+
+def hash_seed(spatial_shape, comparison_shape):
+    """ The part of a content hash which distinguishes references of different shapes """
+    shape = np.array([*spatial_shape, *comparison_shape], dtype=np.uint64)
+    return _mix(shape, np.uint64(len(shape)))
+
+
+def hash_rows(rows, relative, valid, mutable):
+    """
+
+    The hash of each of the given row major locations, as summed into a content hash.
+
+    :param rows: The row major flattened locations, shape [rows]
+    :param relative: Their relative references, shape [rows, comparison * rank]
+    :param valid: Their validity, shape [rows, comparison]
+    :param mutable: Their mutability, shape [rows]
+    :return: A uint64 array of shape [rows]
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    # Offsets are cast through int64 so negatives wrap consistently
+    columns = np.concatenate([np.asarray(relative, dtype=np.int64).reshape(len(rows), -1),
+                              np.asarray(valid, dtype=np.int64).reshape(len(rows), -1),
+                              np.asarray(mutable, dtype=np.int64).reshape(len(rows), 1),
+                              rows[:, None]], axis=1)
+    columns = np.ascontiguousarray(columns.T).view(np.uint64)
+    return _mix(columns, np.uint64(0x9e3779b97f4a7c15))
+
+
+class Numpy_Reference():
+    """
+
+    A reference held as numpy arrays.
+
+    The properties mirror those of Reference. "relative_reference", "mutable", and
+    "valid" may be set, and everything else is derived from them on access.
+    """
+    @property
+    def spatial_shape(self):
+        return self._spatial_shape
+    @property
+    def comparison_shape(self):
+        return self._comparison_shape
+    @property
+    def reference_shape(self):
+        return (*self._spatial_shape, *self._comparison_shape, len(self._spatial_shape))
+    @property
+    def valid_shape(self):
+        return (*self._spatial_shape, *self._comparison_shape)
+    @property
+    def spatial_size(self):
+        return int(np.prod(self._spatial_shape))
+    @property
+    def comparison_size(self):
+        return int(np.prod(self._comparison_shape))
+    @property
+    def ordering(self):
+        return self._ordering
+
+    @property
+    def identity(self):
+        """ The coordinates of every spatial location. Shape [spatial..., rank] """
+        if self._identity is None:
+            mesh = np.meshgrid(*[np.arange(size, dtype=np.int32) for size in self._spatial_shape], indexing="ij")
+            self._identity = np.stack(mesh, -1)
+        return self._identity
+
+    @staticmethod
+    def __read_only(array):
+        view = array.view()
+        view.flags.writeable = False
+        return view
+
+    @property
+    def relative_reference(self):
+        return self.__read_only(self._relative_reference)
+    @relative_reference.setter
+    def relative_reference(self, value):
+        value = np.asarray(value)
+        if value.shape != self.reference_shape:
+            raise ValueError("Expected 'reference' to be of shape %s but was instead %s" % (self.reference_shape, value.shape))
+        if not np.issubdtype(value.dtype, np.integer):
+            raise TypeError("Expected 'reference' to be int array. Instead found %s" % value.dtype)
+        self._relative_reference = value.astype(np.int32)
+        self._reference = None
+
+    @property
+    def mutable(self):
+        return self.__read_only(self._mutable)
+    @mutable.setter
+    def mutable(self, value):
+        """ Either a bool array, or as for Reference an int array where 1 sets, -1 clears, and 0 keeps """
+        value = np.asarray(value)
+        if value.shape != self._spatial_shape:
+            raise ValueError("Expected mutable to be shape of spatial dimensions")
+        if value.dtype == bool:
+            self._mutable = value.copy()
+        elif np.issubdtype(value.dtype, np.integer):
+            if value.min(initial=0) < -1 or value.max(initial=0) > 1:
+                raise ValueError("Expected mutable to be between negative 1 and 1")
+            self._mutable = np.where(value == 0, self._mutable, value == 1)
+        else:
+            raise TypeError("Expected mutable to be bool or int")
+
+    @property
+    def valid(self):
+        return self.__read_only(self._valid)
+    @valid.setter
+    def valid(self, value):
+        value = np.asarray(value)
+        if value.shape != self.valid_shape:
+            raise ValueError("Expected valid to be shape of spatial and comparison dimensions")
+        if value.dtype != bool:
+            raise TypeError("Expected valid to be bool")
+        self._valid = value.copy()
+
+    @property
+    def reference(self):
+        """ The absolute reference, wrapped around the grid """
+        if self._reference is None:
+            comparison = (1,) * len(self._comparison_shape)
+            identity = self.identity.reshape(*self._spatial_shape, *comparison, len(self._spatial_shape))
+            self._reference = np.mod(identity + self._relative_reference, np.array(self._spatial_shape, dtype=np.int32))
+        return self._reference
+
+    @property
+    def linear_reference(self):
+        """ The absolute reference with each pointer flattened, row major, into a single spatial index """
+        return np.ravel_multi_index(np.moveaxis(self.reference, -1, 0), self._spatial_shape).astype(np.int32)
+
+    @property
+    def num_valid(self):
+        return int(np.count_nonzero(self._valid))
+
+    @property
+    def packed_positions(self):
+        """ The position of each valid pointer in the row major flattened spatial-comparison grid """
+        return np.flatnonzero(self._valid).astype(np.int32)
+
+    @property
+    def packed_sources(self):
+        """ The row major flattened spatial location each valid pointer reads from """
+        return self.linear_reference.reshape(-1)[self.packed_positions]
+
+    @property
+    def packed_segments(self):
+        """ The row major flattened spatial location each valid pointer belongs to """
+        return self.packed_positions // self.comparison_size
+
+    @property
+    def fan_in(self):
+        """ The number of valid pointers each location holds, in spatial shape """
+        return np.count_nonzero(self._valid.reshape(*self._spatial_shape, -1), axis=-1)
+
+    @property
+    def fan_out(self):
+        """ The number of valid pointers reading from each location, in spatial shape """
+        return np.bincount(self.packed_sources, minlength=self.spatial_size).reshape(self._spatial_shape)
+
+    @property
+    def content_hash(self):
+        """ The content hash, equal to that of a Reference holding the same state """
+        return self.content_hash_of(self._relative_reference, self._mutable, self._valid)
+
+    @staticmethod
+    def content_hash_of(relative, mutable, valid):
+        """
+
+        The content hash of a reference held as arrays, computed directly from them, without
+        building a reference. Equal to Reference.content_hash for the same state.
+
+        :param relative: The relative reference, shape [spatial..., comparison..., rank]
+        :param mutable: The mutability, shape [spatial...]
+        :param valid: The validity, shape [spatial..., comparison...]
+        :return: The hash, as an int
+        """
+        relative = np.asarray(relative)
+        rank = relative.shape[-1]
+        spatial_shape = relative.shape[:rank]
+        size = int(np.prod(spatial_shape))
+        hashes = hash_rows(np.arange(size), relative.reshape(size, -1), np.asarray(valid).reshape(size, -1),
+                           np.asarray(mutable).reshape(size))
+        with np.errstate(over="ignore"):
+            return int(hash_seed(spatial_shape, relative.shape[rank:-1]) + np.sum(hashes, dtype=np.uint64))
+
+    def __init__(self, spatial_shape, comparison_shape, ordering="row_major"):
+        """
+
+        :param spatial_shape: A 1D list, with the size of each spatial dimension
+        :param comparison_shape: A 1D list, with the number of pointers along each comparison dimension
+        :param ordering: The ordering of the Reference this converts into
+        """
+        for value, name in ((spatial_shape, "spatial_shape"), (comparison_shape, "comparison_shape")):
+            if any(int(item) != item or item < 1 for item in value):
+                raise ValueError("All of %s expected to be integers greater then or equal to one, was not" % name)
+        if len(spatial_shape) != len(comparison_shape):
+            raise ValueError("comparison_shape and spatial_shape must have same rank")
+
+        self._spatial_shape = tuple(int(item) for item in spatial_shape)
+        self._comparison_shape = tuple(int(item) for item in comparison_shape)
+        self._ordering = ordering
+        self._identity = None
+        self._reference = None
+        self._relative_reference = np.zeros(self.reference_shape, dtype=np.int32)
+        self._mutable = np.ones(self._spatial_shape, dtype=bool)
+        self._valid = np.ones(self.valid_shape, dtype=bool)
+
+    def update(self, callback):
+        """
+
+        The vectorized counterpart of Reference.update. The callback is called a single time,
+        with every mutable location at once.
+
+        The callback must accept the relative references of the mutable locations, shape
+        [mutable, comparison..., rank], their spatial indices, shape [mutable, rank], and their
+        validity, shape [mutable, comparison...]. It must return a dict with entries "reference",
+        holding the new relative references, and "mutable", holding whether each location remains
+        mutable. It may optionally hold "valid", the new validity. Each entry may also be anything
+        broadcastable to its shape, such as a single comparison reference shared by every location.
+
+        :param callback: A function as described above
+        :return: The reference
+        """
+        if not callable(callback):
+            raise TypeError("Numpy_Reference - update: callback was not a function")
+
+        selected = self._mutable
+        count = int(np.count_nonzero(selected))
+        relative = self._relative_reference[selected]
+        valid = self._valid[selected]
+        try:
+            output = callback(relative, self.identity[selected], valid)
+        except Exception as err:
+            raise ValueError("Error in user callback function - %s" % err) from err
+        if not isinstance(output, dict):
+            raise TypeError("Error in user callback - output was not dict")
+        if "reference" not in output or "mutable" not in output:
+            raise ValueError("Error in user callback - did not return dict with 'reference' and 'mutable' keys")
+
+        try:
+            references = np.broadcast_to(output["reference"], relative.shape)
+            mutables = np.broadcast_to(output["mutable"], [count])
+            valids = valid if output.get("valid") is None else np.broadcast_to(output["valid"], valid.shape)
+        except ValueError as err:
+            raise ValueError("Error in user callback function. Return could not be broadcast - %s" % err) from err
+        if not np.issubdtype(references.dtype, np.integer):
+            raise TypeError("Error in user callback function. Reference was not int")
+        if mutables.dtype != bool or valids.dtype != bool:
+            raise TypeError("Error in user callback function, mutable or valid not bool")
+
+        self._relative_reference[selected] = references
+        self._valid[selected] = valids
+        self._mutable[selected] = mutables
+        self._reference = None
+        return self
+
+    def snapshot(self):
+        """ Captures the complete mutable state, as a dict of numpy arrays, in the form Reference.snapshot uses """
+        return {"relative_reference": self._relative_reference.copy(),
+                "mutable": self._mutable.copy(),
+                "valid": self._valid.copy()}
+
+    def restore(self, snapshot):
+        """ Replaces the state with that of a snapshot, from either a Reference or a Numpy_Reference """
+        arrays = {key: value.numpy() if hasattr(value, "numpy") else np.asarray(value) for key, value in snapshot.items()}
+        self.relative_reference = arrays["relative_reference"]
+        self.mutable = arrays["mutable"].astype(bool)
+        self.valid = arrays["valid"]
+
+    def copy(self):
+        duplicate = Numpy_Reference(self._spatial_shape, self._comparison_shape, ordering=self._ordering)
+        duplicate.restore(self.snapshot())
+        return duplicate
+
+    @classmethod
+    def from_reference(cls, reference):
+        """ A Numpy_Reference holding the state of a Reference """
+        duplicate = cls(reference.spatial_shape.as_list(), reference.comparison_shape.as_list(), ordering=reference.ordering)
+        duplicate.restore(reference.snapshot())
+        return duplicate
+
+    def to_reference(self):
+        """ A Reference holding this state, which selectors may consume. Imports tensorflow. """
+        import tensorflow as tf
+        from spatial_flow.reference import Reference
+
+        snapshot = {"relative_reference": tf.convert_to_tensor(self._relative_reference),
+                    "mutable": tf.convert_to_tensor(self._mutable),
+                    "valid": tf.convert_to_tensor(self._valid)}
+        return Reference(list(self._spatial_shape), list(self._comparison_shape), ordering=self._ordering,
+                         snapshot=snapshot)
+
+
+def spatial_kernel(reference, kernel_delta=1, kernel_bias=0, justification="center", mutable=True):
+    """
+
+    The numpy counterpart of reference.spatial_kernel. Points every mutable location at a
+    rectangular kernel of nearby locations, one pointer per comparison entry.
+
+    :param reference: A Numpy_Reference
+    :param kernel_delta: The spacing between pointers, per dimension or shared. At least one.
+    :param kernel_bias: An offset added to the kernel before spacing, per dimension or shared
+    :param justification: "center", "left", or "right", per dimension or shared. Where the
+        kernel sits relative to the location.
+    :param mutable: Whether the locations remain mutable afterwards
+    :return: The reference
+    """
+    if not isinstance(reference, Numpy_Reference):
+        raise TypeError("spatial_kernel - reference was not of type 'Numpy_Reference'")
+    rank = len(reference.comparison_shape)
+
+    def broadcast(value, name):
+        value = np.asarray(value)
+        if value.ndim > 1 or (value.ndim == 1 and len(value) != rank):
+            raise ValueError("Expected %s to be a single value or of length %s" % (name, rank))
+        return np.broadcast_to(value, [rank])
+
+    kernel_delta = broadcast(kernel_delta, "kernel_delta")
+    kernel_bias = broadcast(kernel_bias, "kernel_bias")
+    justification = broadcast(justification, "justification")
+    if not np.issubdtype(kernel_delta.dtype, np.integer) or not np.issubdtype(kernel_bias.dtype, np.integer):
+        raise TypeError("Expected kernel_delta and kernel_bias to be int")
+    if np.any(kernel_delta < 1):
+        raise ValueError("Expected kernel_delta to be greater than or equal to 1, was not")
+
+    ranges = {"right": lambda length: np.arange(length),
+              "left": lambda length: np.arange(-length + 1, 1),
+              "center": lambda length: np.arange(-(length // 2), length - length // 2)}
+    instructions = []
+    for index, length in enumerate(reference.comparison_shape):
+        if justification[index] not in ranges:
+            raise ValueError("Expected justification to be one of right, left, center. Was %s" % justification[index])
+        instructions.append((ranges[justification[index]](length) + kernel_bias[index]) * kernel_delta[index])
+    kernel = np.stack(np.meshgrid(*instructions, indexing="ij"), -1).astype(np.int32)
+
+    return reference.update(lambda relative, spatial_index, valid: {"reference": kernel, "mutable": mutable})
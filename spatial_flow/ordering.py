@@ -0,0 +1,167 @@
+import functools
+import numpy as np
+import tensorflow as tf
+
+"""
+
+This section pertains to the ordering of the flattened spatial axis.
+
+Whenever the spatial dimensions are flattened, such as when a selector gathers or a reducer
+scatters, some ordering of the locations must be chosen. Row major ordering is the default,
+but under it the neighbors of a location in a 2D or 3D kernel land a whole row, or plane,
+apart in memory.
+
+Space filling curves walk the grid so that locations close in space are close in memory.
+This only pays off when the gather is bound by reads of the state, which it is not while
+the state fits in cache; there, as benchmarks/gather_locality.py shows, they run at parity
+with row major. Two are provided:
+
+    "morton" - The Z order curve. Coordinates have their bits interleaved.
+    "hilbert" - The Hilbert curve, in any number of dimensions. Consecutive locations are always
+        neighbors on power of two grids, giving better locality than morton at a slightly higher
+        construction cost.
+
+For grids whose sizes are not powers of two, the curve over the enclosing power of two grid
+is used, and the locations which exist are ranked along it.
+
+When an ordering other than row major is in use, tensors are stored with their spatial
+dimensions already flattened, in curve order. Conversion to and from the familiar
+[batch..., spatial..., channel...] format happens only at the model boundary.
+
+"""
+
+ORDERINGS = ("row_major", "morton", "hilbert")
+
+
+def _coordinates(spatial_shape):
+    # Every coordinate of the grid, in row major order
+    mesh = np.meshgrid(*[np.arange(size) for size in spatial_shape], indexing="ij")
+    return np.stack(mesh, -1).reshape(-1, len(spatial_shape)).astype(np.int64)
+
+
+def _bits(spatial_shape):
+    return max(1, int(np.ceil(np.log2(max(spatial_shape)))))
+
+
+def morton_codes(spatial_shape):
+    """ The morton code of every location, in row major order """
+    coordinates = _coordinates(spatial_shape)
+    rank = len(spatial_shape)
+    codes = np.zeros(len(coordinates), dtype=np.int64)
+    for bit in range(_bits(spatial_shape) - 1, -1, -1):
+        for dim in range(rank):
+            codes = (codes << 1) | ((coordinates[:, dim] >> bit) & 1)
+    return codes
+
+
+def hilbert_codes(spatial_shape):
+    """ The hilbert index of every location, in row major order. Uses Skilling's transform. """
+    coordinates = _coordinates(spatial_shape)
+    rank = len(spatial_shape)
+    bits = _bits(spatial_shape)
+    X = coordinates.copy()
+
+    # Inverse undo
+    Q = 1 << (bits - 1)
+    while Q > 1:
+        P = Q - 1
+        for dim in range(rank):
+            high = (X[:, dim] & Q) != 0
+            X[high, 0] ^= P
+            low = ~high
+            swap = (X[low, 0] ^ X[low, dim]) & P
+            X[low, 0] ^= swap
+            X[low, dim] ^= swap
+        Q >>= 1
+
+    # Gray encode
+    for dim in range(1, rank):
+        X[:, dim] ^= X[:, dim - 1]
+    flip = np.zeros(len(X), dtype=np.int64)
+    Q = 1 << (bits - 1)
+    while Q > 1:
+        flip[(X[:, rank - 1] & Q) != 0] ^= Q - 1
+        Q >>= 1
+    X ^= flip[:, None]
+
+    # Interleave the transposed form into a single index
+    codes = np.zeros(len(X), dtype=np.int64)
+    for bit in range(bits - 1, -1, -1):
+        for dim in range(rank):
+            codes = (codes << 1) | ((X[:, dim] >> bit) & 1)
+    return codes
+
+
+class Ordering():
+    """
+
+    An ordering of the flattened spatial axis.
+
+    :property forward: For each row major location, its position along the curve.
+    :property inverse: For each position along the curve, the row major location found there.
+    """
+    @property
+    def name(self):
+        return self._name
+    @property
+    def spatial_shape(self):
+        return self._spatial_shape
+    @property
+    def is_row_major(self):
+        return self._name == "row_major"
+    @property
+    def forward(self):
+        return self._forward
+    @property
+    def inverse(self):
+        return self._inverse
+    def __init__(self, spatial_shape, name="row_major"):
+        """
+
+        :param spatial_shape: The spatial shape being ordered
+        :param name: One of "row_major", "morton", "hilbert"
+        """
+        if name not in ORDERINGS:
+            raise ValueError("Ordering - name was not one of %s" % (ORDERINGS,))
+        spatial_shape = tf.TensorShape(spatial_shape)
+        self._name = name
+        self._spatial_shape = spatial_shape
+
+        size = spatial_shape.num_elements()
+        if name == "row_major":
+            inverse = np.arange(size)
+        elif name == "morton":
+            inverse = np.argsort(morton_codes(spatial_shape.as_list()), kind="stable")
+        else:
+            inverse = np.argsort(hilbert_codes(spatial_shape.as_list()), kind="stable")
+        forward = np.empty(size, dtype=np.int64)
+        forward[inverse] = np.arange(size)
+
+        self._forward = tf.constant(forward, dtype=tf.dtypes.int32)
+        self._inverse = tf.constant(inverse, dtype=tf.dtypes.int32)
+
+    def linearize(self, pointers):
+        """ Flattens the index dimension of a block of pointers into a position along the curve """
+        strides = tf.math.cumprod(self._spatial_shape.as_list(), exclusive=True, reverse=True)
+        linear = tf.reduce_sum(tf.multiply(pointers, strides), axis=-1)
+        if self.is_row_major:
+            return linear
+        return tf.gather(self._forward, linear)
+
+    def to_curve(self, flat, axis):
+        """ Reorder a row major flattened spatial axis into curve order """
+        if self.is_row_major:
+            return flat
+        return tf.gather(flat, self._inverse, axis=axis)
+
+    def from_curve(self, flat, axis):
+        """ Reorder a curve ordered flattened spatial axis back into row major order """
+        if self.is_row_major:
+            return flat
+        return tf.gather(flat, self._forward, axis=axis)
+
+
+@functools.lru_cache(maxsize=None)
+def get_ordering(spatial_shape, name="row_major"):
+    """ Fetch a shared ordering. spatial_shape must be a tuple. """
+    return Ordering(list(spatial_shape), name)
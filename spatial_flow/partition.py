@@ -0,0 +1,368 @@
+import multiprocessing
+import numpy as np
+
+"""
+
+This section pertains to spatially sharded execution.
+
+When a spatial grid becomes very large, a single process can no longer hold the state
+and the references. A partition splits the grid into rectangular tiles, and each tile is
+then owned by its own worker process. The partition itself is only geometry: which
+locations each tile owns is worked out arithmetically, so it never holds anything of
+full grid size.
+
+Everything of grid size is handed over a tile at a time. Each tile process obtains its own
+pointers, weights, and initial state from a tile source, builds its own plan from them, and
+returns only its own final state. No process, the parent included, need ever hold the whole
+grid.
+
+Each tile only needs the state of the locations its own pointers read from. Those it
+does not own are its halo. Because the halo is worked out directly from the absolute
+pointers of the tile, it is exact: only cells which are actually read are exchanged,
+whatever the topology. Absolute pointers have already been wrapped around the grid by
+floormod, so a tile on one edge simply has a halo on the opposite edge, and nothing special
+is needed for wraparound. Before the first step, every tile tells every other tile which of
+its cells it needs, so each tile also learns what it must send.
+
+Flattened spatial indices here are always row major, whatever the ordering of the reference
+the pointers came from. Within a tile the state is laid out as [batch, owned + halo, channels],
+with the owned locations first, in increasing flattened order, and the halo after them grouped
+by the tile which owns it. Tile states passed to and returned by the executor are
+[batch, owned, channels], in that same owned order.
+
+"""
+
+
+class Partition():
+    """
+
+    A partition of a spatial grid into tiles.
+
+    The grid is split into tiles[i] roughly equal pieces along each spatial dimension i. Tiles
+    are numbered in row major order of their tile coordinates.
+    """
+    @property
+    def tiles(self):
+        return self._tiles
+    @property
+    def num_tiles(self):
+        return self._num_tiles
+    @property
+    def spatial_shape(self):
+        return self._spatial_shape
+    @property
+    def spatial_size(self):
+        return int(np.prod(self._spatial_shape))
+    def __init__(self, spatial_shape, tiles):
+        """
+
+        :param spatial_shape: A 1D list, with the size of each spatial dimension
+        :param tiles: A 1D list, with the number of tiles along each spatial dimension
+        """
+        if not isinstance(tiles, (list, tuple)) or len(tiles) != len(spatial_shape):
+            raise ValueError("Partition - tiles must be a list with one entry per spatial dimension")
+        if any(type(count) != int or count < 1 or count > size for count, size in zip(tiles, spatial_shape)):
+            raise ValueError("Partition - each tile count must be an integer between 1 and its dimension")
+
+        self._tiles = list(tiles)
+        self._num_tiles = int(np.prod(tiles))
+        self._spatial_shape = [int(size) for size in spatial_shape]
+
+    def bounds(self, tile):
+        """ The [start, stop) of the tile along each spatial dimension """
+        coordinates = np.unravel_index(tile, self._tiles)
+        return [(-(-int(index) * size // count), -(-(int(index) + 1) * size // count))
+                for index, size, count in zip(coordinates, self._spatial_shape, self._tiles)]
+
+    def slices(self, tile):
+        """ The tile's block of any array with leading spatial dimensions, as a tuple of slices """
+        return tuple(slice(start, stop) for start, stop in self.bounds(tile))
+
+    def owned(self, tile):
+        """ The flattened spatial locations owned by the tile, in increasing order """
+        mesh = np.meshgrid(*[np.arange(start, stop) for start, stop in self.bounds(tile)], indexing="ij")
+        return np.ravel_multi_index(tuple(mesh), self._spatial_shape).reshape(-1)
+
+    def owner_of(self, locations):
+        """ The tile owning each of the given flattened spatial locations """
+        coordinates = np.stack(np.unravel_index(np.asarray(locations), self._spatial_shape), -1)
+        tile_coordinates = coordinates * np.array(self._tiles) // np.array(self._spatial_shape)
+        return np.ravel_multi_index(tuple(np.moveaxis(tile_coordinates, -1, 0)), self._tiles)
+
+    def split(self, state):
+        """ Split a row major [batch, spatial, channels] state into a list of owned per tile states. For small grids. """
+        return [state[:, self.owned(tile)] for tile in range(self._num_tiles)]
+
+    def merge(self, tile_states):
+        """ The inverse of split. Builds the whole grid in one array, so is only suitable for small grids. """
+        batch, _, channels = tile_states[0].shape
+        state = np.zeros([batch, self.spatial_size, channels], dtype=tile_states[0].dtype)
+        for tile, tile_state in enumerate(tile_states):
+            state[:, self.owned(tile)] = tile_state
+        return state
+
+
+def tile_pointers(reference, partition, tile, kernel=None, bias=None):
+    """
+
+    The pointer data of a single tile, reading only the tile's block of the reference
+    and of the weights.
+
+    :param reference: A Reference or Numpy_Reference
+    :param partition: The Partition
+    :param tile: The tile
+    :param kernel: None, or one weight per pointer, of shape [spatial..., comparison...]
+    :param bias: None, or one bias per location, of shape [spatial...]
+    :return: A dict, as accepted by Tile_Plan. "sources" holds the flattened location each of the
+        tile's valid pointers reads from, "segments" the position within owned it belongs to, and
+        "positions" its position in the tile's own flattened [owned, comparison...] grid. "kernel"
+        and "bias", if given, are the tile's slices, flattened to match.
+    """
+    spatial_shape = list(reference.spatial_shape)
+    if [int(size) for size in spatial_shape] != partition.spatial_shape:
+        raise ValueError("tile_pointers - reference and partition have different spatial shapes")
+    slices = partition.slices(tile)
+    rank = len(spatial_shape)
+    comparison_size = int(np.prod(list(reference.comparison_shape)))
+
+    relative = np.asarray(reference.relative_reference[slices])
+    valid = np.asarray(reference.valid[slices])
+    mesh = np.meshgrid(*[np.arange(item.start, item.stop) for item in slices], indexing="ij")
+    identity = np.stack(mesh, -1).reshape(*relative.shape[:rank], *[1] * rank, rank)
+    absolute = np.mod(identity + relative, np.array(partition.spatial_shape))
+    linear = np.ravel_multi_index(tuple(np.moveaxis(absolute, -1, 0)), partition.spatial_shape).reshape(-1)
+
+    positions = np.flatnonzero(valid)
+    pointers = {"sources": linear[positions],
+                "segments": positions // comparison_size,
+                "positions": positions}
+    if kernel is not None:
+        pointers["kernel"] = np.asarray(kernel[slices]).reshape(-1)
+    if bias is not None:
+        pointers["bias"] = np.asarray(bias[slices]).reshape(-1)
+    return pointers
+
+
+class Tile_Plan():
+    """
+
+    The execution plan for a single tile, built from that tile's pointer data alone.
+
+    :property owned: The flattened spatial locations owned by the tile
+    :property receive: A dict mapping each neighbor tile to the flattened locations received from it,
+        in halo order
+    :property send: A dict mapping each neighbor tile to the positions, within owned, of the
+        locations sent to it. Empty until "accept" is called with the neighbors' requests.
+    :property sources: For each of the tile's valid pointers, the local position read from
+    :property segments: For each of the tile's valid pointers, the position within owned it belongs to
+    :property positions: For each of the tile's valid pointers, its position in the tile's flattened
+        [owned, comparison...] grid. Used to look up per pointer weights.
+    :property kernel: None, or the tile's per pointer weights, indexed by positions
+    :property bias: None, or the tile's per location bias, indexed by position within owned
+    """
+    @property
+    def halo_size(self):
+        return sum(len(item) for item in self.receive.values())
+
+    @property
+    def local_size(self):
+        return len(self.owned) + self.halo_size
+
+    def __init__(self, partition, tile, pointers):
+        """
+
+        :param partition: The Partition
+        :param tile: The tile planned
+        :param pointers: The tile's pointer data, as made by tile_pointers
+        """
+        sources = np.asarray(pointers["sources"])
+        self.tile = tile
+        self.owned = partition.owned(tile)
+        if np.any(sources < 0) or np.any(sources >= partition.spatial_size):
+            raise ValueError("Tile_Plan - tile %s has sources outside the grid" % tile)
+        if np.any(np.asarray(pointers["segments"]) >= len(self.owned)):
+            raise ValueError("Tile_Plan - tile %s has segments outside the tile" % tile)
+
+        # The halo, grouped by the neighbor owning it
+        needed = np.unique(sources)
+        needed_owner = partition.owner_of(needed)
+        halo = needed[needed_owner != tile]
+        halo_owner = needed_owner[needed_owner != tile]
+        self.receive = {int(neighbor): halo[halo_owner == neighbor] for neighbor in np.unique(halo_owner)}
+        self.send = {}
+
+        # Local numbering. Owned first, then the halo grouped by neighbor.
+        local_order = np.concatenate([self.owned, *self.receive.values()])
+        sorter = np.argsort(local_order)
+        self.sources = sorter[np.searchsorted(local_order, sources, sorter=sorter)]
+        self.segments = np.asarray(pointers["segments"])
+        self.positions = np.asarray(pointers["positions"])
+        self.kernel = pointers.get("kernel")
+        self.bias = pointers.get("bias")
+
+    def accept(self, requests):
+        """
+
+        Work out what to send, from what the neighbors need.
+
+        :param requests: A dict mapping each neighbor tile to the flattened locations it needs from this tile
+        """
+        self.send = {int(neighbor): np.searchsorted(self.owned, cells)
+                     for neighbor, cells in requests.items() if len(cells) > 0}
+
+
+def weighted_sum_step(local_state, plan, activation=np.tanh):
+    """
+
+    The default tile step. Matches packed_reducer: each valid pointer is weighted,
+    then summed onto the location it belongs to. The weights are the plan's own
+    kernel and bias slices, with no kernel meaning a weight of one.
+
+    :param local_state: The tile's local state, [batch, owned + halo, channels]
+    :param plan: The tile's Tile_Plan
+    :param activation: The activation to apply
+    :return: The tile's next owned state, [batch, owned, channels]
+    """
+    values = local_state[:, plan.sources]
+    if plan.kernel is not None:
+        values = values * plan.kernel[plan.positions][None, :, None]
+    output = np.zeros([local_state.shape[0], len(plan.owned), local_state.shape[2]], dtype=local_state.dtype)
+    np.add.at(output, (slice(None), plan.segments), values)
+    if plan.bias is not None:
+        output += plan.bias[None, :, None]
+    return activation(output)
+
+
+def _collect(inbox, step, senders, pending):
+    # Gather the messages of a single step from the given number of senders,
+    # setting aside any which arrive early for later steps.
+
+    received = pending.pop(step, {})
+    while len(received) < senders:
+        index, sender, payload = inbox.get()
+        if index == step:
+            received[sender] = payload
+        else:
+            pending.setdefault(index, {})[sender] = payload
+    return received
+
+
+_TILE_DATA = -2
+_REQUESTS = -1
+
+
+def _tile_worker(partition, tile, source, steps, step_fn, inboxes, results):
+    # The body of a single tile process. Fetch the tile, agree on the halo with
+    # every other tile, then each step send every neighbor the cells it needs,
+    # collect the halo, and update.
+
+    pending = {}
+    if source is None:
+        pointers, state = _collect(inboxes[tile], _TILE_DATA, 1, pending)[None]
+    else:
+        pointers, state = source(tile)
+    plan = Tile_Plan(partition, tile, pointers)
+    state = np.asarray(state)
+    del pointers
+
+    for neighbor in range(partition.num_tiles):
+        if neighbor != tile:
+            inboxes[neighbor].put((_REQUESTS, tile, plan.receive.get(neighbor, np.zeros([0], np.int64))))
+    plan.accept(_collect(inboxes[tile], _REQUESTS, partition.num_tiles - 1, pending))
+
+    for index in range(steps):
+        for neighbor, cells in plan.send.items():
+            inboxes[neighbor].put((index, tile, state[:, cells]))
+        received = _collect(inboxes[tile], index, len(plan.receive), pending)
+        halo = [received[neighbor] for neighbor in plan.receive]
+        local_state = np.concatenate([state, *halo], axis=1)
+        state = step_fn(local_state, plan)
+    results.put((tile, state))
+
+
+class Sharded_Executor():
+    """
+
+    Runs a spatial flow step function over a partitioned grid, with one process per tile.
+
+    Only halo cells are exchanged between processes, once per step. The step function is called
+    within each tile process with the tile's local state and plan, and must return the tile's next
+    owned state. It must be picklable, so top level functions or functools.partial are suitable.
+
+    Tiles are supplied by a tile source. This is either a picklable function, called within each
+    tile process with the tile, or an iterable yielding each tile in turn. Either way each tile is
+    a pair of its pointer data, as made by tile_pointers, and its initial [batch, owned, channels]
+    state. A function is called where the tile is needed, so it should load or generate just that
+    tile; a partial over a whole reference would be pickled into every process. An iterable is
+    drawn from in the parent one tile at a time, each tile being sent on to its process before the
+    next is drawn.
+    """
+    @property
+    def partition(self):
+        return self._partition
+    def __init__(self, partition, step_fn=weighted_sum_step, timeout=600):
+        """
+
+        :param partition: A Partition
+        :param step_fn: A function accepting (local_state, plan) as described above
+        :param timeout: Seconds to wait for each tile's result
+        """
+        if not isinstance(partition, Partition):
+            raise TypeError("Sharded_Executor - partition was not of type 'Partition'")
+        if not callable(step_fn):
+            raise TypeError("Sharded_Executor - step_fn was not callable")
+        self._partition = partition
+        self._step_fn = step_fn
+        self._timeout = timeout
+
+    def stream(self, source, steps):
+        """
+
+        Run, yielding each tile's result as soon as it finishes.
+
+        :param source: A tile source, as described above
+        :param steps: The number of steps to run
+        :return: A generator of (tile, final owned state) pairs, in the order tiles finish
+        """
+        if type(steps) != int or steps < 0:
+            raise ValueError("Sharded_Executor - steps was not a non-negative integer")
+        num_tiles = self._partition.num_tiles
+        function = source if callable(source) else None
+
+        context = multiprocessing.get_context("spawn")
+        inboxes = [context.Queue() for _ in range(num_tiles)]
+        results = context.Queue()
+        processes = [context.Process(target=_tile_worker,
+                                     args=(self._partition, tile, function, steps, self._step_fn, inboxes, results))
+                     for tile in range(num_tiles)]
+        for process in processes:
+            process.start()
+        try:
+            if function is None:
+                count = 0
+                for tile, (pointers, state) in enumerate(source):
+                    if tile >= num_tiles:
+                        raise ValueError("Sharded_Executor - source yielded more than %s tiles" % num_tiles)
+                    inboxes[tile].put((_TILE_DATA, None, (pointers, np.asarray(state))))
+                    count += 1
+                if count != num_tiles:
+                    raise ValueError("Sharded_Executor - source yielded %s tiles, expected %s" % (count, num_tiles))
+            for _ in processes:
+                yield results.get(timeout=self._timeout)
+        finally:
+            for process in processes:
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.terminate()
+
+    def run(self, source, steps):
+        """
+
+        Run, collecting every tile's result.
+
+        :param source: A tile source, as described above
+        :param steps: The number of steps to run
+        :return: A list holding each tile's final [batch, owned, channels] state, in tile order
+        """
+        outputs = dict(self.stream(source, steps))
+        return [outputs[tile] for tile in range(self._partition.num_tiles)]
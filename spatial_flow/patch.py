@@ -0,0 +1,206 @@
+import struct
+import numpy as np
+
+"""
+
+This section pertains to patches, compact records of the changes between two
+references.
+
+When only a small part of a topology mutates, there is no need to ship the whole
+relative reference to other trainers or servers. A patch lists only what changed:
+for each changed pointer, its location, its slot within the comparison grid, its new
+relative offset and its new validity; and for each location whose mutability changed,
+its new mutability. Patches are made by Reference.diff, and applied by
+Reference.apply_patch, which scatters just the listed entries.
+
+Locations and slots are row major flattened indices, whatever the ordering of the
+reference, so a patch may be applied to any reference with the same shapes.
+
+The binary encoding stores each column at the smallest integer width able to hold it,
+and packs boolean columns eight to a byte. It is laid out as:
+
+    header - The magic b"SFRP", the format version, the spatial rank, then the spatial
+        and comparison shapes as uint32.
+    counts - The number of changed pointers and of changed mutabilities as uint32, then
+        one width code each for the locations, slots, and offsets.
+    body - locations, slots, offsets, packed validity, mutable locations, packed mutability.
+
+All integers are little endian.
+
+"""
+
+_MAGIC = b"SFRP"
+_FORMAT = 1
+_UNSIGNED = [np.uint8, np.uint16, np.uint32, np.uint64]
+_SIGNED = [np.int8, np.int16, np.int32, np.int64]
+
+
+def _unsigned_code(largest):
+    # The smallest unsigned width holding every value up to largest
+    for code, dtype in enumerate(_UNSIGNED):
+        if largest <= np.iinfo(dtype).max:
+            return code
+    raise ValueError("Reference_Patch - index too large to encode")
+
+
+def _signed_code(values):
+    # The smallest signed width holding every value
+    if values.size == 0:
+        return 0
+    low, high = int(values.min()), int(values.max())
+    for code, dtype in enumerate(_SIGNED):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return code
+    raise ValueError("Reference_Patch - offset too large to encode")
+
+
+class Reference_Patch():
+    """
+
+    A sparse set of changes to a reference.
+
+    :property locations: For each changed pointer, its row major flattened spatial location
+    :property slots: For each changed pointer, its row major flattened comparison slot
+    :property offsets: For each changed pointer, its new relative offset. Shape [changed, spatial rank]
+    :property valid: For each changed pointer, its new validity
+    :property mutable_locations: The row major flattened locations whose mutability changed
+    :property mutable: The new mutability of each of those locations
+    """
+    @property
+    def spatial_shape(self):
+        return self._spatial_shape
+    @property
+    def comparison_shape(self):
+        return self._comparison_shape
+    @property
+    def locations(self):
+        return self._locations
+    @property
+    def slots(self):
+        return self._slots
+    @property
+    def offsets(self):
+        return self._offsets
+    @property
+    def valid(self):
+        return self._valid
+    @property
+    def mutable_locations(self):
+        return self._mutable_locations
+    @property
+    def mutable(self):
+        return self._mutable
+    @property
+    def size(self):
+        """ The number of changed pointers """
+        return len(self._locations)
+    @property
+    def empty(self):
+        return self.size == 0 and len(self._mutable_locations) == 0
+    def __init__(self, spatial_shape, comparison_shape, locations, slots, offsets, valid,
+                 mutable_locations, mutable):
+        """
+
+        :param spatial_shape: The spatial shape of the reference, as a 1D list
+        :param comparison_shape: The comparison shape of the reference, as a 1D list
+        :param locations: As the property
+        :param slots: As the property
+        :param offsets: As the property
+        :param valid: As the property
+        :param mutable_locations: As the property
+        :param mutable: As the property
+        """
+        self._spatial_shape = [int(item) for item in spatial_shape]
+        self._comparison_shape = [int(item) for item in comparison_shape]
+        if len(self._spatial_shape) != len(self._comparison_shape):
+            raise ValueError("Reference_Patch - spatial_shape and comparison_shape must have the same rank")
+        rank = len(self._spatial_shape)
+
+        self._locations = np.asarray(locations, dtype=np.int64).reshape(-1)
+        self._slots = np.asarray(slots, dtype=np.int64).reshape(-1)
+        self._offsets = np.asarray(offsets, dtype=np.int64).reshape(-1, rank)
+        self._valid = np.asarray(valid, dtype=bool).reshape(-1)
+        self._mutable_locations = np.asarray(mutable_locations, dtype=np.int64).reshape(-1)
+        self._mutable = np.asarray(mutable, dtype=bool).reshape(-1)
+
+        count = len(self._locations)
+        if len(self._slots) != count or len(self._offsets) != count or len(self._valid) != count:
+            raise ValueError("Reference_Patch - locations, slots, offsets, and valid must have the same length")
+        if len(self._mutable) != len(self._mutable_locations):
+            raise ValueError("Reference_Patch - mutable_locations and mutable must have the same length")
+        spatial_size = int(np.prod(self._spatial_shape))
+        comparison_size = int(np.prod(self._comparison_shape))
+        for values, limit, name in ((self._locations, spatial_size, "locations"),
+                                    (self._slots, comparison_size, "slots"),
+                                    (self._mutable_locations, spatial_size, "mutable_locations")):
+            if values.size > 0 and (values.min() < 0 or values.max() >= limit):
+                raise ValueError("Reference_Patch - %s out of range" % name)
+
+    def pointer_indices(self):
+        """ The full [spatial..., comparison...] index of each changed pointer. Shape [changed, 2 * rank] """
+        spatial = np.unravel_index(self._locations, self._spatial_shape)
+        comparison = np.unravel_index(self._slots, self._comparison_shape)
+        return np.stack([*spatial, *comparison], -1).reshape(-1, 2 * len(self._spatial_shape))
+
+    def mutable_indices(self):
+        """ The spatial index of each location whose mutability changed. Shape [changed, rank] """
+        spatial = np.unravel_index(self._mutable_locations, self._spatial_shape)
+        return np.stack(spatial, -1).reshape(-1, len(self._spatial_shape))
+
+    def to_bytes(self):
+        """ The compact binary encoding of the patch """
+        rank = len(self._spatial_shape)
+        location_code = _unsigned_code(int(np.prod(self._spatial_shape)) - 1)
+        slot_code = _unsigned_code(int(np.prod(self._comparison_shape)) - 1)
+        offset_code = _signed_code(self._offsets)
+
+        header = struct.pack("<4sBB%dI" % (2 * rank), _MAGIC, _FORMAT, rank,
+                             *self._spatial_shape, *self._comparison_shape)
+        counts = struct.pack("<IIBBB", self.size, len(self._mutable_locations),
+                             location_code, slot_code, offset_code)
+        body = [self._locations.astype(np.dtype(_UNSIGNED[location_code]).newbyteorder("<")),
+                self._slots.astype(np.dtype(_UNSIGNED[slot_code]).newbyteorder("<")),
+                self._offsets.astype(np.dtype(_SIGNED[offset_code]).newbyteorder("<")),
+                np.packbits(self._valid),
+                self._mutable_locations.astype(np.dtype(_UNSIGNED[location_code]).newbyteorder("<")),
+                np.packbits(self._mutable)]
+        return b"".join([header, counts, *[item.tobytes() for item in body]])
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+
+        Decode a patch encoded by to_bytes.
+
+        :param data: A bytes like object
+        :return: A Reference_Patch
+        """
+        data = memoryview(data)
+        magic, version, rank = struct.unpack_from("<4sBB", data, 0)
+        if magic != _MAGIC:
+            raise ValueError("Reference_Patch - data is not an encoded patch")
+        if version != _FORMAT:
+            raise ValueError("Reference_Patch - unsupported format version %s" % version)
+        offset = struct.calcsize("<4sBB")
+        shapes = struct.unpack_from("<%dI" % (2 * rank), data, offset)
+        offset += struct.calcsize("<%dI" % (2 * rank))
+        count, mutable_count, location_code, slot_code, offset_code = struct.unpack_from("<IIBBB", data, offset)
+        offset += struct.calcsize("<IIBBB")
+
+        def read(dtype, length):
+            nonlocal offset
+            dtype = np.dtype(dtype).newbyteorder("<")
+            values = np.frombuffer(data, dtype=dtype, count=length, offset=offset)
+            offset += dtype.itemsize * length
+            return values
+
+        def read_bits(length):
+            return np.unpackbits(read(np.uint8, (length + 7) // 8), count=length).astype(bool)
+
+        locations = read(_UNSIGNED[location_code], count)
+        slots = read(_UNSIGNED[slot_code], count)
+        offsets = read(_SIGNED[offset_code], count * rank)
+        valid = read_bits(count)
+        mutable_locations = read(_UNSIGNED[location_code], mutable_count)
+        mutable = read_bits(mutable_count)
+        return cls(shapes[:rank], shapes[rank:], locations, slots, offsets, valid, mutable_locations, mutable)
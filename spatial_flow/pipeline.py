@@ -0,0 +1,171 @@
+import queue
+import threading
+import numpy as np
+import tensorflow as tf
+from spatial_flow.spatial_tensor import Spatial_State
+
+"""
+
+This section pertains to feeding spatial states from tf.data pipelines.
+
+Every distinct batch shape a compiled selector or reducer sees produces a
+new trace. When serving a stream, where batches arrive at whatever size the
+traffic dictates, this means retracing is nearly constant.
+
+The state feed solves this by only ever producing a small, fixed set of batch
+sizes, referred to as buckets. Incoming samples are batched, and each batch is
+padded up to the smallest bucket which will hold it. Alongside each padded batch
+the number of real samples is provided, so padding may be discarded afterwards.
+Compiled functions are then traced exactly once per bucket.
+
+Single samples are batched by arrival. A batch holds whatever samples are ready
+when it is formed, up to the largest bucket, and never waits for more. A lone
+request is therefore run at once in the smallest bucket, while a busy stream,
+whose samples queue up faster than they are consumed, fills the larger buckets.
+
+"""
+
+
+class State_Feed():
+    """
+
+    The state feed class
+
+    A state feed is initialized with a spatial state and a list of bucket
+    sizes, and when called with a tf.data dataset returns a new dataset producing
+    (state, count) pairs, where state has a batch size drawn from the buckets and
+    count is the number of samples which are not padding.
+
+    :method compile:
+        Wraps a function so that it is traced once per bucket, with a fully
+        defined input signature, rather than once per observed batch shape.
+    """
+    @property
+    def spatial_state(self):
+        return self._spatial_state
+    @property
+    def buckets(self):
+        return self._buckets
+    @property
+    def prefetch(self):
+        return self._prefetch
+    def __init__(self, spatial_state, buckets=(1, 8, 32), prefetch=tf.data.AUTOTUNE, dtype=tf.dtypes.float32):
+        """
+
+        The initializer
+
+        :param spatial_state: The Spatial_State being fed.
+        :param buckets: A list of positive integer batch sizes.
+        :param prefetch: How many padded batches to prefetch. Defaults to autotune.
+        :param dtype: The dtype of the state.
+        """
+        if not isinstance(spatial_state, Spatial_State):
+            raise TypeError("State_Feed - spatial_state was not of type 'Spatial_State'")
+        if spatial_state.batch_dims.rank != 1:
+            raise ValueError("State_Feed - expected spatial state to have exactly one batch dimension")
+        if not isinstance(buckets, (list, tuple)) or len(buckets) == 0:
+            raise TypeError("State_Feed - buckets was not a nonempty list or tuple")
+        if any(type(item) != int or item < 1 for item in buckets):
+            raise ValueError("State_Feed - buckets must all be positive integers")
+
+        self._spatial_state = spatial_state
+        self._buckets = tuple(sorted(set(buckets)))
+        self._prefetch = prefetch
+        self._dtype = dtype
+
+    def signature(self, bucket):
+        """ Returns the TensorSpec of a padded batch in the given bucket """
+        if bucket not in self._buckets:
+            raise ValueError("State_Feed - %s is not one of the buckets %s" % (bucket, self._buckets))
+        return self._spatial_state.signature([bucket], self._dtype)
+
+    def __pad(self, batch):
+        # Pad a batch up to the smallest bucket which can hold it
+
+        count = tf.shape(batch)[0]
+        buckets = tf.constant(self._buckets, dtype=count.dtype)
+        bucket = tf.gather(buckets, tf.searchsorted(buckets, tf.expand_dims(count, 0)))[0]
+        paddings = tf.concat([[[0, bucket - count]], tf.zeros([batch.shape.rank - 1, 2], count.dtype)], axis=0)
+        return tf.pad(batch, paddings), count
+
+    def __ready(self, dataset):
+        # Drain the dataset on a background thread, then yield batches
+        # of whatever samples are ready, without waiting for more.
+
+        largest = self._buckets[-1]
+        samples = queue.Queue(maxsize=2 * largest)
+        finished = object()
+
+        def fill():
+            try:
+                for sample in dataset:
+                    samples.put(sample.numpy())
+            except Exception as err:
+                samples.put(err)
+            samples.put(finished)
+        threading.Thread(target=fill, daemon=True).start()
+
+        while True:
+            batch = [samples.get()]
+            while len(batch) < largest and batch[-1] is not finished and not isinstance(batch[-1], Exception):
+                try:
+                    batch.append(samples.get_nowait())
+                except queue.Empty:
+                    break
+            last = batch[-1]
+            if last is finished or isinstance(last, Exception):
+                batch.pop()
+            if batch:
+                yield np.stack(batch)
+            if isinstance(last, Exception):
+                raise last
+            if last is finished:
+                return
+
+    def __call__(self, dataset, batched=False):
+        """
+
+        Builds the padded, bucketed, prefetched pipeline.
+
+        :param dataset: A tf.data dataset producing states.
+        :param batched: If false, each element is a single sample of shape [spatial..., channel...], and
+            samples are batched by arrival as described above. If true, each element is a batch of any
+            size, such as a single request on a server. Batches larger than the largest bucket are split.
+        :return: A tf.data dataset producing (state, count) pairs.
+        """
+        if not isinstance(dataset, tf.data.Dataset):
+            raise TypeError("State_Feed - expected a tf.data.Dataset")
+
+        largest = self._buckets[-1]
+        dataset = dataset.map(lambda item: tf.cast(item, self._dtype))
+        if batched:
+            dataset = dataset.flat_map(lambda batch: tf.data.Dataset.from_tensor_slices(batch).batch(largest))
+        else:
+            samples = dataset.prefetch(self._prefetch)
+            dataset = tf.data.Dataset.from_generator(lambda: self.__ready(samples),
+                                                     output_signature=self._spatial_state.signature([None], self._dtype))
+        dataset = dataset.map(self.__pad, num_parallel_calls=tf.data.AUTOTUNE)
+        return dataset.prefetch(self._prefetch)
+
+    def compile(self, function):
+        """
+
+        Compiles function once per bucket. The returned callable accepts a padded
+        state, as produced by this feed, and dispatches to the matching trace.
+
+        :param function: A function accepting a state in spatialgrid format
+        :return: A callable
+        """
+        if not callable(function):
+            raise TypeError("State_Feed - compile: function was not callable")
+        traces = {bucket: tf.function(function, input_signature=[self.signature(bucket)])
+                  for bucket in self._buckets}
+
+        def dispatch(state):
+            bucket = state.shape[0]
+            if bucket not in traces:
+                raise ValueError("State_Feed - batch of size %s is not one of the buckets %s"
+                                 % (bucket, self._buckets))
+            return traces[bucket](state)
+        dispatch.traces = traces
+        return dispatch
@@ -1,7 +1,10 @@
 import tensorflow as tf
 import tensorflow.keras as keras
 from spatial_flow.utils.error_utils import Reducer_Error
+import spatial_flow.utils.error_utils as error
 from spatial_flow.selectors import Selector
+from spatial_flow.utils.instrumentation import instrument
+import spatial_flow.core as core
 """
 
 A reducer is an object which accepts a 
@@ -28,19 +31,49 @@ class Reducer(keras.layers.Layer):
 
     """
     @property
+    def layout(self):
+        return self._selector.layout
+    @property
     def batch_dims(self):
-        return self._batch_dims
+        return self._selector.batch_dims
     @property
     def channel_dims(self):
-        return self._channel_dims
+        return self._selector.channel_dims
     @property
     def selector(self):
         return self._selector
-    def __init__(self, selector, reduce_dims = "all", name="reducer"):
+    @property
+    def consumes_selection(self):
+        """ Whether reduce_state consumes the output of the selector """
+        return True
+    @property
+    def hot_swappable(self):
+        """ Whether a compiled call picks up changes to the reference without retracing """
+        return self._selector.hot_swappable
+    @property
+    def compiled(self):
+        """
+        A compiled call with a stable input signature. One trace serves every batch size.
+        If the reducer is not hot swappable, it is rebuilt whenever the reference changes.
+        """
+        version = self._selector.reference.version
+        if self._compiled is None or (not self.hot_swappable and self._compiled_version != version):
+            signature = self.input_signature()
+            #Build eagerly, so weight creation does not force a second trace
+            if not self.built:
+                self.build(signature.shape)
+                self.built = True
+            self._compiled = tf.function(self.__call__, input_signature=[signature])
+            self._compiled_version = version
+        return self._compiled
+    def __init__(self, selector, reduce_dims = "all", name="reducer", **kwargs):
         """
 
         The initializer for the reducer class.
 
+        The layout of incoming tensors is taken from the selector, which
+        declares it up front.
+
         :param selector: A valid selector
         :param reduce_dims: The dimensions to be reduced. Supports "All" or a 1D bool list
         :param name: The name of the layer.
@@ -48,33 +81,43 @@ class Reducer(keras.layers.Layer):
 
         #verify inputs are sane
         if not isinstance(selector, Selector):
-            return Reducer_Error("Input 'selector' was not a selector")
+            raise Reducer_Error("Input 'selector' was not a selector")
 
 
         #Initialize and store
         super().__init__(name=name, **kwargs)
 
-
-
         self._selector = selector
+        self._compiled = None
+        self._compiled_version = None
 
+    def input_signature(self, dtype=tf.dtypes.float32):
+        """
 
-        #Set default values
+        Describes the tensor this reducer is called with. By default, this
+        is whatever the selector produces. Reducers which fuse selection
+        should override this.
 
-        self._batch_dims = None
-        self._channel_dims = None
+        :param dtype: The dtype of the spatial state
+        :return: A tf.TensorSpec
+        """
+        return self._selector.output_signature(dtype)
 
-        #Go wrap call to strip batch and channel dims off
+    def reduce_state(self, spatial_state, cache=None):
+        """
 
+        Performs one complete select and reduce step, starting from
+        a tensor in spatialgrid format and returning one.
 
-        self.__stored_call = self.__call__
-        def stripper(self, input):
+        Reducers which fuse selection into their own call should override this.
 
-            self._total_batch_dims = input.batch_dims
-            self._channel_dims = input.channel_dims
-            self.__call__ = self.__stored_call
-            self.__call__(input)
-        self.__call__ = stripper
+        :param spatial_state: A tensor in spatialgrid format
+        :param cache: None, or a Selection_Cache to share the selection through
+        :return: A tensor in spatialgrid format
+        """
+        if cache is None:
+            return self(self.selector(spatial_state))
+        return self(cache.select(self.selector, spatial_state))
 
 @spatial_register
 class dense_reducer(Reducer):
@@ -147,7 +190,7 @@ class dense_reducer(Reducer):
 
         #perform verification and extrapolation
 
-        tf.debugging.assert_rank_at_least(input_shape, self.batch_dims.rank)
+        error.assert_rank_at_least(input_shape, self.batch_dims.rank)
 
 
 
@@ -156,6 +199,293 @@ class dense_reducer(Reducer):
         kernel_shape = tf.where(self._sharing, )
 
 
+@spatial_register
+class packed_reducer(Reducer):
+    """
+
+    The packed reducer consumes the packed output of a selector, in which
+    pruned pointers have already been compacted away, and performs a
+    weighted sum over the surviving pointers of each neuron.
+
+    Each pointer owns a single weight, shared across batch and channels. The
+    weights of pruned pointers still exist, but are never read, so pruning
+    removes both the gather and the multiply-accumulate.
+
+    """
+    def __init__(self,
+                 selector,
+                 activation=None,
+                 use_bias=True,
+                 kernel_initializer="glorot_uniform",
+                 bias_initializer="zeros",
+                 kernel_regularizer=None,
+                 bias_regularizer=None,
+                 kernel_constraint=None,
+                 bias_constraint=None,
+                 **kwargs):
+        """
+
+        :param selector: A selector with packed set to true.
+        :param activation: Like keras Dense
+        :param use_bias: Like keras Dense
+        :param kernel_initializer: Like keras Dense
+        :param bias_initializer: Like keras Dense
+        :param kernel_regularizer: Like keras Dense
+        :param bias_regularizer: Like keras Dense
+        :param kernel_constraint: Like keras Dense
+        :param bias_constraint: Like keras Dense
+        :param kwargs:
+        """
+        super().__init__(selector, **kwargs)
+        if not selector.packed:
+            raise Reducer_Error("packed_reducer requires a selector in packed mode")
+
+        self._use_bias = use_bias
+        self._activation = keras.activations.get(activation)
+        self._kernel_initializer = keras.initializers.get(kernel_initializer)
+        self._bias_initializer = keras.initializers.get(bias_initializer)
+        self._kernel_regularizer = keras.regularizers.get(kernel_regularizer)
+        self._bias_regularizer = keras.regularizers.get(bias_regularizer)
+        self._kernel_constraint = keras.constraints.get(kernel_constraint)
+        self._bias_constraint = keras.constraints.get(bias_constraint)
+
+    def build(self, input_shape):
+
+        #One weight per pointer, valid or not, so that validity may change
+        #without rebuilding the layer.
+
+        reference = self.selector.reference
+        self._kernel = self.add_weight(name="kernel",
+                                       shape=[reference.spatial_size * reference.comparison_size],
+                                       initializer=self._kernel_initializer,
+                                       regularizer=self._kernel_regularizer,
+                                       constraint=self._kernel_constraint)
+        if self._use_bias:
+            self._bias = self.add_weight(name="bias",
+                                         shape=[reference.spatial_size],
+                                         initializer=self._bias_initializer,
+                                         regularizer=self._bias_regularizer,
+                                         constraint=self._bias_constraint)
+
+    @instrument("packed_reducer.call")
+    def call(self, packed):
+        """
+
+        :param packed: A tensor in packed format, [batch..., valid pointers, channel...]
+        :return: A tensor in spatialgrid format
+        """
+        reference = self.selector.reference
+
+        #Move the pointer dimension to the front, weight it, then
+        #sum each neuron's pointers back onto its spatial location.
+
+        weights = tf.gather(self._kernel, reference.packed_positions)
+        return self.__weighted_sum(packed, weights, reference.packed_segments)
+
+    @property
+    def consumes_selection(self):
+        return self.selector.dedup != "neuron"
+    @property
+    def hot_swappable(self):
+        return self.selector.hot_swappable and self.selector.dedup != "neuron"
+
+    def reduce_state(self, spatial_state, cache=None):
+        """
+
+        Performs one complete select and reduce step. When the selector dedups
+        per neuron, duplicate pointers are merged by summing their weights, so
+        each distinct read is gathered and multiplied only once.
+
+        :param spatial_state: A tensor in spatialgrid format
+        :param cache: None, or a Selection_Cache to share the selection through
+        :return: A tensor in spatialgrid format
+        """
+        if self.selector.dedup != "neuron":
+            return super().reduce_state(spatial_state, cache)
+        if not self.built:
+            self.build(self.input_signature().shape)
+            self.built = True
+        return self.__reduce_unique(spatial_state)
+
+    @instrument("packed_reducer.reduce_unique")
+    def __reduce_unique(self, spatial_state):
+        reference = self.selector.reference
+        unique, merge_map = self.selector.select_unique(spatial_state)
+        _, segments, _ = reference.unique_pointers("neuron")
+        weights = tf.gather(self._kernel, reference.packed_positions)
+        weights = tf.math.unsorted_segment_sum(weights, merge_map, tf.shape(segments)[0])
+        return self.__weighted_sum(unique, weights, segments)
+
+    def __weighted_sum(self, packed, weights, segments):
+        # Weight each read, sum it onto the location it belongs to, then
+        # apply the bias and activation and restore spatialgrid format.
+
+        batch_rank = self.layout.batch_rank
+        values = core.move_axis(packed, batch_rank, 0)
+        weights = tf.reshape(weights, [-1] + [1] * (values.shape.rank - 1))
+        values = tf.multiply(values, tf.cast(weights, values.dtype))
+        output = tf.math.unsorted_segment_sum(values, segments, self.selector.reference.spatial_size)
+
+        if self._use_bias:
+            bias = tf.reshape(self._bias, [-1] + [1] * (values.shape.rank - 1))
+            output = tf.add(output, tf.cast(bias, output.dtype))
+        output = self._activation(output)
+
+        #Restore spatialgrid format
+        output = core.move_axis(output, 0, batch_rank)
+        return self.layout.restore(output)
+
+
+@spatial_register
+class sparse_reducer(Reducer):
+    """
+
+    The sparse reducer fuses selection and reduction. Rather than building a
+    comparison tensor, the reference and the per-pointer weights are viewed
+    as a sparse adjacency matrix, and the entire step is performed as a single
+    sparse-dense matmul over [prod(spatial), batch*channels].
+
+    For low density topologies this avoids materializing the comparison
+    tensor entirely. Because of this, the sparse reducer is called directly
+    with a tensor in spatialgrid format. The selector is used only for its
+    reference.
+
+    """
+    def __init__(self,
+                 selector,
+                 activation=None,
+                 use_bias=True,
+                 kernel_initializer="glorot_uniform",
+                 bias_initializer="zeros",
+                 kernel_regularizer=None,
+                 bias_regularizer=None,
+                 kernel_constraint=None,
+                 bias_constraint=None,
+                 **kwargs):
+        """
+
+        :param selector: A selector, whose reference defines the topology.
+        :param activation: Like keras Dense
+        :param use_bias: Like keras Dense
+        :param kernel_initializer: Like keras Dense
+        :param bias_initializer: Like keras Dense
+        :param kernel_regularizer: Like keras Dense
+        :param bias_regularizer: Like keras Dense
+        :param kernel_constraint: Like keras Dense
+        :param bias_constraint: Like keras Dense
+        :param kwargs:
+        """
+        super().__init__(selector, **kwargs)
+
+        self._use_bias = use_bias
+        self._activation = keras.activations.get(activation)
+        self._kernel_initializer = keras.initializers.get(kernel_initializer)
+        self._bias_initializer = keras.initializers.get(bias_initializer)
+        self._kernel_regularizer = keras.regularizers.get(kernel_regularizer)
+        self._bias_regularizer = keras.regularizers.get(bias_regularizer)
+        self._kernel_constraint = keras.constraints.get(kernel_constraint)
+        self._bias_constraint = keras.constraints.get(bias_constraint)
+
+    def build(self, input_shape):
+
+        reference = self.selector.reference
+        self._kernel = self.add_weight(name="kernel",
+                                       shape=reference.valid_shape,
+                                       initializer=self._kernel_initializer,
+                                       regularizer=self._kernel_regularizer,
+                                       constraint=self._kernel_constraint)
+        if self._use_bias:
+            self._bias = self.add_weight(name="bias",
+                                         shape=[reference.spatial_size],
+                                         initializer=self._bias_initializer,
+                                         regularizer=self._bias_regularizer,
+                                         constraint=self._bias_constraint)
+
+    @instrument("sparse_reducer.call")
+    def call(self, spatial_state):
+        """
+
+        :param spatial_state: A tensor in spatialgrid format
+        :return: A tensor in spatialgrid format
+        """
+        reference = self.selector.reference
+        adjacency = reference.to_sparse_adjacency(self._kernel, spatial_state.dtype)
+
+        #Collapse everything which is not spatial into the columns
+
+        batch_rank = self.layout.batch_rank
+        flat_state = self.layout.flatten(spatial_state)
+        flat_state = core.move_axis(flat_state, batch_rank, 0)
+        columns_shape = tf.shape(flat_state)
+        columns = tf.reshape(flat_state, [reference.spatial_size, -1])
+
+        #Perform the select and reduce, then restore
+
+        output = tf.sparse.sparse_dense_matmul(adjacency, columns)
+        if self._use_bias:
+            output = tf.add(output, tf.cast(tf.expand_dims(self._bias, -1), output.dtype))
+        output = self._activation(output)
+        output = tf.reshape(output, columns_shape)
+        output = core.move_axis(output, 0, batch_rank)
+        return self.layout.restore(output)
+
+    def input_signature(self, dtype=tf.dtypes.float32):
+        """ Selection is fused into call, so the input is in spatialgrid format """
+        return self.layout.signature(dtype=dtype)
+
+    @property
+    def consumes_selection(self):
+        return False
+    @property
+    def hot_swappable(self):
+        # The adjacency structure is captured when traced
+        return False
+
+    def reduce_state(self, spatial_state, cache=None):
+        """ Selection is fused into call, so the selector and cache are skipped """
+        return self(spatial_state)
+
+
+@spatial_register
+class Location_Dense(keras.layers.Layer):
+    """
+
+    A dense reduction with separate weights for every spatial location,
+    performed for all locations at once as a single batched contraction.
+
+    Accepts [batch, locations, channels, comparison] and returns [batch, locations, channels].
+
+    """
+    def __init__(self,
+                 locations,
+                 kernel_initializer="glorot_uniform",
+                 bias_initializer="zeros",
+                 **kwargs):
+        """
+
+        :param locations: The number of spatial locations
+        :param kernel_initializer: Like keras Dense
+        :param bias_initializer: Like keras Dense
+        :param kwargs:
+        """
+        super().__init__(**kwargs)
+        self._locations = locations
+        self._kernel_initializer = keras.initializers.get(kernel_initializer)
+        self._bias_initializer = keras.initializers.get(bias_initializer)
+
+    def build(self, input_shape):
+        self._kernel = self.add_weight(name="kernel",
+                                       shape=[self._locations, input_shape[-1]],
+                                       initializer=self._kernel_initializer)
+        self._bias = self.add_weight(name="bias",
+                                     shape=[self._locations],
+                                     initializer=self._bias_initializer)
+
+    def call(self, input):
+        output = tf.einsum("bnck,nk->bnc", input, tf.cast(self._kernel, input.dtype))
+        return output + tf.cast(self._bias[None, :, None], output.dtype)
+
+
 @spatial_register
 class keras_reducer(Reducer):
     """
@@ -168,21 +498,66 @@ class keras_reducer(Reducer):
     layer according to specifications. This is
     then utilized to reduce the indicated dimensions.
 
+    The layer reduces a single neuron, and is shared by every neuron. It may be executed
+    in one of two modes:
+
+        "batched" - Every spatial location and channel is folded into the batch axis, and the
+            layer is called once on [batch*spatial*channel, comparison...]. This runs at the
+            speed of a single layer call, and is the default.
+        "neuron" - The layer is called once per spatial location, on [batch..., channel..., comparison...].
+            Only needed for layers which must see the whole batch of a single neuron at once.
+
+    If per_location is true, reduce is not used. Every location instead gets its own dense
+    weights, applied to all locations at once by a single Location_Dense layer.
+
     """
-    def __fetch_reduce(self):
+    def __init__(self, selector, mode="batched", per_location=False, activation=None, **kwargs):
+        """
+
+        :param selector: A selector producing comparison format
+        :param mode: Either "batched" or "neuron"
+        :param per_location: Whether to use separate dense weights for every location instead of reduce
+        :param activation: Like keras Dense
+        :param kwargs:
+        """
+        super().__init__(selector, **kwargs)
+        if selector.packed:
+            raise Reducer_Error("keras_reducer requires a selector producing comparison format")
+        if mode not in ("batched", "neuron"):
+            raise Reducer_Error("keras_reducer mode was not 'batched' or 'neuron'")
+        if type(per_location) != bool:
+            raise Reducer_Error("keras_reducer per_location was not bool")
+
+        self._mode = mode
+        self._per_location = per_location
+        self._activation = keras.activations.get(activation)
+        self._layer = None
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @property
+    def per_location(self):
+        return self._per_location
+
+    def __fetch_reduce(self, batch_dims, channel_dims):
 
         #Fetch from user code, see if it runs at all.
+        comparison_shape = self.selector.comparison_shape
         try:
-            reduce_func = self.reduce()
+            reduce_func = self.reduce(batch_dims, channel_dims, comparison_shape)
         except Exception as err:
             msg = "Error in user code, reduce: did not successfully return: %s" % err
             raise Reducer_Error(msg) from err
         if not callable(reduce_func):
             raise Reducer_Error("Error in user code: Did not return callable function or class")
 
+        #Hold the layer, so its weights are tracked
+        self._layer = reduce_func
 
         #Build wrapper around function for sanity checking purposes
-        def reduce_wrapper(self, input):
+        def reduce_wrapper(input):
             #Does it even execute?
             try:
                 output = reduce_func(input)
@@ -191,10 +566,9 @@ class keras_reducer(Reducer):
                 raise Reducer_Error(msg) from err
             #It executed. IS the result of sane shape?
 
-
-            shape = self.batch_dims.concatenate(self.channel_dims).concatenate(tf.TensorShape([1]))
-            tf.debugging.assert_shapes([(output, shape)],
-                                       message="Error in user layer. Expected shape %s, got %s" %(shape, output.shape))
+            shape = batch_dims.concatenate(channel_dims).concatenate(tf.TensorShape([1]))
+            if not output.shape.is_compatible_with(shape):
+                raise Reducer_Error("Error in user layer. Expected shape %s, got %s" % (shape, output.shape))
 
             #looks good. Return
             return output
@@ -203,6 +577,7 @@ class keras_reducer(Reducer):
         #Return wrapped reduce
 
         return reduce_wrapper
+
     def reduce(self, batch_dims, channel_dims, comparison_shape):
         """
 
@@ -216,7 +591,9 @@ class keras_reducer(Reducer):
 
         The total shape of the incoming block will be
         [batch dims, channel_dims, comparison_dims]. Outgoing it should
-        be [batch_dims, channel_dims, 1]
+        be [batch_dims, channel_dims, 1]. In batched mode, the batch dims
+        are a single unknown dimension and there are no channel dims, as
+        everything has been folded into the batch.
 
 
         The default mode simply flattens the input and
@@ -237,8 +614,9 @@ class keras_reducer(Reducer):
         class default(tf.keras.layers.Layer):
             def __init__(self, batch_dims, channel_dims, comparison_shape):
                 super().__init__(name = "default")
-                reshape_dims =  batch_dims.concatenate(channel_dims).concatenate(tf.TensorShape(tf.reduce_prod(comparison_shape)))
-                self._flatten = lambda input : tf.reshape(input, reshape_dims)
+                leading = batch_dims.rank + channel_dims.rank
+                size = comparison_shape.num_elements()
+                self._flatten = lambda input : tf.reshape(input, tf.concat([tf.shape(input)[:leading], [size]], 0))
                 self._dense = tf.keras.layers.Dense(1)
             def call(self, input):
                 output = self._flatten(input)
@@ -249,3 +627,45 @@ class keras_reducer(Reducer):
 
         return default(batch_dims, channel_dims, comparison_shape)
 
+    def build(self, input_shape):
+        if self._per_location:
+            self._layer = Location_Dense(self.selector.reference.spatial_size, name="location_dense")
+        elif self._mode == "batched":
+            self._reduce = self.__fetch_reduce(tf.TensorShape([None]), tf.TensorShape([]))
+        else:
+            self._reduce = self.__fetch_reduce(self.batch_dims, self.channel_dims)
+
+    @instrument("keras_reducer.call")
+    def call(self, comparison):
+        """
+
+        :param comparison: A tensor in comparison format
+        :return: A tensor in spatialgrid format
+        """
+        layout = self.layout
+        comparison_shape = self.selector.comparison_shape
+        shape = tf.shape(comparison)
+        output_shape = shape[:-comparison_shape.rank]
+
+        if self._per_location:
+            #Fold batch and channel dimensions, keeping locations apart, and contract all locations at once
+            flat = layout.flatten(comparison)
+            flat_shape = tf.shape(flat)
+            batch_size = tf.reduce_prod(flat_shape[:layout.batch_rank])
+            channel_size = tf.reduce_prod(flat_shape[layout.batch_rank + 1:-comparison_shape.rank])
+            folded = tf.reshape(flat, [batch_size, self.selector.reference.spatial_size,
+                                       channel_size, comparison_shape.num_elements()])
+            output = self._layer(folded)
+        elif self._mode == "batched":
+            #Fold everything but the comparison into the batch, and make a single call
+            folded = tf.reshape(comparison, tf.concat([[-1], comparison_shape.as_list()], 0))
+            output = self._reduce(folded)
+        else:
+            #One call per location
+            flat = core.move_axis(layout.flatten(comparison), layout.batch_rank, 0)
+            output = tf.map_fn(self._reduce, flat, fn_output_signature=comparison.dtype)
+            output = core.move_axis(output, 0, layout.batch_rank)
+
+        output = tf.reshape(output, output_shape)
+        output.set_shape(comparison.shape[:-comparison_shape.rank])
+        return self._activation(output)
@@ -1,7 +1,13 @@
+import numpy as np
 import tensorflow as tf
 import tensorflow.keras as keras
 import spatial_flow.utils.error_utils as error
+from spatial_flow.utils.instrumentation import instrument
 import spatial_flow.core as core
+from spatial_flow.ordering import get_ordering
+from spatial_flow.statistics import Pointer_Statistics
+from spatial_flow.patch import Reference_Patch
+from spatial_flow.numpy_reference import hash_seed, hash_rows
 
 """
 
@@ -54,6 +60,37 @@ class Reference:
     The property "identity" identifies the spatial
     grid locations. It, again, cannot be modified.
 
+    The property "valid" is a per-pointer mask. Pointers which are
+    not valid have been pruned, and are compacted out of the packed
+    index lists ("packed_sources", "packed_segments", "packed_slots")
+    which are rebuilt whenever the reference or the mask changes.
+
+    The property "ordering" names the ordering of the flattened spatial
+    axis. Every flattened spatial index the reference produces, linear or
+    packed, is a position along that ordering, and packed pointers are sorted
+    by the position of the location they belong to.
+
+    The property "statistics" holds vectorized statistics over the pointers,
+    such as fan in, fan out, and reach. They are computed on first access,
+    then brought up to date incrementally whenever the reference changes.
+
+    The property "version" increases every time the reference, its validity, or its
+    mutability actually changes, and "location_versions" records the version at which
+    each spatial location last changed. Anything caching data derived from the reference
+    should remember the version it was built at, then use "dirty" or "dirty_regions"
+    to find exactly what has changed since.
+
+    The absolute, linear, gather, and packed pointers are held in variables, which
+    are assigned in place whenever the reference changes. A compiled graph reading
+    them therefore always sees the current topology, without retracing. The packed
+    variables have an unknown length, so pruning pointers does not retrace either.
+    Assignments are not atomic across variables, so changes should be made between
+    calls, such as at step boundaries, and not while a graph using them runs.
+
+    To ship a small change elsewhere, "diff" records just the changed pointers
+    as a patch, with a compact binary encoding, and "apply_patch" scatters them
+    into another reference.
+
     Under standard conditions, one should use the "update" method to make
     changes and the "unpack" method to make selections.
     """
@@ -85,15 +122,19 @@ class Reference:
         self.reference_shape, value.shape)
         msg_int_err = "Expected 'reference' to be int tensor. Instead found %s" % value.dtype
 
-        tf.debugging.assert_shapes([(value, self.reference_shape)], message=msg_shape_err)
-        tf.debugging.assert_integer(value, message=msg_int_err)
+        error.assert_shapes([(value, self.reference_shape)], message=msg_shape_err)
+        error.assert_integer(value, message=msg_int_err)
 
-        # set the relative reference
+        # set the relative reference, noting which locations changed
 
+        changed = tf.reduce_any(tf.not_equal(self._relative_reference, tf.cast(value, self._relative_reference.dtype)),
+                                axis=list(range(self.spatial_shape.rank, self.reference_shape.rank)))
         self._relative_reference.assign(value)
 
         # set the true reference
-        self._reference = self.__build_reference()
+        self.__store("_reference", self.__build_reference())
+        self.__build_packed()
+        self.__mark(changed)
 
     @property
     def identity(self):
@@ -101,7 +142,7 @@ class Reference:
 
     @property
     def mutable(self):
-        return self._mutable
+        return tf.identity(self._mutable)
 
     @mutable.setter
     def mutable(self, value):
@@ -112,24 +153,134 @@ class Reference:
         :return:
         """
 
-        tf.debugging.assert_shapes([(value, self.spatial_shape)],
+        error.assert_shapes([(value, self.spatial_shape)],
                                    message="Expected mutable to be shape of spatial dimensions")
-        tf.debugging.assert_integer(value, message="Expected mutable to be int")
-        tf.debugging.assert_greater_equal(value, -1,
+        error.assert_integer(value, message="Expected mutable to be int")
+        error.assert_greater_equal(value, -1,
                                           message="Expected mutable to be greater than or equal to negative 1")
-        tf.debugging.assert_less_equal(value, 1, "Expected mutable to be less than or equal to 1")
+        error.assert_less_equal(value, 1, "Expected mutable to be less than or equal to 1")
+
+        # Update mutable. Ones become true, negative ones false, and zeros are kept
+
+        mutable = tf.where(tf.equal(value, 1), True, tf.where(tf.equal(value, -1), False, self._mutable))
+        changed = tf.not_equal(self._mutable, mutable)
+        self._mutable.assign(mutable)
+        self.__mark(changed)
+
+    @property
+    def valid(self):
+        return tf.identity(self._valid)
 
-        # Update mutable. Do this by finding true pushes, false pushes, and applying them
+    @valid.setter
+    def valid(self, value):
+        """
+        Setter for valid. Expects a bool tensor with one entry per pointer,
+        false meaning the pointer is pruned.
 
-        mutable_now_true = tf.where(tf.equal(value, 1))
-        mutable_now_false = tf.where(tf.equal(value, -1))
+        :param value:
+        :return:
+        """
+
+        if not isinstance(value, tf.Tensor):
+            raise TypeError("Expected 'valid' to be of type tf.Tensor. Instead was %s" % type(value))
+        error.assert_shapes([(value, self.valid_shape)],
+                                   message="Expected valid to be shape of spatial and comparison dimensions")
+        error.assert_type(value, tf.dtypes.bool, message="Expected valid to be bool")
+
+        changed = self.__valid_changes(value)
+        self._valid.assign(value)
+        self.__build_packed()
+        self.__mark(changed)
+
+    # version properties. These allow caches to find what has changed.
+    @property
+    def version(self):
+        """
 
-        if mutable_now_true.shape[0] > 0:
-            self._mutable = tf.tensor_scatter_nd_update(self._mutable, mutable_now_true,
-                                                        [True] * mutable_now_true.shape[0])
-        if mutable_now_false.shape[0] > 0:
-            self._mutable = tf.tensor_scatter_nd_update(self._mutable, mutable_now_false,
-                                                        [False] * mutable_now_false.shape[0])
+        Increases whenever the reference, its validity, or its mutability changes. The count
+        is held in a variable, so changes made within a compiled graph are counted, and this
+        returns its current value as an int.
+        """
+        with tf.init_scope():
+            return int(self._version.numpy())
+
+    @property
+    def location_versions(self):
+        """ The version at which each spatial location last changed, in spatial shape """
+        return tf.identity(self._location_versions)
+
+    def dirty(self, since):
+        """
+
+        Find the locations which have changed.
+
+        :param since: A version, such as the one a cache was built at
+        :return: A bool tensor of spatial shape, true where the location changed after that version
+        """
+        return tf.greater(self._location_versions, since)
+
+    def dirty_regions(self, since, region_shape):
+        """
+
+        Find the regions which have changed. The spatial grid is cut into blocks
+        of region_shape, with blocks on the far edges truncated where needed.
+
+        :param since: A version, such as the one a cache was built at
+        :param region_shape: A 1D list, with the size of a region along each spatial dimension
+        :return: A bool tensor with one entry per region, true where any location within changed
+        """
+        if len(region_shape) != self.spatial_shape.rank:
+            raise ValueError("Expected region_shape to have one entry per spatial dimension")
+        spatial = self.spatial_shape.as_list()
+        counts = [-(-size // region) for size, region in zip(spatial, region_shape)]
+        padding = [[0, count * region - size] for count, region, size in zip(counts, region_shape, spatial)]
+        dirty = tf.pad(self.dirty(since), padding)
+        blocked = tf.reshape(dirty, [item for pair in zip(counts, region_shape) for item in pair])
+        return tf.reduce_any(blocked, axis=list(range(1, 2 * len(counts), 2)))
+
+    def __valid_changes(self, value):
+        # The locations at which validity would change were value stored
+        comparison_axes = list(range(self.spatial_shape.rank, self.valid_shape.rank))
+        return tf.reduce_any(tf.not_equal(self._valid, value), axis=comparison_axes)
+
+    def __mark(self, changed):
+        # Bump the version and mark the changed locations, if anything changed.
+        # Held in variables, so this also works within a compiled graph.
+
+        version = self._version.assign_add(tf.cast(tf.reduce_any(changed), tf.dtypes.int64))
+        self._location_versions.assign(tf.where(changed, version, self._location_versions))
+
+    # packed properties. These exclude invalid pointers entirely.
+    @property
+    def linear_reference(self):
+        """ Returns the reference with each pointer flattened into a single spatial index """
+        return self._linear_reference
+
+    @property
+    def packed_sources(self):
+        """ The flattened spatial location each valid pointer reads from """
+        return self._packed_sources
+
+    @property
+    def packed_segments(self):
+        """ The flattened spatial location each valid pointer belongs to """
+        return self._packed_segments
+
+    @property
+    def packed_slots(self):
+        """ The flattened comparison slot each valid pointer occupies """
+        return self._packed_slots
+
+    @property
+    def packed_positions(self):
+        """ The position of each valid pointer in the flattened spatial-comparison grid """
+        return self._packed_positions
+
+    @property
+    def num_valid(self):
+        """ The number of valid pointers. A tensor within a compiled graph, else an int. """
+        count = tf.shape(self._packed_positions)[0]
+        return int(count) if tf.executing_eagerly() else count
 
     # config properties
     @property
@@ -148,11 +299,67 @@ class Reference:
     def reference_shape(self):
         return self._reference_shape
 
+    @property
+    def valid_shape(self):
+        return self._valid_shape
+
+    @property
+    def ordering(self):
+        return self._ordering.name
+
+    @property
+    def gather_reference(self):
+        """ The linear reference, with locations flattened in ordering order. Shape [spatial, comparison...] """
+        return self._gather_reference
+
+    @property
+    def statistics(self):
+        """ The Pointer_Statistics of this reference, brought up to date on access """
+        with tf.init_scope():
+            if self._statistics is None:
+                self._statistics = Pointer_Statistics(self)
+            elif self._statistics.version != self.version:
+                rows = tf.where(tf.reshape(self.dirty(self._statistics.version), [-1]))[:, 0]
+                self._statistics.refresh(rows)
+        return self._statistics
+
+    @property
+    def content_hash(self):
+        """
+
+        A 64 bit hash of the relative reference, validity, and mutability, as an int.
+        References with the same shapes and contents share a hash, whatever their
+        history. Each location is hashed separately and the results are summed, so on
+        access only the locations changed since the last access are rehashed.
+        """
+        with tf.init_scope(), np.errstate(over="ignore"):
+            if self._hash is None:
+                rows = np.arange(self.spatial_size)
+                hashes = self.__hash_rows(rows)
+                seed = hash_seed(self.spatial_shape.as_list(), self.comparison_shape.as_list())
+                self._hash = [self.version, hashes, seed + np.sum(hashes, dtype=np.uint64)]
+            elif self._hash[0] != self.version:
+                version, hashes, total = self._hash
+                rows = tf.where(tf.reshape(self.dirty(version), [-1]))[:, 0].numpy()
+                fresh = self.__hash_rows(rows)
+                total = total - np.sum(hashes[rows], dtype=np.uint64) + np.sum(fresh, dtype=np.uint64)
+                hashes[rows] = fresh
+                self._hash = [self.version, hashes, total]
+        return int(self._hash[2])
+
+    @property
+    def spatial_size(self):
+        return self._spatial_size
+
+    @property
+    def comparison_size(self):
+        return self._comparison_size
+
     def __mesh(self, shape, dtype=tf.dtypes.int32):
 
-        tf.debugging.assert_integer(shape)
-        tf.debugging.assert_rank(shape, 1)
-        tf.debugging.assert_greater_equal(shape, 1)
+        error.assert_integer(shape)
+        error.assert_rank(shape, 1)
+        error.assert_greater_equal(shape, 1)
         # This function makes a meshgrid for a given shape
 
         # Build meshgrid spatial creation instructions, then build meshgrid list
@@ -166,9 +373,9 @@ class Reference:
     def __verify(self, value, name):
 
         """ Perform verification """
-        tf.debugging.assert_rank(value, 1, message="%s rank was not 1" % name)
-        tf.debugging.assert_integer(value, message="%s expected to be int, was not")
-        tf.debugging.assert_greater_equal(value, 1,
+        error.assert_rank(value, 1, message="%s rank was not 1" % name)
+        error.assert_integer(value, message="%s expected to be int, was not")
+        error.assert_greater_equal(value, 1,
                                           message="All of %s expected to be greater then or equal to one, was not")
         return value
 
@@ -186,7 +393,133 @@ class Reference:
         output = tf.transpose(modulo_form, permute)
         return output
 
-    def __init__(self, spatial_shape, comparison_shape):
+    def __linearize(self, pointers):
+        # Flatten the index dimension of a block of pointers into
+        # a single spatial index along the ordering.
+
+        return self._ordering.linearize(pointers)
+
+    def __build_packed(self):
+        # Build the linearized reference, then compact away every
+        # pointer which is not valid, keeping track of where each
+        # survivor came from.
+
+        linear = self.__linearize(self.reference)
+        self.__store("_linear_reference", linear)
+
+        flat_shape = [self.spatial_size, *self.comparison_shape]
+        if self._ordering.is_row_major:
+            self.__store("_gather_reference", tf.reshape(linear, flat_shape))
+        else:
+            self.__store("_gather_reference", tf.gather(tf.reshape(linear, flat_shape), self._ordering.inverse))
+
+        flat_linear = tf.reshape(linear, [-1])
+        flat_valid = tf.reshape(self._valid, [-1])
+        positions = tf.cast(tf.where(flat_valid)[:, 0], tf.dtypes.int32)
+        segments = tf.math.floordiv(positions, self.comparison_size)
+        slots = tf.math.floormod(positions, self.comparison_size)
+
+        # Under a curve ordering, walk the pointers in curve order, so
+        # that the gather streams along the curve.
+        if not self._ordering.is_row_major:
+            segments = tf.gather(self._ordering.forward, segments)
+            order = tf.argsort(segments * self.comparison_size + slots, stable=True)
+            positions = tf.gather(positions, order)
+            segments = tf.gather(segments, order)
+            slots = tf.gather(slots, order)
+
+        self.__store("_packed_positions", positions, dynamic=True)
+        self.__store("_packed_sources", tf.gather(flat_linear, positions), dynamic=True)
+        self.__store("_packed_segments", segments, dynamic=True)
+        self.__store("_packed_slots", slots, dynamic=True)
+        self._packed_index = None
+
+    def __get_packed_index(self):
+        # For every pointer, row major over [spatial, comparison], its position
+        # within the packed lists, or -1 if it is not valid. Only depends on
+        # validity, so it is built lazily and dropped when validity changes.
+
+        size = self.spatial_size * self.comparison_size
+        build = lambda: tf.tensor_scatter_nd_update(tf.fill([size], -1),
+                                                    tf.reshape(self._packed_positions, [-1, 1]),
+                                                    tf.range(tf.size(self._packed_positions)))
+        if not tf.executing_eagerly():
+            # Validity may change between calls of a compiled graph, so nothing is cached there
+            return build()
+        if self._packed_index is None:
+            self._packed_index = build()
+        return self._packed_index
+
+    def __scatter_pointers(self, pointers, positions, offsets):
+        # Bring the derived pointers of just the given entries up to date, in place.
+        # Validity must not have changed, so the packed layout still holds.
+
+        rank = self.spatial_shape.rank
+        coordinates = tf.cast(pointers[:, :rank], offsets.dtype)
+        absolute = tf.math.floormod(coordinates + offsets, self.spatial_shape.as_list())
+        linear = self.__linearize(absolute)
+        self._reference.scatter_nd_update(pointers, absolute)
+        self._linear_reference.scatter_nd_update(pointers, linear)
+
+        # The gather reference is flattened in ordering order
+        rows = tf.cast(self.__linearize(coordinates), tf.dtypes.int64)
+        self._gather_reference.scatter_nd_update(tf.concat([rows[:, None], pointers[:, rank:]], axis=-1), linear)
+
+        packed = tf.gather(self.__get_packed_index(), positions)
+        keep = tf.greater_equal(packed, 0)
+        self._packed_sources.scatter_nd_update(tf.boolean_mask(packed, keep)[:, None], tf.boolean_mask(linear, keep))
+
+    def __store(self, name, value, dynamic=False):
+        # Pointers live in variables, assigned in place, so that compiled
+        # graphs reading them pick up changes without retracing. Dynamic
+        # variables may change length.
+
+        variable = getattr(self, name, None)
+        if variable is None:
+            shape = tf.TensorShape([None] * value.shape.rank) if dynamic else value.shape
+            with tf.init_scope():
+                setattr(self, name, tf.Variable(value, shape=shape, trainable=False))
+        else:
+            variable.assign(value)
+
+
+    def __hash_rows(self, rows):
+        # The hash of each given row major location
+
+        indices = tf.constant(rows, dtype=tf.dtypes.int64)
+        relative = tf.gather(tf.reshape(self._relative_reference, [self.spatial_size, -1]), indices)
+        valid = tf.gather(tf.reshape(self._valid, [self.spatial_size, -1]), indices)
+        mutable = tf.gather(tf.reshape(self._mutable, [self.spatial_size]), indices)
+        return hash_rows(rows, relative.numpy(), valid.numpy(), mutable.numpy())
+
+    def __build_adjacency(self):
+        # Work out the sparse structure of the adjacency matrix. Duplicate
+        # pointers within a neuron land on the same matrix entry, so
+        # each packed pointer is mapped onto its merged entry.
+
+        rows = tf.cast(self.packed_segments, tf.dtypes.int64)
+        cols = tf.cast(self.packed_sources, tf.dtypes.int64)
+        keys = rows * self.spatial_size + cols
+        unique_keys, merge_map = tf.unique(keys, out_idx=tf.dtypes.int32)
+
+        # Sort so the result is in canonical row major order.
+        order = tf.argsort(unique_keys)
+        unique_keys = tf.gather(unique_keys, order)
+        merge_map = tf.gather(tf.math.invert_permutation(order), merge_map)
+
+        indices = tf.stack([tf.math.floordiv(unique_keys, self.spatial_size),
+                            tf.math.floormod(unique_keys, self.spatial_size)], axis=-1)
+        self._adjacency = (self.version, indices, merge_map)
+
+    def __init__(self, spatial_shape, comparison_shape, ordering="row_major", snapshot=None):
+        """
+
+        :param spatial_shape: A 1D list, with the size of each spatial dimension
+        :param comparison_shape: A 1D list, with the number of pointers along each comparison dimension
+        :param ordering: The ordering of the flattened spatial axis. See ordering.py
+        :param snapshot: None, or a snapshot to start from. The derived pointers are then
+            built once, from the snapshot, rather than built and rebuilt by restore.
+        """
 
         self._spatial_shape = tf.TensorShape(self.__verify(spatial_shape, "spatial_shape"))
         self._comparison_shape = tf.TensorShape(self.__verify(comparison_shape, "comparison_shape"))
@@ -194,6 +527,10 @@ class Reference:
 
         self._index_shape = tf.TensorShape([self.spatial_shape.rank])
         self._reference_shape = tf.TensorShape([*self.spatial_shape, *self.comparison_shape, *self._index_shape])
+        self._valid_shape = tf.TensorShape([*self.spatial_shape, *self.comparison_shape])
+        self._spatial_size = self.spatial_shape.num_elements()
+        self._comparison_size = self.comparison_shape.num_elements()
+        self._ordering = get_ordering(tuple(self.spatial_shape.as_list()), ordering)
 
         # set up internal flatten numbers
 
@@ -204,8 +541,267 @@ class Reference:
 
         self._identity = self.__mesh(self.spatial_shape)
         self._relative_reference = tf.Variable(tf.zeros(self.reference_shape, tf.dtypes.int32))
-        self._mutable = tf.fill(self.spatial_shape, True)
-        self._reference = self.__build_reference()
+        mutable = tf.fill(self.spatial_shape, True)
+        valid = tf.fill(self.valid_shape, True)
+        if snapshot is not None:
+            relative, mutable, valid = self.__check_snapshot(snapshot)
+            self._relative_reference.assign(relative)
+        self.__store("_mutable", mutable)
+        self.__store("_valid", valid)
+        self.__store("_version", tf.constant(0, tf.dtypes.int64))
+        self.__store("_location_versions", tf.zeros(self.spatial_shape, tf.dtypes.int64))
+        self._statistics = None
+        self._hash = None
+        self._adjacency = None
+        self._unique = {}
+        self._inverse = {}
+        self.__store("_reference", self.__build_reference())
+        self.__build_packed()
+    def snapshot(self):
+        """
+
+        Captures the complete mutable state of the reference.
+
+        :return: A dict with entries "relative_reference", "mutable", and "valid"
+        """
+        return {"relative_reference": tf.identity(self._relative_reference),
+                "mutable": tf.identity(self._mutable),
+                "valid": tf.identity(self._valid)}
+
+    def __check_snapshot(self, snapshot):
+        # The entries of a snapshot, checked against this reference's shapes
+
+        relative = snapshot["relative_reference"]
+        mutable = snapshot["mutable"]
+        valid = snapshot["valid"]
+        error.assert_shapes([(relative, self.reference_shape), (mutable, self.spatial_shape), (valid, self.valid_shape)],
+                            message="Expected a snapshot of a reference with the same shapes")
+        error.assert_integer(relative, message="Expected relative_reference to be int")
+        error.assert_type(mutable, tf.dtypes.bool, message="Expected mutable to be bool")
+        error.assert_type(valid, tf.dtypes.bool, message="Expected valid to be bool")
+        return tf.cast(relative, self._relative_reference.dtype), mutable, valid
+
+    def restore(self, snapshot):
+        """
+
+        Replaces the relative reference, mutability, and validity all at once,
+        rebuilding the derived pointers a single time. The version increases
+        once, if anything changed.
+
+        :param snapshot: A dict as returned by snapshot
+        """
+        relative, mutable, valid = self.__check_snapshot(snapshot)
+
+        relative_axes = list(range(self.spatial_shape.rank, self.reference_shape.rank))
+        changed = tf.reduce_any(tf.not_equal(self._relative_reference, relative), axis=relative_axes)
+        changed = tf.logical_or(changed, self.__valid_changes(valid))
+        changed = tf.logical_or(changed, tf.not_equal(self._mutable, mutable))
+
+        self._relative_reference.assign(relative)
+        self._mutable.assign(mutable)
+        self._valid.assign(valid)
+        self.__store("_reference", self.__build_reference())
+        self.__build_packed()
+        self.__mark(changed)
+
+    def copy(self):
+        """ An independent reference with the same configuration and state """
+        duplicate = Reference(self.spatial_shape.as_list(), self.comparison_shape.as_list(), ordering=self.ordering)
+        duplicate.restore(self.snapshot())
+        return duplicate
+
+    def diff(self, other):
+        """
+
+        Find the changes between another reference and this one.
+
+        :param other: A reference with the same shapes, or a snapshot of one
+        :return: A Reference_Patch which, when applied to other, makes it equal to this reference
+        """
+        if isinstance(other, Reference):
+            other = other.snapshot()
+        if not isinstance(other, dict):
+            raise TypeError("Expected 'other' to be a Reference or snapshot. Instead was %s" % type(other))
+        relative = other["relative_reference"]
+        mutable = other["mutable"]
+        valid = other["valid"]
+        error.assert_shapes([(relative, self.reference_shape), (mutable, self.spatial_shape), (valid, self.valid_shape)],
+                            message="Expected a reference with the same shapes")
+
+        # Every pointer whose offset or validity differs
+        changed = tf.reduce_any(tf.not_equal(self._relative_reference, tf.cast(relative, self._relative_reference.dtype)),
+                                axis=-1)
+        changed = tf.logical_or(changed, tf.not_equal(self._valid, valid))
+        pointers = tf.where(changed)
+        mutable_indices = tf.where(tf.not_equal(self._mutable, mutable))
+
+        rank = self.spatial_shape.rank
+        spatial_strides = tf.math.cumprod(self.spatial_shape.as_list(), exclusive=True, reverse=True)
+        comparison_strides = tf.math.cumprod(self.comparison_shape.as_list(), exclusive=True, reverse=True)
+        ravel = lambda indices, strides: tf.reduce_sum(indices * tf.cast(strides, indices.dtype), axis=-1).numpy()
+        return Reference_Patch(self.spatial_shape.as_list(),
+                               self.comparison_shape.as_list(),
+                               ravel(pointers[:, :rank], spatial_strides),
+                               ravel(pointers[:, rank:], comparison_strides),
+                               tf.gather_nd(self._relative_reference, pointers).numpy(),
+                               tf.gather_nd(self._valid, pointers).numpy(),
+                               ravel(mutable_indices, spatial_strides),
+                               tf.gather_nd(self._mutable, mutable_indices).numpy())
+
+    def apply_patch(self, patch):
+        """
+
+        Applies a patch, as made by diff. Only the entries listed in the patch are
+        scattered, so the cost scales with the size of the patch. Should validity change,
+        the packed pointers are rebuilt once. The version increases once, if anything changed.
+
+        :param patch: A Reference_Patch, or its binary encoding
+        """
+        if isinstance(patch, (bytes, bytearray, memoryview)):
+            patch = Reference_Patch.from_bytes(patch)
+        if not isinstance(patch, Reference_Patch):
+            raise TypeError("Expected 'patch' to be of type Reference_Patch. Instead was %s" % type(patch))
+        if patch.spatial_shape != self.spatial_shape.as_list() or patch.comparison_shape != self.comparison_shape.as_list():
+            raise ValueError("Expected a patch of a reference with spatial shape %s and comparison shape %s, got %s and %s"
+                             % (self.spatial_shape, self.comparison_shape, patch.spatial_shape, patch.comparison_shape))
+        if patch.empty:
+            return self
+
+        rank = self.spatial_shape.rank
+        pointers = tf.constant(patch.pointer_indices(), dtype=tf.dtypes.int64)
+        positions = tf.constant(patch.locations * self.comparison_size + patch.slots, dtype=tf.dtypes.int64)
+        offsets = tf.constant(patch.offsets, dtype=self._relative_reference.dtype)
+        valid = tf.constant(patch.valid)
+        mutable_indices = tf.constant(patch.mutable_indices(), dtype=tf.dtypes.int64)
+        mutable = tf.constant(patch.mutable)
+
+        # Work out which entries actually differ, so only real changes are marked
+        offsets_differ = tf.reduce_any(tf.not_equal(tf.gather_nd(self._relative_reference, pointers), offsets), axis=-1)
+        valid_differs = tf.not_equal(tf.gather_nd(self._valid, pointers), valid)
+        mutable_differs = tf.not_equal(tf.gather_nd(self._mutable, mutable_indices), mutable)
+        changed = tf.concat([tf.boolean_mask(pointers[:, :rank], tf.logical_or(offsets_differ, valid_differs)),
+                             tf.boolean_mask(mutable_indices, mutable_differs)], axis=0)
+        changed = tf.scatter_nd(changed, tf.ones(tf.shape(changed)[:1], tf.dtypes.int32), self.spatial_shape) > 0
+
+        def rebuild():
+            self._valid.scatter_nd_update(pointers, valid)
+            self.__store("_reference", self.__build_reference())
+            self.__build_packed()
+
+        def scatter():
+            tf.cond(tf.reduce_any(offsets_differ),
+                    lambda: self.__scatter_pointers(pointers, positions, offsets),
+                    lambda: None)
+
+        # Branch in the graph, not in python, so patches may be applied within a compiled graph
+        if patch.size > 0:
+            self._relative_reference.scatter_nd_update(pointers, offsets)
+            tf.cond(tf.reduce_any(valid_differs), rebuild, scatter)
+        if len(patch.mutable_locations) > 0:
+            self._mutable.scatter_nd_update(mutable_indices, mutable)
+        self.__mark(changed)
+        return self
+
+    def to_sparse_adjacency(self, weights=None, dtype=tf.dtypes.float32):
+        """
+
+        Exports the reference as a sparse adjacency matrix of shape
+        [prod(spatial), prod(spatial)]. Row i column j holds the summed weight of
+        every valid pointer on spatial location i which reads from spatial location j.
+
+        The sparse structure is cached, and is only rebuilt when the version changes.
+
+        :param weights: None, or a tensor of shape [spatial..., comparison...] holding
+            one weight per pointer. None gives every pointer a weight of one.
+        :param dtype: The dtype of the matrix values
+        :return: A tf.sparse.SparseTensor
+        """
+        if self._adjacency is None or self._adjacency[0] != self.version:
+            # Lift out of any graph being traced, so the cache does not hold graph tensors
+            with tf.init_scope():
+                self.__build_adjacency()
+        _, indices, merge_map = self._adjacency
+
+        if weights is None:
+            values = tf.ones_like(self.packed_positions, dtype=dtype)
+        else:
+            error.assert_shapes([(weights, self.valid_shape)],
+                                       message="Expected weights to be shape of spatial and comparison dimensions")
+            values = tf.gather(tf.reshape(tf.cast(weights, dtype), [-1]), self.packed_positions)
+        values = tf.math.unsorted_segment_sum(values, merge_map, tf.shape(indices)[0])
+
+        dense_shape = [self.spatial_size, self.spatial_size]
+        return tf.sparse.SparseTensor(indices, values, dense_shape)
+
+    def unique_pointers(self, scope="neuron"):
+        """
+
+        Finds the distinct sources read by the valid pointers, so that each
+        need only be gathered once. Mutation often leaves a neuron reading
+        the same source several times.
+
+        Under the "neuron" scope, pointers are merged when they belong to the same
+        location and read the same source. Under the "global" scope, pointers are merged
+        whenever they read the same source, wherever they belong.
+
+        The result is cached, and is only rebuilt when the version changes.
+
+        :param scope: Either "neuron" or "global"
+        :return: A tuple of (sources, segments, merge_map). sources holds the flattened location
+            read by each distinct entry, and merge_map maps each packed pointer onto its entry.
+            segments holds the location each entry belongs to under the "neuron" scope, and is
+            None under the "global" scope.
+        """
+        if scope not in ("neuron", "global"):
+            raise ValueError("Expected scope to be 'neuron' or 'global'. Instead was %s" % scope)
+        if scope not in self._unique or self._unique[scope][0] != self.version:
+            # Lift out of any graph being traced, so the cache does not hold graph tensors
+            with tf.init_scope():
+                if scope == "neuron":
+                    if self._adjacency is None or self._adjacency[0] != self.version:
+                        self.__build_adjacency()
+                    _, indices, merge_map = self._adjacency
+                    self._unique[scope] = (self.version,
+                                           tf.cast(indices[:, 1], tf.dtypes.int32),
+                                           tf.cast(indices[:, 0], tf.dtypes.int32),
+                                           merge_map)
+                else:
+                    sources, merge_map = tf.unique(self.packed_sources, out_idx=tf.dtypes.int32)
+                    self._unique[scope] = (self.version, sources, None, merge_map)
+        return self._unique[scope][1:]
+
+    def inverse_index(self, packed=True):
+        """
+
+        Builds the inverse of the reference: for each spatial location, every pointer
+        which reads from it. The result is in CSR form, and is what allows the gradient
+        of a selection to be a single sorted segment sum rather than a contended scatter.
+
+        The index is cached, and is only rebuilt when the version changes.
+
+        :param packed: If true, index the packed pointers. Else, index the pointers of
+            the flattened gather reference, valid or not.
+        :return: A tuple of (readers, row_splits, segment_ids). readers lists pointer positions
+            grouped by the location they read, with the readers of location i found at
+            readers[row_splits[i]:row_splits[i+1]]. segment_ids holds the location each entry
+            of readers reads, and so is sorted.
+        """
+        key = "packed" if packed else "dense"
+        if key not in self._inverse or self._inverse[key][0] != self.version:
+            # Lift out of any graph being traced, so the cache does not hold graph tensors
+            with tf.init_scope():
+                if packed:
+                    sources = self.packed_sources
+                else:
+                    sources = tf.reshape(self.gather_reference, [-1])
+                readers = tf.argsort(sources, stable=True)
+                segment_ids = tf.gather(sources, readers)
+                counts = tf.math.bincount(sources, minlength=self.spatial_size, maxlength=self.spatial_size)
+                row_splits = tf.concat([[0], tf.math.cumsum(counts)], axis=0)
+                self._inverse[key] = (self.version, readers, row_splits, segment_ids)
+        return self._inverse[key][1:]
+
+    @instrument("Reference.update")
     def update(self, callback):
         """"
 
@@ -217,6 +813,9 @@ class Reference:
         return a dict with entries "reference" and "mutable". "reference"  must be a tensor of comparison-reference type, and "mutable" can
         be "True" or "False", with True allowing further changes and false preventing them.\
 
+        The dict may optionally contain the entry "valid", a bool tensor of comparison shape. Pointers marked
+        false are pruned, and will be compacted out of packed selection. If omitted, validity is unchanged.
+
         Callback should return the relative position to a nearby spatial position of interest.
 
         :param callback: A function which
@@ -227,7 +826,7 @@ class Reference:
             raise TypeError("Reference - unpack_reference: callback was not a function")
         shape = self.comparison_shape.concatenate(self.index_shape)
 
-        def callback_wrapper(unpacked, spatial_index):
+        def callback_wrapper(unpacked, spatial_index, valid):
 
             # Test if user code even runs. If not, raise reason.
             try:
@@ -249,15 +848,23 @@ class Reference:
 
 
             #Assert sane entries.
-            tf.debugging.assert_shapes([(output["reference"], shape)],
+            error.assert_shapes([(output["reference"], shape)],
                                        message="Error in user callback function. Return was not " +
                                                "of shape %s or None" % shape)
-            tf.debugging.assert_type(output["reference"],
+            error.assert_type(output["reference"],
                                      unpacked.dtype,
                                      message="Error in user callback function. " +
                                              "Return was of dtype %s but reference was of dtype %s"
                                              % (output["reference"].dtype, unpacked.dtype))
-            tf.debugging.assert_type(output["mutable"], tf.dtypes.bool, "Error in user callback function, mutable not bool")
+            error.assert_type(output["mutable"], tf.dtypes.bool, "Error in user callback function, mutable not bool")
+
+            #Fill in, or check, validity
+            if "valid" not in output.keys() or output["valid"] is None:
+                output = {**output, "valid" : valid}
+            error.assert_shapes([(output["valid"], self.comparison_shape)],
+                                       message="Error in user callback function. Valid was not " +
+                                               "of shape %s" % self.comparison_shape)
+            error.assert_type(output["valid"], tf.dtypes.bool, "Error in user callback function, valid not bool")
             #Return result
             return output
 
@@ -265,25 +872,34 @@ class Reference:
 
         reshaped_ref = tf.reshape(self.relative_reference, self._flatten_spatial)
         reshaped_identity = tf.reshape(self.identity, self._flatten_identity)
+        reshaped_valid = tf.reshape(self._valid, [-1, *self.comparison_shape])
         reshaped_mut = tf.reshape(self._mutable, [-1])
         excluded_ref = tf.boolean_mask(reshaped_ref, reshaped_mut)
         excluded_identity = tf.boolean_mask(reshaped_identity, reshaped_mut)
+        excluded_valid = tf.boolean_mask(reshaped_valid, reshaped_mut)
         #run map
         output_sig = {"reference" : tf.TensorSpec(shape, self.reference.dtype),
-                      "mutable" : tf.TensorSpec(None, tf.dtypes.bool) }
-        map_func = lambda index : callback_wrapper(excluded_ref[index], excluded_identity[index])
+                      "mutable" : tf.TensorSpec(None, tf.dtypes.bool),
+                      "valid" : tf.TensorSpec(self.comparison_shape, tf.dtypes.bool)}
+        map_func = lambda index : callback_wrapper(excluded_ref[index], excluded_identity[index], excluded_valid[index])
         map_range = tf.range(0, excluded_ref.shape[0])
         map_ref = tf.map_fn(map_func, map_range, fn_output_signature=output_sig)
         mutables = map_ref["mutable"]
         references = map_ref["reference"]
-
-        #update references
-        restored_ref = tf.tensor_scatter_nd_update(reshaped_ref, tf.where(reshaped_mut), references)
-        restored_mut = tf.where(tf.tensor_scatter_nd_update(reshaped_mut, tf.where(reshaped_mut), mutables), 0, -1)
-        self.relative_reference = tf.reshape(restored_ref, self.reference_shape)
-        self.mutable = tf.reshape(restored_mut, self.spatial_shape)
+        valids = map_ref["valid"]
+
+        #update references. Everything is stored at once, so the packed
+        #lists are rebuilt, and the version bumped, a single time.
+        where_mutable = tf.where(reshaped_mut)
+        restored_ref = tf.tensor_scatter_nd_update(reshaped_ref, where_mutable, references)
+        restored_mut = tf.tensor_scatter_nd_update(reshaped_mut, where_mutable, mutables)
+        restored_valid = tf.tensor_scatter_nd_update(reshaped_valid, where_mutable, valids)
+        self.restore({"relative_reference": tf.reshape(restored_ref, self.reference_shape),
+                      "mutable": tf.reshape(restored_mut, self.spatial_shape),
+                      "valid": tf.reshape(restored_valid, self.valid_shape)})
 
         return self
+    @instrument("Reference.unpack")
     def unpack(self, callback, shape, dtype=tf.dtypes.float32):
         """
 
@@ -324,10 +940,10 @@ class Reference:
                 raise TypeError(
                     "Error in user callback function - return was not none or tensor, but %s" % type(output))
             tf.print(output)
-            tf.debugging.assert_shapes([(output, shape)],
+            error.assert_shapes([(output, shape)],
                                        message="Error in user callback function. Return was not " +
                                                "of shape %s or None" % shape)
-            tf.debugging.assert_type(output,
+            error.assert_type(output,
                                      dtype,
                                      message="Error in user callback function. " +
                                              "Return was of dtype %s but reference was of dtype %s"
@@ -380,9 +996,10 @@ class Reference_Op():
         #perform basic sanity checking
         if not isinstance(output, (list, tuple)):
             raise TypeError("Reference_Op - error in modify - Expected return of list or tuple")
-        if len(output) != 2:
-            raise ValueError("Referenoce_Op - error in modify - list length was not 2")
-
+        if len(output) not in (2, 3):
+            raise ValueError("Referenoce_Op - error in modify - list length was not 2 or 3")
+        if len(output) == 3:
+            return {"reference" : output[0], "mutable" : output[1], "valid" : output[2]}
         return {"reference" : output[0], "mutable" : output[1]}
 
 
@@ -399,6 +1016,9 @@ class Reference_Op():
         Modify is then expected to return a list containing the new relative comparison_indices
         and a bool in the second entry. True means it remains mutable, false means it does not.
 
+        Optionally, a third entry may be returned. This is a bool tensor of comparison shape
+        marking which pointers remain valid; false prunes the pointer from packed selection.
+
         :param comparison_indices: the unpacked comparison indices
         :param spatial_index: The location of the comparison_indices on the spatial grid
         :return a list containing first the tensor and second the mutability bool.
@@ -429,8 +1049,8 @@ def spatial_kernel(reference, kernel_delta=1, kernel_bias=0, justification="cent
 
         # perform standard validation
 
-        tf.debugging.assert_integer(input, "Input %s was not int" % input_name)
-        tf.debugging.assert_rank_in(input, [0, 1], "Input of %s did not have rank 0 or 1" % input_name)
+        error.assert_integer(input, "Input %s was not int" % input_name)
+        error.assert_rank_in(input, [0, 1], "Input of %s did not have rank 0 or 1" % input_name)
         # input = tf.cast(input, dtype=tf.dtypes.int32)
 
         # broadcast if needed
@@ -444,7 +1064,7 @@ def spatial_kernel(reference, kernel_delta=1, kernel_bias=0, justification="cent
         # finally, do threshold evaluation if requested
 
         if (threshold != None):
-            tf.debugging.assert_greater_equal(input, threshold,
+            error.assert_greater_equal(input, threshold,
                                               "Expected %s to be greater than or equal to %s, was not"
                                               % (input_name, threshold))
         return input
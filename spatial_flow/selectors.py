@@ -1,8 +1,13 @@
+import collections
 import tensorflow as tf
 import tensorflow.keras as keras
 
 from spatial_flow.reference import Reference
+from spatial_flow.numpy_reference import Numpy_Reference
+from spatial_flow.mutation import Async_Mutator
+from spatial_flow.spatial_tensor import Layout
 from spatial_flow.utils.error_utils import Selection_Error
+from spatial_flow.utils.instrumentation import instrument
 import spatial_flow.core as core
 
 """
@@ -61,12 +66,48 @@ class Selector(keras.layers.Layer):
     def index_shape(self):
         return self._index_shape
     @property
+    def layout(self):
+        return self._layout
+    @property
     def batch_dims(self):
-        return self._batch_dims
+        return tf.TensorShape([None] * self._layout.batch_rank)
     @property
     def channel_dims(self):
-        return self._channel_dims
-    def __init__(self, reference, name="selector", mode="simple"):
+        return self._layout.channel_shape
+    @property
+    def packed(self):
+        return self._packed
+    @property
+    def dedup(self):
+        return self._dedup
+    @property
+    def inverse_gradient(self):
+        return self._inverse_gradient
+    @property
+    def selection_key(self):
+        """ Selectors with equal keys produce identical selections from the same state """
+        return (self.reference, self._packed, self._dedup, self._layout)
+    @property
+    def hot_swappable(self):
+        """
+        Whether a compiled call picks up changes to the reference without retracing. True
+        unless selection depends on structures derived from the pointers, which are captured
+        when traced.
+        """
+        return self._dedup is None and not self._inverse_gradient
+    @property
+    def compiled(self):
+        """
+        A compiled call with a stable input signature. One trace serves every batch size.
+        If the selector is not hot swappable, it is rebuilt whenever the reference changes.
+        """
+        stale = not self.hot_swappable and self._compiled_version != self.reference.version
+        if self._compiled is None or stale:
+            self._compiled = tf.function(self.__call__, input_signature=[self._layout.signature()])
+            self._compiled_version = self.reference.version
+        return self._compiled
+    def __init__(self, reference, name="selector", mode="simple", packed=False, layout=None, dedup=None,
+                 inverse_gradient=False):
         """
 
         The initializer
@@ -77,20 +118,61 @@ class Selector(keras.layers.Layer):
 
         For the vast majority of purposes, simple is sufficinet.
 
-        :param reference: a valid reference
+        When packed is true, pointers which the reference has marked invalid are
+        never gathered. The output is then in packed format, [batch..., valid pointers, channel...],
+        and should be consumed by a reducer which understands packed format.
+
+        The layout declares up front how incoming spatial states are arranged. If not
+        provided, one batch dimension and no channel dimensions are assumed.
+
+        Dedup applies to packed selection. When set, pointers reading the same source are
+        gathered only once, either per neuron ("neuron") or across the whole reference
+        ("global"), then expanded back out. The output is unchanged, but repeated reads
+        of the state disappear. Reducers which can weight the distinct reads directly,
+        such as packed_reducer under "neuron", skip the expansion entirely.
+
+        When inverse_gradient is true, the backwards pass of the gather uses the cached
+        inverse index of the reference, summing the gradient of each source with a single
+        sorted segment sum rather than scattering it.
+
+        :param reference: a valid reference. A Numpy_Reference is converted into one.
         :param name: The name of this object
         :param mode: either "simple" or "advanced"
+        :param packed: Whether to compact away invalid pointers.
+        :param layout: A Layout, or None for the default.
+        :param dedup: None, "neuron", or "global"
+        :param inverse_gradient: Whether to use the inverse index for the gradient
         """
         super().__init__(name=name)
 
         # Quick Sanity check
 
+        if isinstance(reference, Numpy_Reference):
+            reference = reference.to_reference()
         if not isinstance(reference, Reference):
             raise Selection_Error("init - Not provided with a reference of type 'Reference'")
         if type(mode) != str:
             raise Selection_Error("init - mode was not string")
         if mode not in ("simple", "advanced"):
             raise Selection_Error("init - mode was not 'simple' or 'advanced")
+        if type(packed) != bool:
+            raise Selection_Error("init - packed was not bool")
+        if dedup not in (None, "neuron", "global"):
+            raise Selection_Error("init - dedup was not None, 'neuron', or 'global'")
+        if dedup is not None and not packed:
+            raise Selection_Error("init - dedup requires packed to be true")
+        if type(inverse_gradient) != bool:
+            raise Selection_Error("init - inverse_gradient was not bool")
+        if layout is None:
+            layout = Layout(reference.spatial_shape, ordering=reference.ordering)
+        if not isinstance(layout, Layout):
+            raise Selection_Error("init - layout was not of type 'Layout'")
+        if layout.spatial_shape != reference.spatial_shape:
+            raise Selection_Error("init - layout spatial shape %s does not match reference spatial shape %s"
+                                  % (layout.spatial_shape, reference.spatial_shape))
+        if layout.ordering != reference.ordering:
+            raise Selection_Error("init - layout ordering %s does not match reference ordering %s"
+                                  % (layout.ordering, reference.ordering))
 
         #Store reference
 
@@ -99,13 +181,12 @@ class Selector(keras.layers.Layer):
         self._spatial_shape = reference.spatial_shape
         self._comparison_shape = reference.comparison_shape
         self._index_shape = reference.index_shape
-
-        self._batch_dims = None
-        self._channel_dims = None
-
-        #hack save to work transparently
-
-            #impliment
+        self._packed = packed
+        self._dedup = dedup
+        self._inverse_gradient = inverse_gradient
+        self._layout = layout
+        self._compiled = None
+        self._compiled_version = None
 
     def modify(self, comparison_references, *args, **kwargs):
         """
@@ -158,17 +239,86 @@ class Selector(keras.layers.Layer):
         :return: None
         """
 
+        self.reference.update(self.__update_func(args, kwargs))
+
+    def run_modify_async(self, *args, continuous=True, **kwargs):
+        """
+
+        Runs your declared modify function in a background thread, against a copy of
+        the reference. Training may continue with the current reference meanwhile. Call
+        "swap" on the returned mutator at step boundaries to bring the result in.
+
+        :param args: Any arguments modify needs
+        :param continuous: Whether to begin the next mutation as soon as one is swapped in
+        :param kwargs: Any keyword arguments modify needs
+        :return: A started Async_Mutator
+        """
+        update_func = self.__update_func(args, kwargs)
+        mutator = Async_Mutator(self.reference, lambda reference: reference.update(update_func), continuous)
+        return mutator.start()
+
+    def __update_func(self, args, kwargs):
         if(self._mode == "simple"):
-            update_func = lambda unpacked, spatial_index : self.modify(unpacked, args, kwargs)
-            self.reference.update(update_func)
+            return lambda unpacked, spatial_index : self.modify(unpacked, args, kwargs)
+        return lambda unpacked, spatial_index : self.modify(unpacked, spatial_index, args, kwargs)
+
+    def select_packed(self, spatial_state):
+        """
+
+        Perform the extraction, gathering only pointers the reference
+        considers valid. Pruned pointers cost nothing.
+
+        :param spatial_state: A tensor in spatialgrid format
+        :return: A tensor in packed format, [batch..., valid pointers, channel...]
+        """
+
+        if self._dedup is not None:
+            unique, merge_map = self.select_unique(spatial_state)
+            return tf.gather(unique, merge_map, axis=self._layout.batch_rank)
+
+        flat_state = self._layout.flatten(spatial_state)
+        if self._inverse_gradient:
+            return core.inverse_gather(flat_state, self.reference.packed_sources,
+                                       self.reference.inverse_index(packed=True), self._layout.batch_rank)
+        return tf.gather(flat_state, self.reference.packed_sources, axis=self._layout.batch_rank)
+
+    def select_unique(self, spatial_state):
+        """
+
+        Gather each distinct source once, under the dedup scope.
+
+        :param spatial_state: A tensor in spatialgrid format
+        :return: A tuple of the distinct reads, [batch..., distinct, channel...], and the
+            merge map, which maps each valid pointer onto its distinct read.
+        """
+        scope = "neuron" if self._dedup is None else self._dedup
+        sources, _, merge_map = self.reference.unique_pointers(scope)
+        flat_state = self._layout.flatten(spatial_state)
+        return tf.gather(flat_state, sources, axis=self._layout.batch_rank), merge_map
+
+    def output_signature(self, dtype=tf.dtypes.float32):
+        """
+
+        Describes the output of this selector, leaving batch dimensions open.
+
+        :param dtype: The dtype of the spatial state
+        :return: A tf.TensorSpec, in comparison or packed format
+        """
+        batch_dims = self.batch_dims
+        if self._packed:
+            shape = batch_dims.concatenate([None]).concatenate(self.channel_dims)
         else:
-            update_func = lambda unpacked, spatial_index : self.modify(unpacked, spatial_index, args, kwargs)
-            self.reference.update(update_func)
+            shape = batch_dims.concatenate(self._layout.stored_spatial_shape).concatenate(
+                self.channel_dims).concatenate(self.comparison_shape)
+        return tf.TensorSpec(shape, dtype)
 
+    @instrument("Selector.call")
     def call(self, spatial_state):
         """
 
-        Perform the extraction and produce a tensor in comparison format.
+        Perform the extraction and produce a tensor in comparison format,
+        [batch..., spatial..., channel..., comparison...]. The spatial dimensions
+        are in stored form, as described by the layout.
 
         Compiles with tensorflow.
 
@@ -177,22 +327,92 @@ class Selector(keras.layers.Layer):
         :return: A tensor in comparison format
         """
 
-        #store batch (nonspatial) dimensions.
+        if self._packed:
+            return self.select_packed(spatial_state)
+
+        #Gather every pointer at once using the linearized reference. This gives
+        #[batch..., spatial..., comparison..., channel...]
+
+        layout = self._layout
+        flat_state = layout.flatten(spatial_state)
+        if self._inverse_gradient:
+            gathered = core.inverse_gather(flat_state, tf.reshape(self.reference.gather_reference, [-1]),
+                                           self.reference.inverse_index(packed=False), layout.batch_rank)
+            shape = tf.shape(flat_state)
+            gathered = tf.reshape(gathered, tf.concat([shape[:layout.batch_rank],
+                                                       tf.shape(self.reference.gather_reference),
+                                                       shape[layout.batch_rank + 1:]], axis=0))
+            gathered.set_shape(flat_state.shape[:layout.batch_rank].concatenate(
+                self.reference.gather_reference.shape).concatenate(flat_state.shape[layout.batch_rank + 1:]))
+        else:
+            gathered = tf.gather(flat_state, self.reference.gather_reference, axis=layout.batch_rank)
+        gathered = layout.restore(gathered)
+
+        #Move the comparison dimensions to the end
+
+        comparison_start = layout.batch_rank + layout.stored_spatial_rank
+        channel_start = comparison_start + self.comparison_shape.rank
+        permute = [*range(comparison_start),
+                   *range(channel_start, channel_start + layout.channel_rank),
+                   *range(comparison_start, channel_start)]
+        return tf.transpose(gathered, permute)
+
+
+class Selection_Cache():
+    """
+
+    Shares selections between selectors within a single forward pass.
 
-        if self._batch_dims is None:
-            self._batch_dims = spatial_state.batch_dims
-        if self._channel_dims is None:
-            self._channel_dims = spatial_state.channel_dims
+    Selectors wrapping the same reference, with the same mode and layout, produce
+    identical selections from the same state. The cache is told up front which selectors
+    will consume a selection. The first to ask computes it, and every other consumer
+    is handed the same tensor. Each entry is dropped as soon as its last consumer has
+    taken it, so that the selection may be freed as early as possible.
 
+    Entries are keyed on the selection key of the selector and the identity of the state
+    tensor, and are only reused while the version of the reference is unchanged.
+    """
+    def __init__(self, selectors):
+        """
 
-        #define callback function
-        def callback(comparison_grid):
-            gather = tf.gather_nd(spatial_state, comparison_grid, len(self._batch_dims)+len(self._channel_dims))
-            return gather
+        :param selectors: Every selector which will consume a selection, once per consumption
+        """
+        self._consumers = collections.Counter(selector.selection_key for selector in selectors)
+        self._entries = {}
 
-        #perform callback
-        shape = self.reference.comparison_shape
-        output = self.reference.unpack(callback, shape)
-        return output
+    def __len__(self):
+        """ The number of selections still held """
+        return len(self._entries)
 
+    def select(self, selector, spatial_state):
+        """
 
+        Fetch the selection of the given selector, computing it only if no equivalent
+        selector has already done so.
+
+        :param selector: A selector which was declared as a consumer
+        :param spatial_state: A tensor in spatialgrid format
+        :return: What the selector would return when called on the state
+        """
+        key = selector.selection_key
+        expected = self._consumers.get(key, 0)
+        if expected <= 1:
+            return selector(spatial_state)
+
+        entry_key = (key, id(spatial_state))
+        entry = self._entries.get(entry_key)
+        if (entry is None or entry["state"] is not spatial_state or
+                entry["version"] != selector.reference.version):
+            selection = selector(spatial_state)
+
+            # The state is held so that its identity cannot be reused while the entry lives
+            self._entries[entry_key] = {"state": spatial_state,
+                                        "version": selector.reference.version,
+                                        "selection": selection,
+                                        "remaining": expected - 1}
+            return selection
+
+        entry["remaining"] -= 1
+        if entry["remaining"] <= 0:
+            del self._entries[entry_key]
+        return entry["selection"]
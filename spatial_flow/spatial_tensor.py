@@ -1,4 +1,137 @@
 import tensorflow as tf
+import spatial_flow.core as core
+from spatial_flow.ordering import get_ordering
+
+
+class Layout():
+    """
+
+    A layout is the explicit contract describing how a tensor in spatialgrid
+    format is arranged. Every such tensor is [batch..., spatial..., channel...].
+
+    The spatial shape must be fully known. The number of batch dimensions must be
+    known, but their sizes are left open, so that one compiled graph may serve every
+    batch size. Channel dimensions must have a known rank, but individual entries
+    may be None.
+
+    Selectors and reducers are given a layout up front, rather than attempting to
+    discover it from the first tensor they see, and can therefore provide a stable
+    input signature for compiled calls.
+
+    If the ordering is not row major, the spatial dimensions are stored already flattened
+    in that ordering, [batch..., spatial, channel...]. "to_storage" and "from_storage" convert
+    at the model boundary.
+    """
+    @property
+    def batch_rank(self):
+        return self._batch_rank
+    @property
+    def spatial_shape(self):
+        return self._spatial_shape
+    @property
+    def channel_shape(self):
+        return self._channel_shape
+    @property
+    def ordering(self):
+        return self._ordering.name
+    @property
+    def stored_spatial_shape(self):
+        """ The spatial part of the shape of a stored tensor """
+        if self._ordering.is_row_major:
+            return self._spatial_shape
+        return tf.TensorShape([self._spatial_shape.num_elements()])
+    @property
+    def stored_spatial_rank(self):
+        return self.stored_spatial_shape.rank
+    @property
+    def spatial_rank(self):
+        return self._spatial_shape.rank
+    @property
+    def channel_rank(self):
+        return self._channel_shape.rank
+    @property
+    def rank(self):
+        return self._batch_rank + self.stored_spatial_rank + self.channel_rank
+    def __init__(self, spatial_shape, channel_shape=(), batch_rank=1, ordering="row_major"):
+        """
+
+        :param spatial_shape: A 1D list of integers specifying the spatial dimensions.
+        :param channel_shape: A 1D list specifying the channel dimensions. Entries may be None
+        :param batch_rank: The number of batch dimensions
+        :param ordering: The ordering of the flattened spatial axis. See ordering.py
+        """
+        if type(batch_rank) != int or batch_rank < 0:
+            raise ValueError("Layout - batch_rank was not a non-negative integer")
+        spatial_shape = tf.TensorShape(spatial_shape)
+        if not spatial_shape.is_fully_defined():
+            raise ValueError("Layout - spatial_shape %s was not fully defined" % spatial_shape)
+        channel_shape = tf.TensorShape(channel_shape)
+        if channel_shape.rank is None:
+            raise ValueError("Layout - channel_shape must have a known rank")
+
+        self._batch_rank = batch_rank
+        self._spatial_shape = spatial_shape
+        self._channel_shape = channel_shape
+        self._ordering = get_ordering(tuple(spatial_shape.as_list()), ordering)
+
+    def __eq__(self, other):
+        if not isinstance(other, Layout):
+            return NotImplemented
+        return (self._batch_rank == other.batch_rank and
+                self._spatial_shape == other.spatial_shape and
+                self._channel_shape.as_list() == other.channel_shape.as_list() and
+                self.ordering == other.ordering)
+
+    def __hash__(self):
+        return hash((self._batch_rank, tuple(self._spatial_shape.as_list()),
+                     tuple(self._channel_shape.as_list()), self.ordering))
+
+    def __repr__(self):
+        return "Layout(spatial_shape=%s, channel_shape=%s, batch_rank=%s, ordering=%s)" % (
+            self._spatial_shape.as_list(), self._channel_shape.as_list(), self._batch_rank, self.ordering)
+
+    def signature(self, batch_shape=None, dtype=tf.dtypes.float32):
+        """
+
+        Builds a TensorSpec for a tensor in spatialgrid format
+
+        :param batch_shape: None to leave every batch dimension open, else a 1D list of length batch_rank.
+        :param dtype: The dtype of the tensor.
+        :return: A tf.TensorSpec
+        """
+        if batch_shape is None:
+            batch_shape = [None] * self._batch_rank
+        batch_shape = tf.TensorShape(batch_shape)
+        if batch_shape.rank != self._batch_rank:
+            raise ValueError("Layout - batch_shape %s did not have rank %s" % (batch_shape, self._batch_rank))
+        return tf.TensorSpec(batch_shape.concatenate(self.stored_spatial_shape).concatenate(self._channel_shape),
+                             dtype)
+
+    def flatten(self, input):
+        """ Flattens the spatial dimensions of a stored tensor, giving [batch..., spatial, channel...] """
+        if not self._ordering.is_row_major:
+            return input
+        return core.flatten_spatial(input, self._batch_rank, self.spatial_rank)
+
+    def restore(self, input):
+        """ Restores flattened spatial dimensions to their stored form """
+        if not self._ordering.is_row_major:
+            return input
+        return core.restore_spatial(input, self._batch_rank, self._spatial_shape)
+
+    def to_storage(self, input):
+        """ Converts a [batch..., spatial..., channel...] tensor into stored form. Use at the model boundary """
+        if self._ordering.is_row_major:
+            return input
+        flat = core.flatten_spatial(input, self._batch_rank, self.spatial_rank)
+        return self._ordering.to_curve(flat, self._batch_rank)
+
+    def from_storage(self, input):
+        """ Converts a stored tensor back into [batch..., spatial..., channel...]. Use at the model boundary """
+        if self._ordering.is_row_major:
+            return input
+        flat = self._ordering.from_curve(input, self._batch_rank)
+        return core.restore_spatial(flat, self._batch_rank, self._spatial_shape)
 
 
 class Spatial_State(tf.keras.layers.Layer):
@@ -21,11 +154,14 @@ class Spatial_State(tf.keras.layers.Layer):
         return self._spatial_dims
     @property
     def channel_dims(self):
-        return self.
+        return self._channel_dims
     @property
     def total_dims(self):
         return self._total_dims
-    def __init__(self, spatial_dims, channel_dims=[], batch_dims=[None], initialization ="zeros"):
+    @property
+    def layout(self):
+        return self._layout
+    def __init__(self, spatial_dims, channel_dims=[], batch_dims=[None], initialization ="zeros", ordering="row_major"):
         """_channel_dims
 
         The initialization method.
@@ -39,17 +175,56 @@ class Spatial_State(tf.keras.layers.Layer):
             channels
         :param batch_dims: A 1D tensorshope, which may have none as entries, corrolated to any batch parameters
         :param initialization: What form to initialize any tensor to.
+        :param ordering: The ordering of the flattened spatial axis. If not row major, the state
+            is held flattened in that ordering. See Layout.
         """
         super().__init__(False)
 
         self._batch_dims = tf.TensorShape(batch_dims)
         self._spatial_dims = tf.TensorShape(tf.constant(spatial_dims))
         self._channel_dims = tf.TensorShape(channel_dims)
-        self._total_dims = self._batch_dims.concatenate(self._spatial_dims).concatenate(self._channel_dims)
+        self._layout = Layout(self._spatial_dims, self._channel_dims, self._batch_dims.rank, ordering)
+        self._total_dims = self._batch_dims.concatenate(self._layout.stored_spatial_shape).concatenate(self._channel_dims)
 
-        if type(initialization) is str:
-            intialization = tf.keras.initializers.get(initialization)
+        self._initialization = tf.keras.initializers.get(initialization)
 
         self._state = tf.keras.Input(type_spec=tf.TensorSpec(self._total_dims))
+    def initial_state(self, batch_shape=None, dtype=tf.dtypes.float32):
+        """
+
+        Builds a concrete initial state using the initializer. Any batch
+        dimension left as None must be provided through batch_shape.
+
+        :param batch_shape: A 1D list of integers, or None to use batch_dims as is.
+        :param dtype: The dtype of the state.
+        :return: A tensor of shape [batch..., spatial..., channel...]
+        """
+        if batch_shape is None:
+            batch_shape = self._batch_dims
+        batch_shape = tf.TensorShape(batch_shape)
+        if not batch_shape.is_fully_defined():
+            raise ValueError("Spatial_State - initial_state: batch shape %s was not fully defined" % batch_shape)
+        shape = batch_shape.concatenate(self._layout.stored_spatial_shape).concatenate(self._channel_dims)
+        return self._initialization(shape, dtype=dtype)
+    def signature(self, batch_shape=None, dtype=tf.dtypes.float32):
+        """
+
+        Builds a TensorSpec describing a concrete state. Unlike the input,
+        batch dimensions may be fixed here, which is what allows compiled
+        graphs to be specialized to a particular batch shape.
+
+        :param batch_shape: A 1D list, or None to use batch_dims as is.
+        :param dtype: The dtype of the state.
+        :return: A tf.TensorSpec
+        """
+        if batch_shape is None:
+            batch_shape = self._batch_dims
+        return self._layout.signature(batch_shape, dtype)
+    def to_storage(self, state):
+        """ Convert a [batch..., spatial..., channel...] tensor into this state's stored form """
+        return self._layout.to_storage(state)
+    def from_storage(self, state):
+        """ Convert a stored state back into [batch..., spatial..., channel...] """
+        return self._layout.from_storage(state)
     def call(self, null):
         return self.state
\ No newline at end of file
@@ -0,0 +1,209 @@
+import tensorflow as tf
+from spatial_flow.ordering import get_ordering
+
+"""
+
+This section pertains to statistics over the pointers of a reference.
+
+Knowing how a topology is distributed matters for analysis and for sharding: which
+locations are read from most, how far pointers reach, and how many are wasted on
+duplicates. Everything here is computed with vectorized bincount and scatter ops,
+never by unpacking the reference location by location.
+
+The statistics are:
+
+    fan_in - For each location, how many valid pointers it holds, and so how many reads it makes.
+    fan_out - For each location, how many valid pointers read from it. The hot spots of a topology
+        are the locations with the largest fan out.
+    distance - The distance each valid pointer reaches, measured as the largest offset along any
+        dimension after wrapping around the grid. Reported as a histogram.
+    duplicates - For each location, how many of its valid pointers read from a source another of
+        its pointers already reads from.
+    mutable_fraction - The fraction of locations which remain mutable.
+
+Per location statistics are returned in the spatial shape of the reference. Per location
+counts are kept as running totals, so that when only some locations of a reference change,
+only the pointers of the locations the reference reports as dirty are revisited.
+
+"""
+
+
+class Pointer_Statistics():
+    """
+
+    The statistics of a single reference.
+
+    These are normally obtained through Reference.statistics, which caches them and keeps
+    them up to date as the reference is updated.
+    """
+    @property
+    def reference(self):
+        return self._reference
+
+    @property
+    def version(self):
+        """ The version of the reference these statistics describe """
+        return self._version
+
+    @property
+    def fan_in(self):
+        """ The number of valid pointers each location holds, in spatial shape """
+        return tf.reshape(self._fan_in, self._reference.spatial_shape)
+
+    @property
+    def fan_out(self):
+        """ The number of valid pointers reading from each location, in spatial shape """
+        return tf.reshape(tf.gather(self._fan_out, self._ordering.forward), self._reference.spatial_shape)
+
+    @property
+    def duplicates(self):
+        """ The number of duplicate pointers each location holds, in spatial shape """
+        return tf.reshape(self._duplicates, self._reference.spatial_shape)
+
+    @property
+    def duplicate_count(self):
+        return tf.reduce_sum(self._duplicates)
+
+    @property
+    def fan_in_histogram(self):
+        """ Entry i is the number of locations with a fan in of i """
+        if "fan_in" not in self._histograms:
+            self._histograms["fan_in"] = tf.math.bincount(self._fan_in, minlength=self._reference.comparison_size + 1)
+        return self._histograms["fan_in"]
+
+    @property
+    def fan_out_histogram(self):
+        """ Entry i is the number of locations with a fan out of i """
+        if "fan_out" not in self._histograms:
+            self._histograms["fan_out"] = tf.math.bincount(self._fan_out)
+        return self._histograms["fan_out"]
+
+    @property
+    def distance_histogram(self):
+        """ Entry i is the number of valid pointers reaching a distance of i """
+        return self._distance_counts
+
+    @property
+    def mutable_fraction(self):
+        return tf.reduce_mean(tf.cast(self._reference.mutable, tf.dtypes.float32))
+
+    def __init__(self, reference):
+        """
+
+        :param reference: The reference to gather statistics over
+        """
+        self._reference = reference
+        self._ordering = get_ordering(tuple(reference.spatial_shape.as_list()), reference.ordering)
+        self._max_distance = max(reference.spatial_shape.as_list()) // 2
+        self.__rebuild()
+
+    def __pointer_terms(self, rows):
+        # For the given row major locations, the source, validity, and
+        # distance of each of their pointers. Each is [rows, comparison].
+
+        reference = self._reference
+        flat = [reference.spatial_size, reference.comparison_size]
+        sources = tf.gather(tf.reshape(reference.linear_reference, flat), rows)
+        valid = tf.gather(tf.reshape(reference.valid, flat), rows)
+        relative = tf.gather(tf.reshape(reference.relative_reference, [*flat, reference.spatial_shape.rank]), rows)
+
+        # Wrap each offset onto the nearest copy of the grid before measuring it
+        shape = tf.constant(reference.spatial_shape.as_list(), dtype=relative.dtype)
+        half = tf.math.floordiv(shape, 2)
+        wrapped = tf.math.floormod(relative + half, shape) - half
+        distance = tf.reduce_max(tf.abs(wrapped), axis=-1)
+        return sources, valid, distance
+
+    def __row_terms(self, sources, valid):
+        # The fan in and duplicate count of each of the given locations
+
+        fan_in = tf.reduce_sum(tf.cast(valid, tf.dtypes.int32), axis=-1)
+
+        # Number every (location, source) pair. Whatever is left after
+        # removing repeats is the number of distinct sources per location.
+        local = tf.broadcast_to(tf.range(tf.shape(sources)[0])[:, None], tf.shape(sources))
+        keys = tf.boolean_mask(tf.cast(local, tf.dtypes.int64) * self._reference.spatial_size
+                               + tf.cast(sources, tf.dtypes.int64), valid)
+        distinct, _ = tf.unique(keys)
+        distinct = tf.math.bincount(tf.cast(tf.math.floordiv(distinct, self._reference.spatial_size), tf.dtypes.int32),
+                                    minlength=tf.shape(sources)[0], maxlength=tf.shape(sources)[0])
+        return fan_in, fan_in - distinct
+
+    def __rebuild(self):
+        # Compute every statistic from scratch
+
+        reference = self._reference
+        rows = tf.range(reference.spatial_size)
+        sources, valid, distance = self.__pointer_terms(rows)
+
+        self._sources = sources
+        self._valid = valid
+        self._distance = distance
+        self._fan_in, self._duplicates = self.__row_terms(sources, valid)
+        self._fan_out = tf.math.bincount(tf.boolean_mask(sources, valid),
+                                         minlength=reference.spatial_size, maxlength=reference.spatial_size)
+        self._distance_counts = tf.math.bincount(tf.boolean_mask(distance, valid),
+                                                 minlength=self._max_distance + 1, maxlength=self._max_distance + 1)
+        self._histograms = {}
+        self._version = reference.version
+
+    def refresh(self, rows=None):
+        """
+
+        Bring the statistics up to date with the reference.
+
+        :param rows: None to recompute everything. Else a 1D int tensor of the row major
+            flattened locations which have changed. Only the pointers of those locations
+            are revisited.
+        """
+        if rows is None:
+            self.__rebuild()
+            return
+
+        rows = tf.cast(tf.reshape(rows, [-1]), tf.dtypes.int32)
+        sources, valid, distance = self.__pointer_terms(rows)
+        old_sources = tf.gather(self._sources, rows)
+        old_valid = tf.gather(self._valid, rows)
+        old_distance = tf.gather(self._distance, rows)
+
+        # Retract the contributions of the old pointers, and add those of the new.
+        def counts(old, new):
+            old = tf.boolean_mask(old, old_valid)
+            new = tf.boolean_mask(new, valid)
+            updates = tf.concat([-tf.ones_like(old), tf.ones_like(new)], axis=0)
+            return tf.concat([old, new], axis=0)[:, None], updates
+
+        indices, updates = counts(old_sources, sources)
+        self._fan_out = tf.tensor_scatter_nd_add(self._fan_out, indices, updates)
+        indices, updates = counts(old_distance, distance)
+        self._distance_counts = tf.tensor_scatter_nd_add(self._distance_counts, indices, updates)
+
+        fan_in, duplicates = self.__row_terms(sources, valid)
+        self._fan_in = tf.tensor_scatter_nd_update(self._fan_in, rows[:, None], fan_in)
+        self._duplicates = tf.tensor_scatter_nd_update(self._duplicates, rows[:, None], duplicates)
+
+        self._sources = tf.tensor_scatter_nd_update(self._sources, rows[:, None], sources)
+        self._valid = tf.tensor_scatter_nd_update(self._valid, rows[:, None], valid)
+        self._distance = tf.tensor_scatter_nd_update(self._distance, rows[:, None], distance)
+        self._histograms = {}
+        self._version = self._reference.version
+
+    def hot_spots(self, count):
+        """
+
+        Find the locations read from most.
+
+        :param count: How many locations to return
+        :return: A tuple of the locations, as [count, spatial rank] coordinates, and their fan outs
+        """
+        fan_out, locations = tf.math.top_k(tf.gather(self._fan_out, self._ordering.forward), k=count)
+        coordinates = tf.transpose(tf.unravel_index(locations, self._reference.spatial_shape.as_list()))
+        return coordinates, fan_out
+
+    def as_dict(self):
+        """ The summary statistics, as python values """
+        return {"fan_in_histogram": self.fan_in_histogram.numpy().tolist(),
+                "fan_out_histogram": self.fan_out_histogram.numpy().tolist(),
+                "distance_histogram": self.distance_histogram.numpy().tolist(),
+                "duplicate_count": int(self.duplicate_count),
+                "mutable_fraction": float(self.mutable_fraction)}
@@ -1,2 +1,3 @@
 from spatial_flow.utils import error_utils
 from spatial_flow.utils import functions
+from spatial_flow.utils import instrumentation
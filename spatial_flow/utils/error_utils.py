@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 import tensorflow.python.framework.errors as errors
 
@@ -15,6 +16,137 @@ This is meant to be a private file.
 """
 
 
+""" Validation level section
+
+The validation level controls how much checking the assertion functions below perform.
+
+    "off" - no checking at all.
+    "trace" - only checks which can be resolved statically are performed. Dtypes, ranks, and
+        known shapes are always checked, and values are checked only when they are known
+        without running the graph, as is always the case eagerly. No assert ops are ever created.
+    "full" - every check is performed, using tf.debugging. In graph mode this creates assert ops.
+
+"full" is the default, matching the checking performed before levels existed. Production
+graphs should be traced under "trace" or "off".
+"""
+
+VALIDATION_OFF = "off"
+VALIDATION_TRACE = "trace"
+VALIDATION_FULL = "full"
+_validation_level = VALIDATION_FULL
+
+
+def set_validation_level(level):
+    """ Set the global validation level. Must be "off", "trace", or "full" """
+    global _validation_level
+    check_catagory(level, "level", [VALIDATION_OFF, VALIDATION_TRACE, VALIDATION_FULL], "off, trace, full")
+    _validation_level = level
+
+
+def get_validation_level():
+    return _validation_level
+
+
+class validation_level():
+    """ Context manager which temporarily sets the validation level """
+    def __init__(self, level):
+        self._level = level
+    def __enter__(self):
+        self._previous = get_validation_level()
+        set_validation_level(self._level)
+        return self
+    def __exit__(self, *args):
+        set_validation_level(self._previous)
+
+
+def _static_value(input):
+    # Fetch the value of input if it can be known without running a graph, else None
+    if tf.is_tensor(input):
+        return tf.get_static_value(input)
+    return np.asarray(input)
+
+
+def _static_failure(message, default):
+    if message is None:
+        message = default
+    raise errors.InvalidArgumentError(None, None, message)
+
+
+def assert_shapes(shapes, message=None):
+    """ As tf.debugging.assert_shapes, routed through the validation level """
+    if _validation_level == VALIDATION_OFF:
+        return
+    if _validation_level == VALIDATION_FULL:
+        tf.debugging.assert_shapes(shapes, message=message)
+        return
+    for input, shape in shapes:
+        if not tf.TensorShape(np.shape(input) if not tf.is_tensor(input) else input.shape).is_compatible_with(shape):
+            _static_failure(message, "Expected shape %s, was not" % (shape,))
+
+
+def assert_integer(input, message=None):
+    """ As tf.debugging.assert_integer. This is always static. """
+    if _validation_level == VALIDATION_OFF:
+        return
+    tf.debugging.assert_integer(input, message=message)
+
+
+def assert_type(input, dtype, message=None):
+    """ As tf.debugging.assert_type. This is always static. """
+    if _validation_level == VALIDATION_OFF:
+        return
+    tf.debugging.assert_type(input, dtype, message=message)
+
+
+def _check_rank(input, condition, rank, message, full_check):
+    # Shared logic for the rank assertions
+    if _validation_level == VALIDATION_OFF:
+        return
+    if _validation_level == VALIDATION_FULL:
+        full_check(input, rank, message=message)
+        return
+    actual = input.shape.rank if tf.is_tensor(input) else np.ndim(input)
+    if actual is not None and not condition(actual, rank):
+        _static_failure(message, "Rank %s did not satisfy requirement %s" % (actual, rank))
+
+
+def assert_rank(input, rank, message=None):
+    """ As tf.debugging.assert_rank, routed through the validation level """
+    _check_rank(input, lambda actual, rank: actual == rank, rank, message, tf.debugging.assert_rank)
+
+
+def assert_rank_in(input, ranks, message=None):
+    """ As tf.debugging.assert_rank_in, routed through the validation level """
+    _check_rank(input, lambda actual, ranks: actual in ranks, ranks, message, tf.debugging.assert_rank_in)
+
+
+def assert_rank_at_least(input, rank, message=None):
+    """ As tf.debugging.assert_rank_at_least, routed through the validation level """
+    _check_rank(input, lambda actual, rank: actual >= rank, rank, message, tf.debugging.assert_rank_at_least)
+
+
+def _check_condition(input, threshold, condition, message, full_check):
+    # Shared logic for the value assertions
+    if _validation_level == VALIDATION_OFF:
+        return
+    if _validation_level == VALIDATION_FULL:
+        full_check(input, threshold, message=message)
+        return
+    value = _static_value(input)
+    if value is not None and not np.all(condition(value, threshold)):
+        _static_failure(message, "Condition failed against threshold %s" % threshold)
+
+
+def assert_greater_equal(input, threshold, message=None):
+    """ As tf.debugging.assert_greater_equal, routed through the validation level """
+    _check_condition(input, threshold, np.greater_equal, message, tf.debugging.assert_greater_equal)
+
+
+def assert_less_equal(input, threshold, message=None):
+    """ As tf.debugging.assert_less_equal, routed through the validation level """
+    _check_condition(input, threshold, np.less_equal, message, tf.debugging.assert_less_equal)
+
+
 """ Cast section """
 
 def cast(input, input_name, dtype, dtype_name):
@@ -184,4 +316,9 @@ class Unit_Error(Exception):
 class Reducer_Error(Exception):
     def __init__(self, msg):
         msg = "Reducer Error: " + msg
-        super().__init__(msg)
\ No newline at end of file
+        super().__init__(msg)
+
+class Combiner_Error(Exception):
+    def __init__(self, msg):
+        msg = "Combiner Error: " + msg
+        super().__init__(msg)
@@ -0,0 +1,159 @@
+import time
+import inspect
+import functools
+import tensorflow as tf
+
+"""
+
+Instrumentation Utility file
+
+This contains the opt-in instrumentation used to find out which spatial flow
+operations are retracing and where time is being spent. Functions are marked with
+the "instrument" decorator. While instrumentation is disabled, the decorator does
+nothing beyond a single flag check before calling straight through.
+
+When enabled, each instrumented function records:
+
+    traces - how many times it was run while a graph was being traced.
+    eager_calls, eager_time - how many times it ran eagerly, and for how long in seconds.
+    graph_calls, graph_time - how many times a traced graph containing it was executed, and for how long.
+        These are measured by timestamp ops, and so only exist in graphs traced while enabled.
+    max_elements, last_shape - the size of the largest output, and the shape of the most recent one.
+
+Graph execution counters are held in variables, and so are read when the report is made.
+If profiler annotations are requested, eager calls are wrapped in tf.profiler trace events and
+traced graphs are placed in a name scope, so both show up under their name in the profiler.
+
+"""
+
+_enabled = False
+_profiler = False
+_records = {}
+
+
+def enable(profiler=False):
+    """ Turn instrumentation on. If profiler is true, also emit tf.profiler annotations """
+    global _enabled, _profiler
+    _enabled = True
+    _profiler = profiler
+
+
+def disable():
+    """ Turn instrumentation off. Graphs traced while enabled keep their timing ops. """
+    global _enabled, _profiler
+    _enabled = False
+    _profiler = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """ Discard every record """
+    _records.clear()
+
+
+class _Record():
+    """ The statistics gathered for a single instrumented function """
+    def __init__(self):
+        self.traces = 0
+        self.eager_calls = 0
+        self.eager_time = 0.0
+        self.max_elements = 0
+        self.last_shape = None
+
+        # Created outside of any graph, so traced graphs may update them
+        with tf.init_scope():
+            self.graph_calls = tf.Variable(0, dtype=tf.dtypes.int64, trainable=False)
+            self.graph_time = tf.Variable(0.0, dtype=tf.dtypes.float64, trainable=False)
+
+    def as_dict(self):
+        return {"traces": self.traces,
+                "eager_calls": self.eager_calls,
+                "eager_time": self.eager_time,
+                "graph_calls": int(self.graph_calls.numpy()),
+                "graph_time": float(self.graph_time.numpy()),
+                "max_elements": self.max_elements,
+                "last_shape": self.last_shape}
+
+
+def _fetch(name):
+    if name not in _records:
+        _records[name] = _Record()
+    return _records[name]
+
+
+def _record_sizes(record, output):
+    # Record the size of every tensor produced. Static shapes are used
+    # while tracing, as that is all that is available.
+    for item in tf.nest.flatten(output, expand_composites=True):
+        if not tf.is_tensor(item):
+            continue
+        shape = item.shape
+        record.last_shape = shape.as_list() if shape.rank is not None else None
+        elements = shape.num_elements()
+        if elements is not None:
+            record.max_elements = max(record.max_elements, elements)
+
+
+def report():
+    """
+
+    Builds the structured report.
+
+    :return: A dict mapping each instrumented name to a dict of its statistics
+    """
+    return {name: record.as_dict() for name, record in _records.items()}
+
+
+def instrument(name):
+    """
+
+    Decorator marking a function for instrumentation under the given name.
+
+    :param name: The name to record under, such as "Selector.call"
+    :return: The decorator
+    """
+    if not isinstance(name, str):
+        raise TypeError("instrument - name was not a string")
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+
+            record = _fetch(name)
+            if tf.executing_eagerly():
+                record.eager_calls += 1
+                start = time.perf_counter()
+                if _profiler:
+                    with tf.profiler.experimental.Trace(name):
+                        output = function(*args, **kwargs)
+                else:
+                    output = function(*args, **kwargs)
+                record.eager_time += time.perf_counter() - start
+                _record_sizes(record, output)
+                return output
+
+            # We are tracing. Count it, then surround the traced ops with timestamps.
+            record.traces += 1
+            with tf.name_scope(name.replace(".", "_")):
+                start = tf.timestamp()
+                with tf.control_dependencies([start]):
+                    output = function(*args, **kwargs)
+                tensors = [item for item in tf.nest.flatten(output, expand_composites=True) if tf.is_tensor(item)]
+                with tf.control_dependencies(tensors):
+                    elapsed = tf.timestamp() - start
+                record.graph_calls.assign_add(1)
+                record.graph_time.assign_add(elapsed)
+            _record_sizes(record, output)
+            return output
+
+        # Keras inspects call signatures to decide which arguments to pass, so
+        # the wrapper must advertise the signature of what it wraps.
+        wrapper.__signature__ = inspect.signature(function)
+        return wrapper
+    return decorator
@@ -0,0 +1,34 @@
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from spatial_flow.spatial_tensor import Spatial_State
+from spatial_flow.pipeline import State_Feed
+
+
+def make_feed():
+    return State_Feed(Spatial_State([4, 4], [2]), buckets=(1, 8, 32))
+
+
+def test_single_sample_lands_in_smallest_bucket():
+    feed = make_feed()
+    stream = tf.data.Dataset.from_tensor_slices(tf.random.normal([1, 4, 4, 2]))
+    batches = [(state.shape[0], int(count)) for state, count in feed(stream)]
+    assert batches == [(1, 1)]
+
+
+def test_short_stream_never_uses_largest_bucket():
+    feed = make_feed()
+    stream = tf.data.Dataset.from_tensor_slices(tf.random.normal([3, 4, 4, 2]))
+    batches = [(state.shape[0], int(count)) for state, count in feed(stream)]
+    assert sum(count for _, count in batches) == 3
+    assert all(bucket in (1, 8) for bucket, _ in batches)
+
+
+def test_samples_are_kept_in_order():
+    feed = make_feed()
+    samples = tf.random.normal([40, 4, 4, 2])
+    stream = tf.data.Dataset.from_tensor_slices(samples)
+    states = [state[:count] for state, count in feed(stream)]
+    assert all(state.shape[0] in feed.buckets for state, _ in feed(stream))
+    tf.debugging.assert_equal(tf.concat(states, axis=0), samples)